@@ -1,8 +1,17 @@
 
 import datetime
 import enum
+import getpass
+import os
+import re
+import socket
+import threading
+import time
 from typing import Any, Dict
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from sqlmodel import Session, create_engine, SQLModel, select
 from JupyRunner.core import schema, helpers
@@ -13,12 +22,28 @@ log = helpers.log
 config = None
 url = None
 client = None
+session = None
+
+default_http_config = {
+    'timeout': 30,          # seconds for connecting and each read
+    'retries': 3,           # for connection errors and 502/503/504 of idempotent requests (GET, PUT, PATCH, ...)
+    'backoff_factor': 0.2,  # sleeps backoff_factor * 2**(n-1) seconds before the n-th retry
+    'backoff_jitter': 0.2,  # plus a random jitter of up to this many seconds
+    'pool_maxsize': 10,     # kept alive connections
+    'submitter': '',        # sent as the X-Submitter header (the fair share group of created scripts), defaults to user@host
+}
+http_config = dict(default_http_config)
+
+stats = {}
+_stats_lock = threading.Lock()
 
 def setup(cnfg):
-    global config, url, client
+    global config, url, client, http_config, session
     config = cnfg
     url = config['globals']['dbserver_uri']
-    log.info(f'HTTP API initialized with {url=}')
+    http_config = {**default_http_config, **(config.get('http', {}) or {})}
+    session = None
+    log.info(f'HTTP API initialized with {url=} {http_config=}')
     client = APIClient(url)    
 
 def start(cnfg):
@@ -27,6 +52,67 @@ def start(cnfg):
 
 # def set_prop_remote(script: schema.Script):
 
+def make_session(cnfg:dict|None=None) -> requests.Session:
+    """a requests session with a keep-alive connection pool and retries with exponential backoff and jitter"""
+    cnfg = http_config if cnfg is None else cnfg
+    retry = Retry(total=cnfg['retries'], backoff_factor=cnfg['backoff_factor'], backoff_jitter=cnfg['backoff_jitter'],
+                  status_forcelist=(502, 503, 504), allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'PATCH'}, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cnfg['pool_maxsize'], max_retries=retry)
+    sess = requests.Session()
+    sess.headers['X-Submitter'] = cnfg.get('submitter') or get_default_submitter()
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return sess
+
+def get_default_submitter() -> str:
+    try:
+        return f'{getpass.getuser()}@{socket.gethostname()}'
+    except Exception:
+        return socket.gethostname()
+
+def get_session() -> requests.Session:
+    global session
+    if session is None:
+        session = make_session()
+    return session
+
+def _reset_session():
+    # a forked job must not share the pooled sockets with its parent
+    global session
+    session = None
+
+os.register_at_fork(after_in_child=_reset_session)
+
+def get_endpoint_key(method:str, _url:str) -> str:
+    """the method and route of a request with all ids replaced, e.G. "PATCH /script/{id}" """
+    path = re.sub(r'^https?://[^/]+', '', _url.split('?')[0])
+    return f'{method.upper()} ' + re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+def record_latency(key:str, dt:float, is_error:bool=False):
+    with _stats_lock:
+        st = stats.setdefault(key, {'n': 0, 'n_err': 0, 't_total': 0.0, 't_max': 0.0})
+        st['n'] += 1
+        st['n_err'] += int(is_error)
+        st['t_total'] += dt
+        st['t_max'] = max(st['t_max'], dt)
+
+def get_stats() -> dict:
+    """the number of requests, errors and the mean and max latency in seconds per endpoint"""
+    with _stats_lock:
+        return {k: {**v, 't_mean': v['t_total'] / v['n'] if v['n'] else 0} for k, v in stats.items()}
+
+def request(method:str, _url:str, **kwargs) -> requests.Response:
+    """all HTTP requests to the server go through here (pooled session, default timeout, retries and latency counters)"""
+    kwargs.setdefault('timeout', http_config['timeout'])
+    t_start = time.perf_counter()
+    is_error = True
+    try:
+        response = get_session().request(method, _url, **kwargs)
+        is_error = response.status_code >= 500
+        return response
+    finally:
+        record_latency(get_endpoint_key(method, _url), time.perf_counter() - t_start, is_error)
+
 def ping(_url = None):
     
     _url = url if not _url else _url
@@ -34,10 +120,30 @@ def ping(_url = None):
     _url = f"{_url.rstrip('/')}/ping"
     log.debug(f'GET: {_url}')
 
-    response = requests.get(url)
+    response = request('GET', _url)
     response.raise_for_status() 
     return response.text
 
+def wait_for_events(since:int|None=None, timeout:float=30, _url = None):
+    """long poll the server until any script needs the attention of a runner or the timeout has passed
+
+    Args:
+        since (int | None, optional): the last event seq number seen. None returns the current seq immediately. Defaults to None.
+        timeout (float, optional): max time in seconds the server shall block. Defaults to 30.
+
+    Returns:
+        dict: with seq, events and timed_out (see dispatch_events.wait)
+    """
+    _url = url if not _url else _url
+    assert _url, 'no URL given for wait_for_events!'
+    _url = f"{_url.rstrip('/')}/events/wait"
+    params = {'timeout': timeout} if since is None else {'timeout': timeout, 'since': since}
+    log.debug(f'GET: {_url} {params=}')
+
+    response = request('GET', _url, params=params, timeout=timeout + 10)
+    response.raise_for_status()
+    return response.json()
+
 
 class APIClient:
     def __init__(self, base_url:str=None, none_on_404 = False):
@@ -80,7 +186,7 @@ class APIClient:
     def get(self, endpoint, params=None):
         url = self._url(endpoint)
         log.debug(f'GET: {url} {params=}')
-        response = requests.get(url, params=params) if params else requests.get(url)
+        response = request('GET', url, params=params) if params else request('GET', url)
         if response.status_code == 404 and self.none_on_404:
             return None
         
@@ -91,7 +197,7 @@ class APIClient:
         url = self._url(endpoint)
         data = self._json(data)
         log.debug(f'PUT: {url} {data=}')
-        response = requests.put(url, json=data)
+        response = request('PUT', url, json=data)
         response.raise_for_status()  # Raise an exception for error responses
         resp = response.json()
         self.validate(data, resp)
@@ -102,7 +208,7 @@ class APIClient:
         url = self._url(endpoint)
         data = self._json(data)
         log.debug(f'POST: {url} {data=}')
-        response = requests.post(url, json=data)
+        response = request('POST', url, json=data)
         response.raise_for_status()  # Raise an exception for error responses
         resp = response.json()
         self.validate(data, resp)
@@ -113,7 +219,7 @@ class APIClient:
         url = self._url(endpoint)
         data = self._json(data)
         log.debug(f'POST: {url} {data=}')
-        response = requests.patch(url, json=data)
+        response = request('PATCH', url, json=data)
         response.raise_for_status()  # Raise an exception for error responses
         resp = response.json()
         self.validate(data, resp)
@@ -184,11 +290,210 @@ class ScriptClient(ModelClient):
         }
 
         url = f"{self._base_url}/qry/{self.route}".rstrip('/')
-        response = requests.get(url, params=kwargs)
+        response = request('GET', url, params=kwargs)
+        response.raise_for_status() 
+        return [self.cls.model_validate(v) for v in response.json()]
+
+    def qry_page(self, n_max:int=50, cursor:str|None=None, order:str='asc', **kwargs) -> tuple[list[schema.Script], str|None, str|None]:
+        """one page of scripts (see qry for the filters) and the cursors for the next and the previous page (None if there is none)"""
+        params = {**kwargs, "n_max": n_max, "cursor": cursor, "order": order}
+        url = f"{self._base_url}/qry/{self.route}".rstrip('/')
+        response = request('GET', url, params=params)
         response.raise_for_status() 
+        scripts = [self.cls.model_validate(v) for v in response.json()]
+        return scripts, response.headers.get('X-Next-Cursor'), response.headers.get('X-Prev-Cursor')
+    
+
+    def claim(self, runner_id:str|None=None, runner_ip:str|None=None, n_max:int=1, 
+              max_cost:int|None=None, cost_cap:int|None=None, lease_sec:float=120, scheduler:dict|None=None) -> list[schema.Script]:
+        """atomically claim up to n_max WAITING_TO_RUN scripts for this runner (see db_interface.claim_scripts)"""
+        data = dict(runner_id=runner_id, runner_ip=runner_ip, n_max=n_max, max_cost=max_cost, cost_cap=cost_cap, lease_sec=lease_sec, scheduler=scheduler)
+        url = f"{self._base_url}/action/{self.route}/claim"
+        log.debug(f'POST: {url} {data=}')
+        response = request('POST', url, json=data)
+        response.raise_for_status()
+        return [self.cls.model_validate(v) for v in response.json()]
+    
+    def memoize(self, script_id:int) -> schema.Script|None:
+        """complete the script with the results of an identical earlier run (see db_interface.memoize_script), None on a cache miss"""
+        url = f"{self._base_url}/action/{self.route}/{script_id}/memoize"
+        log.debug(f'POST: {url}')
+        response = request('POST', url)
+        response.raise_for_status()
+        res = response.json()
+        return None if res is None else self.cls.model_validate(res)
+
+    def get_progress(self, script_id:int) -> dict:
+        """the live progress of a running script (see JupyRunner.core.progress)"""
+        url = f"{self._base_url}/qry/{self.route}/{script_id}/progress"
+        log.debug(f'GET: {url}')
+        response = request('GET', url)
+        response.raise_for_status()
+        return response.json()
+
+    def get_cell_durations(self, script_name:str, n_last:int=10) -> list:
+        """the median duration per cell index of the last FINISHED runs of a script_name"""
+        url = f"{self._base_url}/qry/{self.route}/cell_durations"
+        log.debug(f'GET: {url} {script_name=}')
+        response = request('GET', url, params=dict(script_name=script_name, n_last=n_last))
+        response.raise_for_status()
+        return response.json()
+
+    def patch_many(self, changes:dict[int, dict]) -> list[schema.Script]:
+        """set the properties of many scripts (id -> kwargs) in one request and transaction"""
+        data = self._json([{**kwargs, 'id': script_id} for script_id, kwargs in changes.items()])
+        url = self.base_url
+        log.debug(f'PATCH: {url} N={len(data)}')
+        response = request('PATCH', url, json=data)
+        response.raise_for_status()
         return [self.cls.model_validate(v) for v in response.json()]
+
+    def renew_leases(self, script_ids:list[int], runner_id:str|None=None, runner_ip:str|None=None, lease_sec:float=120) -> dict:
+        data = dict(runner_id=runner_id, runner_ip=runner_ip, script_ids=list(script_ids), lease_sec=lease_sec)
+        url = f"{self._base_url}/action/{self.route}/renew_lease"
+        log.debug(f'POST: {url} {data=}')
+        response = request('POST', url, json=data)
+        response.raise_for_status()
+        return response.json()
     
 
+class PatchBatcher():
+    """coalesces script PATCHes into bulk requests (see ScriptClient.patch_many). Changes to the same script are 
+    merged (later ones win) and sent on flush, when max_n scripts are pending or max_delay seconds after the first 
+    pending change. Only use it for changes nobody needs to read back immediately. Changes of a failed flush are kept 
+    and retried max_delay seconds later, unless the server rejected them (4xx).
+
+    Args:
+        client (ScriptClient, optional): the client to send the changes with. Defaults to a new ScriptClient.
+        max_n (int, optional): max number of pending scripts. Defaults to 50.
+        max_delay (float, optional): max seconds a change is pending (<= 0 to only flush explicitly). Defaults to 0.5.
+    """
+
+    def __init__(self, client:ScriptClient|None=None, max_n:int=50, max_delay:float=0.5):
+        self.client = ScriptClient() if client is None else client
+        self.max_n = max_n
+        self.max_delay = max_delay
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def patch(self, script_id:int, **kwargs):
+        with self._lock:
+            self.pending.setdefault(int(script_id), {}).update(kwargs)
+            n = len(self.pending)
+            self._arm()
+        if n >= self.max_n:
+            self.flush()
+
+    def _arm(self):
+        # needs self._lock
+        if self._timer is None and self.max_delay > 0 and self.pending:
+            self._timer = threading.Timer(self.max_delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            pass # flush logged the error and re-armed the timer for the changes it kept
+
+    def flush(self) -> list[schema.Script]:
+        with self._lock:
+            changes, self.pending = self.pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not changes:
+            return []
+        try:
+            return self.client.patch_many(changes)
+        except requests.HTTPError as err:
+            if err.response is None or err.response.status_code >= 500:
+                self._keep(changes, err)
+            else:
+                log.error(f'ERROR while sending N={len(changes)} batched patches: {err}. Dropping them since the server rejected them')
+            raise
+        except Exception as err:
+            self._keep(changes, err)
+            raise
+
+    def _keep(self, changes:dict[int, dict], err:Exception):
+        log.error(f'ERROR while sending N={len(changes)} batched patches: {err}. Keeping them for the next flush')
+        with self._lock:
+            for script_id, kwargs in changes.items():
+                self.pending[script_id] = {**kwargs, **self.pending.get(script_id, {})}
+            self._arm()
+
+    def close(self):
+        self.flush()
+
+
+class AsyncScriptClient():
+    """asyncio client for the calls of the runner loop (see procserver.run_async) sharing one pooled httpx.AsyncClient
+
+    Args:
+        base_url (str, optional): the dbserver uri. Defaults to the one given in setup.
+        max_connections (int, optional): max number of concurrent connections to the server. Defaults to 20.
+        timeout (float, optional): default timeout in seconds for each request. Defaults to 30.
+    """
+
+    def __init__(self, base_url:str=None, max_connections:int=20, timeout:float|None=None):
+        self._base_url = (url if base_url is None else base_url).rstrip('/')
+        self.cls = schema.Script
+        self.route = schema.Script.__tablename__
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        # httpx only retries failed connects, not responses
+        transport = httpx.AsyncHTTPTransport(retries=http_config['retries'], limits=limits)
+        timeout = http_config['timeout'] if timeout is None else timeout
+        self.client = httpx.AsyncClient(base_url=self._base_url, transport=transport, timeout=timeout)
+
+    _json = APIClient._json
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def _request(self, method:str, endpoint:str, params:dict|None=None, data=None, none_on_404=False, **kwargs):
+        params = {k: v for k, v in (params or {}).items() if v is not None} # like requests, which skips None
+        log.debug(f'{method}: {endpoint} {params=} {data=}')
+        t_start = time.perf_counter()
+        is_error = True
+        try:
+            response = await self.client.request(method, endpoint, params=params, json=data, **kwargs)
+            is_error = response.status_code >= 500
+        finally:
+            record_latency(get_endpoint_key(method, endpoint), time.perf_counter() - t_start, is_error)
+        if response.status_code == 404 and none_on_404:
+            return None
+        response.raise_for_status()
+        return response.json()
+
+    async def get(self, script_id:int) -> schema.Script|None:
+        o = await self._request('GET', f'/{self.route}/{script_id}', none_on_404=True)
+        return None if o is None else self.cls.model_validate(o)
+
+    async def patch(self, script_id:int, **kwargs) -> schema.Script:
+        return self.cls.model_validate(await self._request('PATCH', f'/{self.route}/{script_id}', data=self._json(kwargs)))
+
+    async def qry(self, stati:list[schema.STATUS]|None=None, n_max:int=-1, skipn:int=0) -> list[schema.Script]:
+        params = dict(stati=[str(s) for s in stati] if stati else None, n_max=n_max, skipn=skipn)
+        return [self.cls.model_validate(v) for v in await self._request('GET', f'/qry/{self.route}', params=params)]
+
+    async def claim(self, runner_id:str|None=None, runner_ip:str|None=None, n_max:int=1, 
+                    max_cost:int|None=None, cost_cap:int|None=None, lease_sec:float=120, scheduler:dict|None=None) -> list[schema.Script]:
+        data = dict(runner_id=runner_id, runner_ip=runner_ip, n_max=n_max, max_cost=max_cost, cost_cap=cost_cap, lease_sec=lease_sec, scheduler=scheduler)
+        return [self.cls.model_validate(v) for v in await self._request('POST', f'/action/{self.route}/claim', data=data)]
+
+    async def renew_leases(self, script_ids:list[int], runner_id:str|None=None, runner_ip:str|None=None, lease_sec:float=120) -> dict:
+        data = dict(runner_id=runner_id, runner_ip=runner_ip, script_ids=list(script_ids), lease_sec=lease_sec)
+        return await self._request('POST', f'/action/{self.route}/renew_lease', data=data)
+
+    async def wait_for_events(self, since:int|None=None, timeout:float=30) -> dict:
+        """see wait_for_events"""
+        params = {'timeout': timeout, 'since': since}
+        return await self._request('GET', '/events/wait', params=params, timeout=timeout + 10)
+
+
 class DeviceClient(ModelClient):
     def __init__(self, base_url: str = None):
         super().__init__(schema.Device, base_url=base_url)
@@ -0,0 +1,259 @@
+"""
+cell level execution cache for papermill runs of scripts with data_json["cell_cache"].
+
+Each code cell is recorded with a hash which chains its source to the sources of all cells before it
+and to the script parameters (params_hash), together with its outputs. A rerun of the same script then
+
+- restores the kernel state from the latest checkpoint before the first changed or failed cell and takes
+  all cells up to the checkpoint from the cache. Checkpoints are pickled kernel sessions, so "dill" needs
+  to be installed in the kernel. They are written after a cell once checkpoint_min_sec have passed since
+  the last one.
+- does not execute cells tagged "pure" (no side effects on the kernel state) whose hash is unchanged, but
+  reuses their recorded outputs.
+
+The injected parameters cell is always executed again, so values like the script_id are up to date.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import nbformat
+from nbclient.exceptions import CellExecutionError
+from papermill.clientwrap import PapermillNotebookClient
+from papermill.engines import NBClientEngine, papermill_engines
+from papermill.log import logger
+from papermill.utils import merge_kwargs, remove_args
+
+from JupyRunner.core import helpers, progress
+
+log = helpers.log
+
+ENGINE_NAME = 'jupyrunner_cell_cache'
+
+default_dir = ''
+checkpoint_min_sec = 60
+max_age_days = 14
+pure_tag = 'pure'
+
+
+def setup(cnfg):
+    global default_dir, checkpoint_min_sec, max_age_days, pure_tag
+    cnfg_cc = cnfg.get('cell_cache', {}) or {}
+    default_dir = cnfg.get('pathes', {}).get('default_dir_cellcache', os.path.join(cnfg.get('pathes', {}).get('default_dir_meas', ''), '_cellcache'))
+    checkpoint_min_sec = cnfg_cc.get('checkpoint_min_sec', checkpoint_min_sec)
+    max_age_days = cnfg_cc.get('max_age_days', max_age_days)
+    pure_tag = cnfg_cc.get('pure_tag', pure_tag)
+
+
+def start(cnfg):
+    prune()
+
+
+def get_dir(script_id:int) -> str:
+    return os.path.join(default_dir, f'script_{script_id}')
+
+
+def prune(max_age_sec:float|None=None) -> list[str]:
+    """delete the caches of all scripts which have not been run for max_age_sec (defaults to max_age_days)"""
+    max_age_sec = max_age_days * 86400 if max_age_sec is None else max_age_sec
+    if max_age_sec <= 0 or not default_dir or not os.path.isdir(default_dir):
+        return []
+    t_min = time.time() - max_age_sec
+    removed = []
+    for name in os.listdir(default_dir):
+        pth = os.path.join(default_dir, name)
+        if name.startswith('script_') and os.path.isdir(pth) and os.path.getmtime(pth) < t_min:
+            shutil.rmtree(pth, ignore_errors=True)
+            removed.append(name)
+    if removed:
+        log.info(f'pruned the cell caches of N={len(removed)} scripts older than {max_age_sec=}')
+    return removed
+
+
+def get_engine_kwargs(script) -> dict:
+    """the kwargs for papermill.execute_notebook to run the script with the cell cache (empty if it did not opt in)"""
+    if not (script.data_json or {}).get('cell_cache'):
+        return {}
+    return dict(engine_name=ENGINE_NAME, cell_cache_dir=get_dir(script.id), cell_cache_seed=script.params_hash or script.set_params_hash())
+
+
+def get_cell_hashes(cells:list, seed:str='') -> list[str|None]:
+    """the chained hash per cell (None for non code cells). The injected parameters only enter through the seed"""
+    h = hashlib.sha256(seed.encode()).hexdigest()
+    ret = []
+    for cell in cells:
+        if cell.get('cell_type') != 'code':
+            ret.append(None)
+            continue
+        source = '' if 'injected-parameters' in cell.get('metadata', {}).get('tags', []) else cell.get('source', '')
+        h = hashlib.sha256((h + '\0' + source).encode()).hexdigest()
+        ret.append(h)
+    return ret
+
+
+class CellCache():
+    """the record of the last run of one script (cells.json) and its kernel checkpoints in one directory"""
+
+    def __init__(self, dirpath:str, seed:str='') -> None:
+        self.dirpath = dirpath
+        self.seed = seed
+        self.filepath = os.path.join(dirpath, 'cells.json')
+        self.cells = {}
+
+    def load(self) -> dict:
+        """the recorded cells of the last run (cell index -> entry), empty if there is none for the same seed"""
+        try:
+            with open(self.filepath, 'r', encoding='utf-8') as fp:
+                dc = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if dc.get('seed') != self.seed:
+            return {}
+        return {int(k): v for k, v in dc.get('cells', {}).items()}
+
+    def save(self):
+        os.makedirs(self.dirpath, exist_ok=True)
+        tmp = self.filepath + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump({'seed': self.seed, 't_last': helpers.now_iso(), 'cells': self.cells}, fp)
+        os.replace(tmp, self.filepath)
+
+    def add(self, index:int, cell_hash:str, cell, status:str, checkpoint:str|None=None):
+        self.cells[index] = dict(hash=cell_hash, status=status, execution_count=cell.get('execution_count'),
+                                 outputs=cell.get('outputs', []), checkpoint=checkpoint)
+        self.save()
+
+    def set_checkpoint(self, index:int, path:str):
+        """keep only the newest checkpoint on disk"""
+        for i, entry in self.cells.items():
+            old = entry.get('checkpoint')
+            if i != index and old:
+                entry['checkpoint'] = None
+                if old != path and os.path.exists(old):
+                    os.remove(old)
+        self.cells[index]['checkpoint'] = path
+        self.save()
+
+
+def get_n_unchanged(record:dict, hashes:list) -> int:
+    """the number of leading cells which were executed successfully with the same hash in the recorded run"""
+    for i, h in enumerate(hashes):
+        if h is not None and (record.get(i, {}).get('hash') != h or record[i].get('status') != 'ok'):
+            return i
+    return len(hashes)
+
+
+def get_checkpoint(record:dict, n_unchanged:int) -> tuple[int, str|None]:
+    """the index and path of the latest existing checkpoint within the unchanged cells or (-1, None)"""
+    for i in sorted(record, reverse=True):
+        path = record[i].get('checkpoint')
+        if i < n_unchanged and path and os.path.exists(path):
+            return i, path
+    return -1, None
+
+
+class CellCacheNotebookClient(PapermillNotebookClient):
+    """papermill client which records each cell and resumes from or skips recorded cells (see module doc)"""
+
+    def __init__(self, nb_man, cell_cache:CellCache, **kw):
+        super().__init__(nb_man, **kw)
+        self.cell_cache = cell_cache
+        self.can_checkpoint = True
+
+    def run_in_kernel(self, code:str) -> bool:
+        """silently run some code in the kernel and return whether it succeeded"""
+        reply = self.wait_for_reply(self.kc.execute(code, silent=True, store_history=False, allow_stdin=False))
+        return bool(reply) and reply['content']['status'] == 'ok'
+
+    def replay_cell(self, index:int, entry:dict):
+        cell = self.nb.cells[index]
+        self.nb_man.cell_start(cell, index)
+        cell.outputs = nbformat.from_dict(entry.get('outputs', []))
+        cell.execution_count = entry.get('execution_count')
+        cell.metadata['jupyrunner'] = {'cached': True}
+        self.nb_man.cell_complete(cell, cell_index=index)
+
+    def checkpoint(self, index:int):
+        path = os.path.join(self.cell_cache.dirpath, f'checkpoint_{index}.pkl')
+        if self.run_in_kernel(f"__import__('dill').dump_session({path!r})"):
+            self.cell_cache.set_checkpoint(index, path)
+        else:
+            self.can_checkpoint = False
+            log.warning(f'could not write a kernel checkpoint to {path=} (is "dill" installed in the kernel?). Continuing without checkpoints')
+
+    def papermill_execute_cells(self):
+        cells = self.nb.cells
+        hashes = get_cell_hashes(cells, self.cell_cache.seed)
+        record = self.cell_cache.load()
+        i_start = 0
+
+        n_unchanged = get_n_unchanged(record, hashes)
+        i_ckpt, path = get_checkpoint(record, n_unchanged)
+        if i_ckpt >= 0 and self.run_in_kernel(f"__import__('dill').load_session({path!r})"):
+            log.info(f'resuming after cell {i_ckpt} from the kernel checkpoint {path=} (N={n_unchanged} unchanged cells)')
+            for index in range(i_ckpt + 1):
+                if hashes[index] is not None:
+                    self.replay_cell(index, record[index])
+                    self.cell_cache.cells[index] = record[index]
+            for index in range(i_ckpt + 1):
+                if 'injected-parameters' in cells[index].get('metadata', {}).get('tags', []):
+                    cells[index].metadata.pop('jupyrunner', None)
+                    self.execute_cell(cells[index], index)
+            i_start = i_ckpt + 1
+        elif i_ckpt >= 0:
+            log.warning(f'could not load the kernel checkpoint {path=}, running all cells')
+
+        t_last = time.monotonic()
+        for index in range(i_start, len(cells)):
+            cell = cells[index]
+            entry = record.get(index, {})
+            if hashes[index] is not None and pure_tag in cell.get('metadata', {}).get('tags', []) and entry.get('hash') == hashes[index] and entry.get('status') == 'ok':
+                self.replay_cell(index, entry)
+                self.cell_cache.add(index, hashes[index], cell, 'ok')
+                continue
+
+            status = 'ok'
+            try:
+                self.nb_man.cell_start(cell, index)
+                self.execute_cell(cell, index)
+            except CellExecutionError as ex:
+                status = 'error'
+                self.nb_man.cell_exception(self.nb.cells[index], cell_index=index, exception=ex)
+                break
+            finally:
+                self.nb_man.cell_complete(self.nb.cells[index], cell_index=index)
+                if hashes[index] is not None:
+                    self.cell_cache.add(index, hashes[index], self.nb.cells[index], status)
+
+            if hashes[index] is not None and self.can_checkpoint and checkpoint_min_sec >= 0 and time.monotonic() - t_last >= checkpoint_min_sec:
+                self.checkpoint(index)
+                t_last = time.monotonic()
+
+
+class CellCacheEngine(NBClientEngine):
+    """papermill engine using the CellCacheNotebookClient (select with engine_name=ENGINE_NAME)"""
+
+    @classmethod
+    def execute_managed_notebook(cls, nb_man, kernel_name, log_output=False, stdout_file=None, stderr_file=None,
+                                 start_timeout=60, execution_timeout=None, cell_cache_dir='', cell_cache_seed='', progress_reporter=None, **kwargs):
+        # same as NBClientEngine.execute_managed_notebook but with the CellCacheNotebookClient
+        kwargs = remove_args(['input_path'], **kwargs)
+        safe_kwargs = remove_args(['timeout', 'startup_timeout'], **kwargs)
+        final_kwargs = merge_kwargs(
+            safe_kwargs,
+            timeout=execution_timeout if execution_timeout else kwargs.get('timeout'),
+            startup_timeout=start_timeout,
+            kernel_name=kernel_name,
+            log=logger,
+            log_output=log_output,
+            stdout_file=stdout_file,
+            stderr_file=stderr_file,
+        )
+        cache = CellCache(cell_cache_dir, seed=cell_cache_seed)
+        with progress.attach(nb_man, progress_reporter):
+            return CellCacheNotebookClient(nb_man, cell_cache=cache, **final_kwargs).execute()
+
+papermill_engines.register(ENGINE_NAME, CellCacheEngine)
@@ -1,17 +1,59 @@
 
 
+import base64
+import copy
 import datetime, json
+import enum
 import os
+import random
+import sqlite3
+import threading
+import time
 import traceback
+import sqlalchemy
 from sqlmodel import Session, create_engine, SQLModel, select
 # from sqlalchemy.orm import select_related
-from JupyRunner.core import schema, helpers
+from JupyRunner.core import schema, helpers, progress
 
 
 log = helpers.log
 
 engine = None
 sqlite_file_name = None
+device_max_concurrent = 1
+max_retries = 0
+memoize_ttl_sec = 86400
+
+sqlite_profile = dict(
+    journal_mode='WAL',
+    synchronous='NORMAL',
+    cache_size_kib=65536,
+    mmap_size_mb=256,
+    busy_timeout_ms=10000,
+    pool_size=10,
+    max_overflow=20,
+    pool_timeout_sec=30,
+    echo=False,
+    slow_query_ms=200,
+    log_sample_rate=0.,
+)
+query_stats = dict(n_queries=0, n_slow=0, max_ms=0., t_max=None, last_slow=[])
+_query_stats_lock = threading.Lock()
+
+status_listeners = []
+
+ACTIVE_STATI = [
+    schema.STATUS.STARTING, 
+    schema.STATUS.RUNNING, 
+    schema.STATUS.CANCELLING, 
+    schema.STATUS.FINISHING, 
+    schema.STATUS.UPLOADING
+]
+
+SCHEDULER_POLICIES = ['fifo', 'priority', 'fair_share']
+SHARE_KEYS = ['device_id', 'submitter']
+
+_claim_lock = threading.Lock()
 
 
 
@@ -52,19 +94,109 @@ def _json_deserializer(dc):
         return dc
     
 def setup(config):
-    global engine, sqlite_url, sqlite_file_name
+    global engine, sqlite_url, sqlite_file_name, device_max_concurrent, max_retries, memoize_ttl_sec
     sqlite_file_name = config.get('db', {})['filepath']
+    device_max_concurrent = config.get('db', {}).get('device_max_concurrent', device_max_concurrent)
+    max_retries = config.get('db', {}).get('max_retries', max_retries)
+    memoize_ttl_sec = config.get('db', {}).get('memoize_ttl_sec', memoize_ttl_sec)
+    sqlite_profile.update(config.get('db', {}).get('sqlite', {}) or {})
     helpers.log.info(f"Starting with DB location: {sqlite_file_name=} (can_write={os.access(sqlite_file_name, os.W_OK)})")
 
      
     
     sqlite_url = f"sqlite:///{sqlite_file_name}"
-    connect_args = {"check_same_thread": False}
-    engine = create_engine(sqlite_url, echo=True, connect_args=connect_args, json_serializer=json_serializer, json_deserializer=json_deserializer)
+    engine = make_engine(sqlite_url, sqlite_profile)
+
+def make_engine(url:str, profile:dict):
+    """the engine for the sqlite DB at url with the pragmas, pool sizes and statement logging of the profile (see sqlite_profile)"""
+    connect_args = {"check_same_thread": False, "timeout": profile['busy_timeout_ms'] / 1000}
+    kwargs = {}
+    if not ':memory:' in url:
+        kwargs = dict(pool_size=profile['pool_size'], max_overflow=profile['max_overflow'], pool_timeout=profile['pool_timeout_sec'])
+    eng = create_engine(url, echo=bool(profile['echo']), connect_args=connect_args, json_serializer=json_serializer, json_deserializer=json_deserializer, **kwargs)
+
+    @sqlalchemy.event.listens_for(eng, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            if profile.get('journal_mode'):
+                cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+            if profile.get('synchronous'):
+                cursor.execute(f"PRAGMA synchronous={profile['synchronous']}")
+            cursor.execute(f"PRAGMA cache_size={-int(profile['cache_size_kib'])}")
+            cursor.execute(f"PRAGMA mmap_size={int(profile['mmap_size_mb'] * 1024**2)}")
+            cursor.execute(f"PRAGMA busy_timeout={int(profile['busy_timeout_ms'])}")
+        finally:
+            cursor.close()
+
+    @sqlalchemy.event.listens_for(eng, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # a single slot, since statements on one connection never nest (a failed one is simply overwritten by the next)
+        conn.info['t_query'] = time.perf_counter()
+
+    @sqlalchemy.event.listens_for(eng, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        t_start = conn.info.pop('t_query', None)
+        if t_start is None:
+            return
+        dt_ms = (time.perf_counter() - t_start) * 1000
+        is_slow = bool(profile['slow_query_ms']) and dt_ms >= profile['slow_query_ms']
+        with _query_stats_lock:
+            query_stats['n_queries'] += 1
+            if dt_ms > query_stats['max_ms']:
+                query_stats['max_ms'], query_stats['t_max'] = round(dt_ms, 1), helpers.now_iso()
+            if is_slow:
+                query_stats['n_slow'] += 1
+                query_stats['last_slow'] = (query_stats['last_slow'] + [dict(t=helpers.now_iso(), ms=round(dt_ms, 1), statement=statement[:500])])[-10:]
+        if is_slow:
+            log.warning(f'slow query ({dt_ms:.0f} ms): {statement[:500]} {str(parameters)[:200]}')
+        elif profile['log_sample_rate'] and random.random() < profile['log_sample_rate']:
+            log.info(f'sampled query ({dt_ms:.1f} ms): {statement[:500]} {str(parameters)[:200]}')
+
+    return eng
+
+
+def get_db_info() -> dict:
+    """the effective sqlite settings of a pooled connection next to the configured profile, the pool status and the query statistics"""
+    effective = {}
+    with engine.connect() as conn:
+        for pragma in ['journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'busy_timeout', 'page_size']:
+            effective[pragma] = conn.exec_driver_sql(f'PRAGMA {pragma}').scalar()
+    return {
+        'filepath': sqlite_file_name,
+        'sqlite_version': sqlite3.sqlite_version,
+        'profile': dict(sqlite_profile),
+        'effective': effective,
+        'pool': engine.pool.status(),
+        'queries': get_query_stats(),
+        'migrations': get_migrations(),
+    }
+
+
+def get_query_stats() -> dict:
+    """a copy of the statement counters (see make_engine)"""
+    with _query_stats_lock:
+        return {k: (list(v) if isinstance(v, list) else v) for k, v in query_stats.items()}
+
+
+def check_db_profile() -> dict:
+    """log the effective sqlite settings and warn about the ones which differ from the profile (e.G. WAL is not possible on network file systems)"""
+    info = get_db_info()
+    eff = info['effective']
+    if sqlite_profile.get('journal_mode') and str(eff['journal_mode']).lower() != sqlite_profile['journal_mode'].lower():
+        log.warning(f"the DB runs with journal_mode={eff['journal_mode']} instead of the configured {sqlite_profile['journal_mode']}")
+    if eff['busy_timeout'] != int(sqlite_profile['busy_timeout_ms']):
+        log.warning(f"the DB runs with busy_timeout={eff['busy_timeout']} instead of the configured {sqlite_profile['busy_timeout_ms']}")
+    log.info(f"DB profile: {eff} pool={info['pool']}")
+    return info
+
 
 def start(config):
     helpers.log.info(f"creating all tables for {sqlite_file_name=}")
     SQLModel.metadata.create_all(engine)
+    add_missing_columns()
+    apply_migrations()
+    check_db_profile()
     commit(schema.ProjectVariable(id='dbi_info', data_json={'t_last': helpers.get_utcnow(), 'info': helpers.get_sys_info()}))
     
 
@@ -72,17 +204,118 @@ def get_engine():
     global engine
     return engine
 
+def _sql_literal(v):
+    if isinstance(v, enum.Enum):
+        v = v.name
+    if isinstance(v, bool):
+        return str(int(v))
+    if isinstance(v, (int, float)):
+        return str(v)
+    return "'" + str(v).replace("'", "''") + "'"
+
+def add_missing_columns():
+    """add all columns which are defined in the schema but missing in existing tables (create_all only creates missing tables)"""
+    insp = sqlalchemy.inspect(engine)
+    added = []
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c['name'] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {col.name} {col.type.compile(dialect=engine.dialect)}'
+                if col.default is not None and col.default.is_scalar and col.default.arg is not None:
+                    ddl += f' DEFAULT {_sql_literal(col.default.arg)}'
+                log.info(f'adding missing column: "{ddl}"')
+                conn.execute(sqlalchemy.text(ddl))
+                added.append(f'{table.name}.{col.name}')
+    return added
+
+def create_missing_indexes(conn) -> list[str]:
+    """create all indexes which are declared in the schema but missing in existing tables (create_all only creates them with new tables)"""
+    insp = sqlalchemy.inspect(conn)
+    added = []
+    for table in SQLModel.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        existing = {ix['name'] for ix in insp.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            log.info(f'creating missing index "{index.name}" on {table.name} {[c.name for c in index.columns]}')
+            index.create(conn)
+            added.append(index.name)
+    return added
+
+def _migrate_hot_query_indexes(conn):
+    create_missing_indexes(conn)
+    conn.execute(sqlalchemy.text('ANALYZE'))
+
+
+# versioned migrations (version, name, fun(conn)), applied in order by apply_migrations at start. Append new ones at
+# the end with the next version and never change applied ones. New columns need none (see add_missing_columns)
+MIGRATIONS = [
+    (1, 'indexes on the hot query columns of script and datafile', _migrate_hot_query_indexes),
+]
+
+def apply_migrations() -> list[int]:
+    """apply all migrations which were not applied to the DB yet, each in its own transaction, and return their versions"""
+    s = schema.SchemaMigration
+    with Session(engine) as session:
+        applied = set(session.exec(select(s.version)).all())
+    done = []
+    for version, name, fun in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version in applied:
+            continue
+        log.info(f'applying DB migration {version=} "{name}"')
+        t0 = time.monotonic()
+        with engine.begin() as conn:
+            fun(conn)
+            conn.execute(sqlalchemy.insert(s.__table__).values(version=version, name=name, time_applied=helpers.get_utcnow(), dt_sec=round(time.monotonic() - t0, 3)))
+        done.append(version)
+    return done
+
+def get_migrations() -> list[dict]:
+    with Session(engine) as session:
+        return [m.model_dump() for m in session.exec(select(schema.SchemaMigration).order_by(schema.SchemaMigration.version)).all()]
+
+def add_status_listener(fun):
+    """register a function fun(obj, status_old) which will be called after an object with a status was committed"""
+    if not fun in status_listeners:
+        status_listeners.append(fun)
+
+def _notify_status(obj, status_old=None):
+    if not hasattr(obj, 'status'):
+        return
+    for fun in status_listeners:
+        try:
+            fun(obj, status_old)
+        except Exception as err:
+            log.error(f'ERROR in status listener {fun=} for {obj.id=}')
+            log.exception(err)
+
+def _get_status_old(obj):
+    if not hasattr(obj, 'status'):
+        return None
+    hist = sqlalchemy.inspect(obj).attrs.status.history
+    return hist.deleted[0] if hist.deleted else (obj.status if not hist.added else None)
+
 def add_to_db(session, obj):
     obj.last_time_changed = helpers.get_utcnow()
     is_existing = session.get(type(obj), obj.id)
 
     if not is_existing:
         session.add(obj)
+    status_old = _get_status_old(obj)
     session.commit()
+    _notify_status(obj, status_old)
 
     return obj
 
-def set_propert_sub(session, obj_type:type, obj_id, **kwargs):
+def _set_props(session, obj_type:type, obj_id, kwargs:dict):
+    """set the properties of one object within the session (without commit) and return it with its old status"""
     obj = session.get(obj_type, obj_id)
     if not obj:
         raise KeyError(f'the object id {obj_id=} for {obj_type=} was not found on the server')
@@ -90,11 +323,27 @@ def set_propert_sub(session, obj_type:type, obj_id, **kwargs):
         if not hasattr(obj, key):
             raise KeyError(f'the object id {obj_id=} for {obj_type=} does not have the property {key=}, which supposed to be set')
         kwargs[key] = _update_factory(key, getattr(obj, key), v)
+    status_old = getattr(obj, 'status', None)
     obj.sqlmodel_update(kwargs)
     obj.last_time_changed = helpers.get_utcnow()  # Update timestamp
+    return obj, status_old
+
+def set_propert_sub(session, obj_type:type, obj_id, **kwargs):
+    obj, status_old = _set_props(session, obj_type, obj_id, kwargs)
     session.commit()
     session.refresh(obj)
+    _notify_status(obj, status_old)
     return obj
+
+def set_properties_many(obj_type:type, changes:dict) -> list:
+    """set the properties of many objects (id -> kwargs) in one transaction"""
+    with Session(engine) as session:
+        objs = [_set_props(session, obj_type, obj_id, dict(kwargs)) for obj_id, kwargs in changes.items()]
+        session.commit()
+        for obj, status_old in objs:
+            session.refresh(obj)
+            _notify_status(obj, status_old)
+        return [obj for obj, _ in objs]
     
 
 def set_property(obj_type:type, obj_id, **kwargs):
@@ -116,12 +365,14 @@ def commit(obj):
                     raise KeyError(f'the object {obj} does not have the property {key=}, which supposed to be set')
                 kwargs[key] = _update_factory(key, getattr(existing_model, key), v)
 
+            status_old = getattr(existing_model, 'status', None)
             existing_model.sqlmodel_update(kwargs)
             existing_model.last_time_changed = helpers.get_utcnow()  # Update timestamp
 
             session.add(existing_model)
             session.commit()
             session.refresh(existing_model)
+            _notify_status(existing_model, status_old)
             return existing_model
 
         else:
@@ -140,6 +391,7 @@ def commit(obj):
             
             session.refresh(obj)
             log.debug(f'COMMIT NEW with {obj=}')
+            _notify_status(obj)
             return obj # session.get(type(obj), obj.id)
         
 
@@ -154,8 +406,64 @@ def add_many(objs):
         session.commit()
         for obj in objs:
             session.refresh(obj)
+            _notify_status(obj)
         return objs
     
+def insert_many(objs:list) -> list[int]:
+    """insert many new objects in one transaction (without refreshing each of them afterwards) and return their ids"""
+    now = helpers.get_utcnow()
+    with Session(engine, expire_on_commit=False) as session:
+        for obj in objs:
+            obj.last_time_changed = now
+        session.add_all(objs)
+        session.commit()
+        for obj in objs:
+            _notify_status(obj)
+        return [obj.id for obj in objs]
+
+
+def get_batch_info(batch_id:str) -> dict:
+    """the number of scripts per status and the progress of all scripts with the given batch_id"""
+    s = schema.Script
+    with Session(engine) as session:
+        q = select(s.status, sqlalchemy.func.count(), sqlalchemy.func.min(s.time_started), sqlalchemy.func.max(s.time_finished))
+        rows = session.exec(q.where(s.batch_id == batch_id).group_by(s.status)).all()
+        ids = session.exec(select(s.id).where(s.batch_id == batch_id).order_by(s.id.asc())).all()
+
+    counts = {str(status): n for status, n, _, _ in rows}
+    n_total = sum(counts.values())
+    n_done = sum(n for k, n in counts.items() if schema.STATUS_DICT[k] > schema.STATUS_DICT['AWAITING_POST_PROC'])
+    n_finished = counts.get(str(schema.STATUS.FINISHED), 0)
+    n_running = sum(n for k, n in counts.items() if 10 <= schema.STATUS_DICT[k] <= 100)
+    
+    return dict(batch_id=batch_id, n_total=n_total, n_done=n_done, n_finished=n_finished, n_failed=n_done - n_finished, 
+                n_running=n_running, n_queued=n_total - n_done - n_running,
+                progress=n_done / n_total if n_total else 0, 
+                is_done=n_total > 0 and n_done == n_total, counts=counts, script_ids=ids)
+
+
+def cancel_batch(batch_id:str) -> dict:
+    """abort all queued scripts and cancel all running scripts of a batch"""
+    s = schema.Script
+    now = helpers.get_utcnow()
+    stati_queued = [k for k, v in schema.STATUS_DICT.items() if v < 10 and k in schema.status_dc]
+    ret = {}
+    with _claim_lock, Session(engine) as session:
+        for stati, status_new in [(stati_queued, schema.STATUS.ABORTED), (ACTIVE_STATI, schema.STATUS.CANCELLING)]:
+            cond = [s.batch_id == batch_id, s.status.in_(stati), s.status != status_new]
+            rows = session.exec(select(s.id, s.status).where(*cond)).all()
+            if rows:
+                session.execute(sqlalchemy.update(s).where(s.id.in_([i for i, _ in rows]), *cond).values(status=status_new, last_time_changed=now))
+                ret[str(status_new)] = rows
+        session.commit()
+
+        for status_new, rows in ret.items():
+            stati_old = dict(rows)
+            for script in session.exec(select(s).where(s.id.in_(list(stati_old)))).all():
+                _notify_status(script, stati_old[script.id])
+    return {k: [i for i, _ in v] for k, v in ret.items()}
+
+
 def se():
     return Session(engine)
 
@@ -188,38 +496,60 @@ def qry_scripts(t_min:datetime.datetime|None=None,
                 script_version:str='',
                 out_path:str='',
                 n_max:int=-1, skipn:int=0, 
-                ret_query = False
+                ret_query = False,
+                order:str='asc'
                 ):
     with Session(engine) as session:
-        return qry_scripts_sub(session, t_min, t_max, stati, script_name, script_in_path, script_version, out_path, n_max, skipn, ret_query)
+        return qry_scripts_sub(session, t_min, t_max, stati, script_name, script_in_path, script_version, out_path, n_max, skipn, ret_query, order=order)
     
-def qry_scripts_sub(session, t_min:datetime.datetime|None=None, 
+def get_scripts_filter(t_min:datetime.datetime|None=None, 
                 t_max:datetime.datetime|None=None, 
                 stati:schema.STATUS|None=None,
                 script_name:str='',
                 script_in_path:str='',
                 script_version:str='',
-                out_path:str='',
-                n_max:int=-1, skipn:int=0, 
-                ret_query = False):
-
+                out_path:str='') -> list:
+    """the where clauses for qry_scripts and qry_scripts_page"""
     s = schema.Script
-    q = select(s).order_by(s.start_condition.asc())
+    cond = []
     if t_min:
-        q = q.where(s.start_condition >= t_min)
+        cond.append(s.start_condition >= t_min)
     if t_max:
-        q = q.where(s.start_condition <= t_max)
+        cond.append(s.start_condition <= t_max)
     if stati:
-        q = q.where(s.status.in_(stati))
-        # log.debug(f'{stati=}')
+        cond.append(s.status.in_(stati))
     if script_in_path:
-        q = q.where(s.script_in_path.like(f"%{script_in_path}%"))
+        cond.append(s.script_in_path.like(f"%{script_in_path}%"))
     if script_name:
-        q = q.where(s.script_name.like(f"%{script_name}%"))
+        cond.append(s.script_name.like(f"%{script_name}%"))
     if script_version:
-        q = q.where(s.script_version.like(f"%{script_version}%"))
+        cond.append(s.script_version.like(f"%{script_version}%"))
     if out_path:
-        q = q.where(s.out_path.like(f"%{out_path}%"))
+        cond.append(s.script_out_path.like(f"%{out_path}%"))
+    return cond
+
+def get_scripts_order(order:str='asc') -> list:
+    """the order of the script queries: by start_condition and then id (as tie breaker for a stable order)"""
+    assert order in ['asc', 'desc'], f'order must be "asc" or "desc" but got {order=}'
+    s = schema.Script
+    if order == 'asc':
+        return [s.start_condition.asc(), s.id.asc()]
+    return [s.start_condition.desc(), s.id.desc()]
+
+def qry_scripts_sub(session, t_min:datetime.datetime|None=None, 
+                t_max:datetime.datetime|None=None, 
+                stati:schema.STATUS|None=None,
+                script_name:str='',
+                script_in_path:str='',
+                script_version:str='',
+                out_path:str='',
+                n_max:int=-1, skipn:int=0, 
+                ret_query = False,
+                order:str='asc'):
+
+    s = schema.Script
+    q = select(s).where(*get_scripts_filter(t_min, t_max, stati, script_name, script_in_path, script_version, out_path))
+    q = q.order_by(*get_scripts_order(order))
     if skipn:
         q = q.offset(skipn)
     if n_max > 0:
@@ -234,6 +564,449 @@ def qry_scripts_sub(session, t_min:datetime.datetime|None=None,
         return session.exec(q).all()
 
 
+def encode_cursor(script:schema.Script, direction:str) -> str:
+    """an opaque cursor for the page after (direction "next") or before ("prev") the script in the (start_condition, id) order"""
+    dc = [helpers.make_zulustr(script.start_condition, remove_ms=False), script.id, direction]
+    return base64.urlsafe_b64encode(json.dumps(dc).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor:str) -> tuple[datetime.datetime, int, str]:
+    """the start_condition, id and direction of a cursor from encode_cursor (raises ValueError for invalid cursors)"""
+    try:
+        start_condition, script_id, direction = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        start_condition = helpers.parse_zulutime(start_condition)
+        assert start_condition is not None and isinstance(script_id, int) and direction in ['next', 'prev']
+    except Exception as err:
+        raise ValueError(f'invalid cursor {cursor=}') from err
+    return start_condition, script_id, direction
+
+def qry_scripts_page(session, n_max:int=50, cursor:str|None=None, order:str='asc', ret_query=False, **kwargs) -> dict:
+    """one page of scripts with keyset pagination on (start_condition, id), so each page costs the same no matter how 
+    deep it is and the pages stay stable under concurrent inserts.
+
+    Args:
+        session: the DB session
+        n_max (int, optional): the page size (<= 0 for all). Defaults to 50.
+        cursor (str|None, optional): the next_cursor or prev_cursor of the previous page, None for the first page. 
+        order (str, optional): "asc" or "desc" by start_condition. Must be the same for all pages. Defaults to 'asc'.
+        kwargs: the filters (see get_scripts_filter)
+
+    Returns:
+        dict: data (the scripts), next_cursor and prev_cursor (None if there is no such page) and with ret_query the query
+    """
+    s = schema.Script
+    key = decode_cursor(cursor) if cursor else None
+    backwards = key is not None and key[2] == 'prev'
+    order_q = ('desc' if order == 'asc' else 'asc') if backwards else order
+
+    q = select(s).where(*get_scripts_filter(**kwargs))
+    if key is not None:
+        row, row_key = sqlalchemy.tuple_(s.start_condition, s.id), sqlalchemy.tuple_(key[0], key[1])
+        q = q.where(row > row_key if order_q == 'asc' else row < row_key)
+    q = q.order_by(*get_scripts_order(order_q))
+    if n_max > 0:
+        q = q.limit(n_max + 1)
+
+    scripts = list(session.exec(q).all())
+    has_more = n_max > 0 and len(scripts) > n_max
+    scripts = scripts[:n_max] if n_max > 0 else scripts
+    if backwards:
+        scripts.reverse()
+
+    has_next = has_more if not backwards else True
+    has_prev = key is not None if not backwards else has_more
+    ret = dict(
+        data=scripts,
+        next_cursor=encode_cursor(scripts[-1], 'next') if scripts and has_next else None,
+        prev_cursor=encode_cursor(scripts[0], 'prev') if scripts and has_prev else None,
+    )
+    if ret_query:
+        ret['query'] = q
+    return ret
+
+
+def get_claimed_by(runner_id:str|None, runner_ip:str|None=None):
+    return runner_id if runner_id else f'default@{runner_ip}'
+
+
+def requeue_expired_claims(session, now:datetime.datetime|None=None) -> list[int]:
+    """put all scripts which were claimed (STARTING) but whose lease has expired back into the queue and return their ids"""
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    cond = [s.status == schema.STATUS.STARTING, s.lease_expires != None, s.lease_expires < now]
+    ids = session.exec(select(s.id).where(*cond)).all()
+    if ids:
+        q = sqlalchemy.update(s).where(s.id.in_(ids), *cond)
+        session.execute(q.values(status=schema.STATUS.WAITING_TO_RUN, claimed_by=None, lease_expires=None, last_time_changed=now))
+        log.warning(f'requeued N={len(ids)} STARTING scripts with expired lease')
+    return list(ids)
+
+
+def reap_expired_leases(now:datetime.datetime|None=None) -> dict:
+    """recover all active scripts whose runner stopped sending heartbeats (lease renewals) in time.
+
+    STARTING scripts are requeued, CANCELLING scripts are set CANCELLED, and all others are requeued 
+    as long as they have retries left (see Script.get_max_retries) or set FAILED otherwise.
+
+    Returns:
+        dict: the script ids per new status
+    """
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    ret = {}
+
+    with _claim_lock, Session(engine) as session:
+        reaped = [(i, schema.STATUS.STARTING) for i in requeue_expired_claims(session, now)]
+        if reaped:
+            ret[str(schema.STATUS.WAITING_TO_RUN)] = [i for i, _ in reaped]
+        q = select(s).where(s.status.in_(ACTIVE_STATI), s.status != schema.STATUS.STARTING, s.lease_expires != None, s.lease_expires < now)
+        for script in session.exec(q).all():
+            status_old, retries = script.status, script.retries
+            msg = f'{helpers.now_iso()} runner "{script.claimed_by}" stopped sending heartbeats (last={script.last_heartbeat}) while the script was {status_old}.'
+            if status_old == schema.STATUS.CANCELLING:
+                status_new = schema.STATUS.CANCELLED
+            elif retries < script.get_max_retries(max_retries):
+                status_new = schema.STATUS.WAITING_TO_RUN
+                retries += 1
+                msg += f' Requeued (retry {retries}/{script.get_max_retries(max_retries)})'
+            else:
+                status_new = schema.STATUS.FAILED
+
+            # the guards make sure a heartbeat which came in after the select wins
+            qu = sqlalchemy.update(s).where(s.id == script.id, s.status == status_old, s.lease_expires == script.lease_expires)
+            qu = qu.values(status=status_new, retries=retries, claimed_by=None, lease_expires=None, 
+                           errors=(script.errors or '') + '\n' + msg, last_time_changed=now)
+            if session.execute(qu).rowcount:
+                log.warning(f'reaped script={script.id}: {msg} --> {status_new}')
+                reaped.append((script.id, status_old))
+                ret.setdefault(str(status_new), []).append(script.id)
+        session.commit()
+
+        for script_id, status_old in reaped:
+            _notify_status(session.get(s, script_id, populate_existing=True), status_old)
+    return ret
+
+
+def expire_queued_scripts(now:datetime.datetime|None=None) -> list[int]:
+    """set all scripts which are still queued (INITIALIZING ... HOLD) but past their end_condition to EXPIRED"""
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    stati = [k for k, v in schema.status_dc.items() if v < 10]
+    cond = [s.status.in_(stati), s.end_condition <= now]
+
+    with _claim_lock, Session(engine) as session:
+        scripts = session.exec(select(s).where(*cond)).all()
+        if not scripts:
+            return []
+        stati_old = {x.id: x.status for x in scripts}
+        msg = f'{helpers.now_iso()} expired before it was started (end_condition passed).'
+        qu = sqlalchemy.update(s).where(s.id.in_(list(stati_old)), *cond)
+        session.execute(qu.values(status=schema.STATUS.EXPIRED, errors=sqlalchemy.func.coalesce(s.errors, '') + '\n' + msg, last_time_changed=now))
+        session.commit()
+        log.info(f'expired N={len(stati_old)} queued scripts: {list(stati_old)}')
+
+        for script_id, status_old in stati_old.items():
+            _notify_status(session.get(s, script_id, populate_existing=True), status_old)
+    return list(stati_old)
+
+
+def materialize_schedules(now:datetime.datetime|None=None, n_max:int=1000) -> list[int]:
+    """create the scripts for all enabled schedules which are due (next_fire <= now) in one transaction 
+    and move their next_fire on. Missed fire times (e.G. while the server was down) are only fired once.
+
+    Returns:
+        list[int]: the ids of the created scripts
+    """
+    sc = schema.Schedule
+    now = helpers.get_utcnow() if now is None else now
+    q = select(sc).where(sc.next_fire <= now, sc.enabled == True).order_by(sc.next_fire.asc()).limit(n_max)
+
+    with Session(engine) as session:
+        schedules = session.exec(q).all()
+        if not schedules:
+            return []
+
+        def disable(schedule, err, action):
+            log.error(f'ERROR while {action} for {schedule.id=} ({schedule.name}): {err}. Disabling it.')
+            schedule.enabled = False
+            schedule.comments = (schedule.comments or '') + f'\n{helpers.now_iso()} disabled because of: {err}'
+
+        scripts = []
+        for schedule in schedules:
+            t_fire = schedule.next_fire
+            try:
+                script = schedule.make_script(t_fire)
+                script.last_time_changed = now
+                session.add(script)
+                scripts.append((schedule, script))
+                schedule.last_fire = t_fire
+                schedule.n_fired += 1
+            except Exception as err:
+                disable(schedule, err, 'creating a script')
+            try:
+                schedule.next_fire = schedule.get_next_fire(max(now, t_fire))
+            except Exception as err: # e.G. a cron which never fires, one bad schedule must not block all others
+                disable(schedule, err, 'computing the next fire time')
+            schedule.last_time_changed = now
+            session.add(schedule)
+
+        session.flush()
+        for schedule, script in scripts:
+            schedule.last_script_id = script.id
+        session.commit()
+
+        for schedule, script in scripts:
+            _notify_status(script)
+        ids = [script.id for _, script in scripts]
+    log.info(f'materialized N={len(ids)} scripts from N={len(schedules)} due schedules')
+    return ids
+
+
+def get_queue_query(now:datetime.datetime|None=None, policy:str='fair_share', share_key:str='submitter', weights:dict|None=None):
+    """build the query for all WAITING_TO_RUN scripts which are due, in the order they should be started in.
+
+    Args:
+        now (datetime.datetime | None, optional): scripts with a start_condition after this are not due yet. Defaults to None (utcnow).
+        policy (str, optional): 'fifo' (start_condition only), 'priority' (strict priority, then fifo) or 'fair_share' 
+            (strict priority, then round robin between the share groups weighted by "weights", then fifo). Defaults to 'fair_share'.
+        share_key (str, optional): the column to build the fair share groups by ('device_id' or 'submitter'). Defaults to 'submitter'.
+        weights (dict | None, optional): relative share per group e.G. {'alice': 2, '__default__': 1}. Groups not given get 
+            the '__default__' weight (1). Defaults to None.
+
+    Returns:
+        the select statement
+    """
+    assert policy in SCHEDULER_POLICIES, f'scheduler policy must be one of {SCHEDULER_POLICIES} but was {policy=}'
+    assert share_key in SHARE_KEYS, f'scheduler share_key must be one of {SHARE_KEYS} but was {share_key=}'
+
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    is_due = [s.status == schema.STATUS.WAITING_TO_RUN, s.start_condition <= now, s.end_condition > now]
+
+    if policy == 'fifo':
+        return select(s).where(*is_due).order_by(s.start_condition.asc(), s.id.asc())
+    if policy == 'priority':
+        return select(s).where(*is_due).order_by(s.priority.desc(), s.start_condition.asc(), s.id.asc())
+
+    # fair share: the n-th waiting script of a group is ranked behind the already running jobs of its group and 
+    # all groups take turns (weighted) within one priority level
+    weights = dict(weights) if weights else {}
+    default_weight = max(float(weights.pop('__default__', 1)), 1e-3)
+    group = sqlalchemy.func.coalesce(getattr(s, share_key), '')
+
+    n_in_group = sqlalchemy.func.row_number().over(partition_by=(s.priority, group), order_by=(s.start_condition.asc(), s.id.asc()))
+    ranked = select(s.id.label('id'), group.label('grp'), n_in_group.label('n')).where(*is_due).subquery('ranked')
+    active = select(group.label('grp'), sqlalchemy.func.count().label('n')).where(s.status.in_(ACTIVE_STATI)).group_by(group).subquery('active')
+
+    weight = sqlalchemy.case({k: max(float(w), 1e-3) for k, w in weights.items()}, value=ranked.c.grp, else_=default_weight) if weights else default_weight
+    score = (ranked.c.n + sqlalchemy.func.coalesce(active.c.n, 0)) * 1.0 / weight
+
+    q = select(s).join(ranked, ranked.c.id == s.id).outerjoin(active, active.c.grp == ranked.c.grp)
+    return q.order_by(s.priority.desc(), score.asc(), s.start_condition.asc(), s.id.asc())
+
+
+def get_device_holders(session, device_id:str|None=None) -> dict[str, list[schema.Script]]:
+    """all active (STARTING ... UPLOADING) scripts per device_id, i.E. the current holders of the device locks"""
+    s = schema.Script
+    q = select(s).where(s.status.in_(ACTIVE_STATI), s.device_id != None)
+    if device_id is not None:
+        q = q.where(s.device_id == device_id)
+    holders = {}
+    for script in session.exec(q.order_by(s.id.asc())).all():
+        holders.setdefault(script.device_id, []).append(script)
+    return holders
+
+
+def get_max_concurrent(session, device_id:str) -> int:
+    device = session.get(schema.Device, device_id)
+    return device.get_max_concurrent(device_max_concurrent) if device else device_max_concurrent
+
+
+def get_device_locks(device_id:str|None=None) -> list[dict]:
+    """the lock state of all devices (or only one) with their limit and the scripts holding them"""
+    with Session(engine) as session:
+        holders = get_device_holders(session, device_id)
+        if device_id is not None:
+            device_ids = [device_id]
+        else:
+            device_ids = sorted(set(session.exec(select(schema.Device.id)).all()) | set(holders))
+        
+        ret = []
+        for dev in device_ids:
+            max_concurrent = get_max_concurrent(session, dev)
+            scripts = holders.get(dev, [])
+            ret.append(dict(device_id=dev, 
+                            max_concurrent=max_concurrent, 
+                            n_holders=len(scripts),
+                            is_locked=max_concurrent > 0 and len(scripts) >= max_concurrent, 
+                            holders=[dict(script_id=x.id, status=x.status, claimed_by=x.claimed_by, time_started=x.time_started) for x in scripts]))
+    return ret
+
+
+def claim_scripts(runner_id:str|None=None, runner_ip:str|None=None, n_max:int=1, 
+                  max_cost:int|None=None, cost_cap:int|None=None, lease_sec:float=120, 
+                  scheduler:dict|None=None) -> list[schema.Script]:
+    """atomically move up to n_max eligible scripts from WAITING_TO_RUN to STARTING for one runner
+
+    Args:
+        runner_id (str | None, optional): the runner id (None for the default runner). Defaults to None.
+        runner_ip (str | None, optional): the primary ip of the runner. Defaults to None.
+        n_max (int, optional): max number of scripts to claim. Defaults to 1.
+        max_cost (int | None, optional): max sum of slot costs to claim (the free slots of the runner). Defaults to None.
+        cost_cap (int | None, optional): the slot cost of a single script is capped to this (the max_slots of the runner). Defaults to None.
+        lease_sec (float, optional): seconds until the claim expires if not renewed. Defaults to 120.
+        scheduler (dict | None, optional): policy, share_key and weights for the queue order (see get_queue_query). Defaults to None.
+
+    Returns:
+        list[schema.Script]: the claimed scripts (now in status STARTING) in queue order
+    """
+    s = schema.Script
+    now = helpers.get_utcnow()
+    claimed_by = get_claimed_by(runner_id, runner_ip)
+    lease_expires = now + datetime.timedelta(seconds=lease_sec)
+
+    with _claim_lock, Session(engine) as session:
+        requeue_expired_claims(session, now)
+        q = get_queue_query(now, **(scheduler or {}))
+
+        # per device mutual exclusion: a script may only start while its device has less than max_concurrent active scripts
+        n_active = {k: len(v) for k, v in get_device_holders(session).items()}
+        max_concurrent = {}
+
+        ids = []
+        cost_total = 0
+        # stream the queue in batches, since usually only its head is claimed
+        result = session.exec(q.execution_options(yield_per=max(4 * n_max, 20)))
+        for script in result:
+            if len(ids) >= n_max:
+                break
+            if not script.test_for_runner(runner_id, runner_ip):
+                continue
+            
+            dev = script.device_id
+            if dev is not None:
+                if not dev in max_concurrent:
+                    max_concurrent[dev] = get_max_concurrent(session, dev)
+                if max_concurrent[dev] > 0 and n_active.get(dev, 0) >= max_concurrent[dev]:
+                    continue # device is busy, but scripts for other devices may go ahead
+
+            cost = script.get_slot_cost()
+            cost = min(cost, cost_cap) if cost_cap else cost
+            if max_cost is not None and cost_total + cost > max_cost:
+                break # keep the queue order -> nothing behind this script may overtake it
+
+            # the status condition makes this safe even against other processes writing to the db
+            qu = sqlalchemy.update(s).where(s.id == script.id, s.status == schema.STATUS.WAITING_TO_RUN)
+            qu = qu.values(status=schema.STATUS.STARTING, claimed_by=claimed_by, lease_expires=lease_expires, last_time_changed=now)
+            if session.execute(qu).rowcount:
+                ids.append(script.id)
+                cost_total += cost
+                if dev is not None:
+                    n_active[dev] = n_active.get(dev, 0) + 1
+        result.close()
+        session.commit()
+
+        scripts = [session.get(s, i, populate_existing=True) for i in ids]
+        for script in scripts:
+            _notify_status(script, schema.STATUS.WAITING_TO_RUN)
+        
+    log.debug(f'{claimed_by=} claimed {ids=}')
+    return scripts
+
+
+def renew_leases(runner_id:str|None=None, runner_ip:str|None=None, script_ids:list[int]|None=None, lease_sec:float=120) -> list[int]:
+    """renew the lease for all given (active) scripts claimed by this runner and return the renewed script ids"""
+    s = schema.Script
+    now = helpers.get_utcnow()
+    claimed_by = get_claimed_by(runner_id, runner_ip)
+    if not script_ids:
+        return []
+    
+    with Session(engine) as session:
+        q = select(s.id).where(s.id.in_(script_ids), s.claimed_by == claimed_by, s.status.in_(ACTIVE_STATI))
+        ids = session.exec(q).all()
+        if ids:
+            qu = sqlalchemy.update(s).where(s.id.in_(ids)).values(lease_expires=now + datetime.timedelta(seconds=lease_sec), last_heartbeat=now)
+            session.execute(qu)
+            session.commit()
+    return list(ids)
+
+
+def find_memoized(session, script:schema.Script, ttl_sec:float, now:datetime.datetime|None=None) -> schema.Script|None:
+    """the latest FINISHED run with the same script_version and params_hash as the given script which finished within 
+    the last ttl_sec. Runs which were memoized themselves are skipped so the TTL always counts from a real execution."""
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    if ttl_sec <= 0 or not script.script_version or not script.params_hash:
+        return None
+    q = select(s).where(s.params_hash == script.params_hash, s.script_version == script.script_version, 
+                        s.status == schema.STATUS.FINISHED, s.time_finished >= now - datetime.timedelta(seconds=ttl_sec), s.id != script.id)
+    for cached in session.exec(q.order_by(s.time_finished.desc())):
+        if not (cached.data_json or {}).get('memoized_from'):
+            return cached
+    return None
+
+
+def memoize_script(script_id:int, now:datetime.datetime|None=None) -> schema.Script|None:
+    """complete a queued script which opted in for memoization (see Script.get_memoize_ttl) with the results of an
+    identical earlier run (see find_memoized) instead of running it.
+
+    The script references the output notebook of the cached run (script_out_path), copies its outputs, papermill_json and
+    docs_json and gets a copy of each of its datafiles pointing to the same files. data_json["memoized_from"] holds the 
+    id of the cached run.
+
+    Returns:
+        schema.Script|None: the FINISHED script or None if there was no cache hit
+    """
+    s = schema.Script
+    now = helpers.get_utcnow() if now is None else now
+    stati_queued = [k for k, v in schema.status_dc.items() if v < 10]
+
+    with _claim_lock, Session(engine) as session:
+        script = session.get(s, script_id)
+        if script is None or not script.status in stati_queued:
+            return None
+        script.set_params_hash()
+        cached = find_memoized(session, script, script.get_memoize_ttl(memoize_ttl_sec), now)
+        if cached is None:
+            session.commit() # keep the params_hash for later lookups
+            return None
+
+        status_old = script.status
+        script.status = schema.STATUS.FINISHED
+        script.script_out_path = cached.script_out_path
+        script.papermill_json = copy.deepcopy(cached.papermill_json)
+        script.docs_json = copy.deepcopy(cached.docs_json)
+        script.data_json = {**(script.data_json or {}), 'memoized_from': cached.id, 'outputs': copy.deepcopy((cached.data_json or {}).get('outputs', {}))}
+        script.comments = (script.comments or '') + f'\n{helpers.now_iso()} completed from the cached run {cached.id} with identical notebook version and parameters'
+        script.time_started = now
+        script.time_finished = now
+        script.last_time_changed = now
+
+        for datafile in cached.datafiles:
+            kwargs = datafile.model_dump(exclude={'id', 'script_id', 'time_initiated', 'last_time_changed'})
+            kwargs['data_json'] = {**(kwargs.get('data_json') or {}), 'memoized_from': datafile.id}
+            session.add(schema.Datafile(**copy.deepcopy(kwargs), script_id=script.id, time_initiated=now, last_time_changed=now))
+        session.commit()
+        session.refresh(script)
+        log.info(f'memoized script={script_id} from script={cached.id} (N={len(cached.datafiles)} datafiles)')
+
+        _notify_status(script, status_old)
+        return script
+
+
+def get_cell_durations(script_name:str, n_last:int=10) -> list:
+    """the median duration per cell index over the last n_last FINISHED runs of the script_name which recorded their 
+    progress (see JupyRunner.core.progress). Empty if there are none"""
+    s = schema.Script
+    if not script_name or n_last <= 0:
+        return []
+    q = select(s.progress_json).where(s.script_name == script_name, s.status == schema.STATUS.FINISHED, s.progress_json != None)
+    with Session(engine) as session:
+        records = session.exec(q.order_by(s.time_finished.desc()).limit(n_last)).all()
+    runs = [r['durations'] for r in records if isinstance(r, dict) and isinstance(r.get('durations'), list)]
+    return progress.get_median_durations(runs)
+
+
 def get_ids(data_type:type, n_max:int=-1, reqt_q = False):
     with Session(engine) as session:
         q = select(data_type.id)
@@ -245,14 +1018,19 @@ def get_ids(data_type:type, n_max:int=-1, reqt_q = False):
         else:
             return res
     
-def qry_tabledata(t_min, t_max, skipn, n_max, **kwargs):
+def qry_tabledata(t_min, t_max, skipn, n_max, cursor:str|None=None, order:str='desc', **kwargs):
     with Session(engine) as session:
-        scripts, q = qry_scripts(n_max=n_max, skipn=skipn, t_min=t_min, t_max=t_max, ret_query=True, **kwargs)
+        if skipn or n_max <= 0: # all rows or pages by offset
+            scripts, q = qry_scripts_sub(session, n_max=n_max, skipn=skipn, t_min=t_min, t_max=t_max, ret_query=True, order=order, **kwargs)
+            page = dict(next_cursor=None, prev_cursor=None)
+        else:
+            page = qry_scripts_page(session, n_max=n_max, cursor=cursor, order=order, t_min=t_min, t_max=t_max, ret_query=True, **kwargs)
+            scripts, q = page['data'], page['query']
 
         # df = pd.DataFrame.from_records(data)
         # columns=df.columns.tolist()
         log.debug(len(scripts))
-        rows = [{**script.model_dump(), **{'files': len(script.datafiles)}} for script in scripts if script]
+        rows = [{**script.model_dump(), **{'files': len(script.datafiles), 'progress': script.get_progress_str()}} for script in scripts if script]
         log.debug(rows)
 
         for row in rows:
@@ -279,8 +1057,8 @@ def qry_tabledata(t_min, t_max, skipn, n_max, **kwargs):
                 elif row[k] is None:
                     row[k] = ''
 
-        columns = 'id device_id script_params_json status script_out_path files docs start_condition end_condition comments time_finished script_name script_version errors script_in_path'.split()
+        columns = 'id device_id script_params_json status script_out_path files docs start_condition end_condition comments time_finished script_name script_version errors script_in_path progress'.split()
         rows = [[row.get(c, None) for c in columns] for row in rows]
 
-        inp = dict(n=n_max, skip=skipn, start_date=t_min, end_date=t_max)
-        return dict(input=inp, queries=str(q), columns=columns, data=list(reversed(rows)))
+        inp = dict(n=n_max, skip=skipn, start_date=t_min, end_date=t_max, cursor=cursor, order=order)
+        return dict(input=inp, queries=str(q), columns=columns, data=rows, next_cursor=page['next_cursor'], prev_cursor=page['prev_cursor'])
@@ -0,0 +1,116 @@
+"""
+in process event board used by the API server to wake up waiting procservers (long polling)
+as soon as a script enters a status which needs the attention of a runner.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+
+from JupyRunner.core import schema, helpers
+
+log = helpers.log
+
+WAKEUP_STATI = [
+    schema.STATUS.INITIALIZING,
+    schema.STATUS.AWAITING_CHECK,
+    schema.STATUS.WAITING_TO_RUN,
+    schema.STATUS.CANCELLING
+]
+
+max_timeout = 60
+max_events = 1000
+
+_cond = threading.Condition()
+_seq = 0
+_events = collections.deque(maxlen=max_events)
+_waiters = set() # (loop, asyncio.Event) of all clients waiting in await_events
+
+
+def setup(config):
+    global max_timeout
+    max_timeout = config.get('globals', {}).get('events_max_timeout', max_timeout)
+
+def start(config):
+    pass
+
+
+def get_seq():
+    return _seq
+
+
+def notify(script_id, status):
+    """register a new event and wake up all waiting clients"""
+    global _seq
+    with _cond:
+        _seq += 1
+        _events.append(dict(seq=_seq, script_id=script_id, status=str(status), t=helpers.now_iso()))
+        _cond.notify_all()
+        for loop, event in _waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError: # the loop was closed meanwhile
+                pass
+    log.debug(f'dispatch event {_seq=} {script_id=} {status=}')
+
+
+def on_status_change(obj, status_old=None):
+    """status listener to be registered in the db_interface"""
+    if isinstance(obj, schema.Script) and obj.status in WAKEUP_STATI and obj.status != status_old:
+        notify(obj.id, obj.status)
+
+
+def _get_events_since(since):
+    return [e for e in _events if e['seq'] > since]
+
+
+def wait(since:int|None=None, timeout:float=30):
+    """block until there are any events newer than "since" or the timeout has passed.
+
+    Args:
+        since (int | None, optional): the last seq number the client has seen. None to return the current seq immediately. Defaults to None.
+        timeout (float, optional): max time to block in seconds. Defaults to 30.
+
+    Returns:
+        dict: seq (the newest seq number), events (list of all events newer than since), and timed_out
+    """
+    t_end = time.monotonic() + max(0, min(timeout, max_timeout))
+
+    with _cond:
+        while (res := _poll(since, t_end)) is None:
+            _cond.wait(t_end - time.monotonic())
+        return res
+
+
+async def await_events(since:int|None=None, timeout:float=30):
+    """as wait, but waits on the event loop instead of blocking a thread (for the long polling endpoint)"""
+    t_end = time.monotonic() + max(0, min(timeout, max_timeout))
+    loop = asyncio.get_running_loop()
+
+    while True:
+        with _cond:
+            res = _poll(since, t_end)
+            if res is not None:
+                return res
+            waiter = (loop, asyncio.Event())
+            _waiters.add(waiter) # under the same lock as the check, so no notify gets lost
+        try:
+            await asyncio.wait_for(waiter[1].wait(), t_end - time.monotonic())
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with _cond:
+                _waiters.discard(waiter)
+
+
+def _poll(since:int|None, t_end:float) -> dict|None:
+    # needs _cond. The result of wait or None to keep waiting
+    # since > _seq means the server was restarted in the meantime --> return immediately
+    if since is None or since > _seq:
+        return dict(seq=_seq, events=[], timed_out=False)
+    if _seq > since:
+        return dict(seq=_seq, events=_get_events_since(since), timed_out=False)
+    if time.monotonic() >= t_end:
+        return dict(seq=_seq, events=[], timed_out=True)
+    return None
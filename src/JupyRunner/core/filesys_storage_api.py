@@ -16,7 +16,7 @@ from pathlib import Path
 import tempfile
 from pathlib import Path
 
-from JupyRunner.core import helpers, helpers_papermill
+from JupyRunner.core import helpers, helpers_papermill, repo_index
 
 log = helpers.log
 
@@ -24,6 +24,7 @@ default_dir_data = ''
 default_dir_repo = ''
 default_dir_docs = ''
 default_dir_libs = ''
+default_dir_logs = ''
 
 home = str(Path.home())
 timeformat_str = '%Y%m%d_%H%M'
@@ -127,11 +128,13 @@ def is_pathname_valid(pathname: str) -> bool:
 
 
 def setup(config):
-    global default_dir_repo, default_dir_data, default_dir_docs, default_dir_libs
+    global default_dir_repo, default_dir_data, default_dir_docs, default_dir_libs, default_dir_logs
     default_dir_data = config['pathes']['default_dir_meas']
     default_dir_repo = config['pathes']['default_dir_repo']
     default_dir_docs = config['pathes']['default_dir_docs']
     default_dir_libs = config['pathes']['default_dir_libs']
+    default_dir_logs = config['pathes'].get('default_dir_logs', join(default_dir_data, '_logs'))
+    repo_index.setup(config)
 
 
     # _log.info(f'         expanduser: "{os.expanduser("~")}"')
@@ -141,6 +144,7 @@ def setup(config):
     log.info(f'    Writing repo to: "{default_dir_repo}" can_write={os.access(default_dir_repo, os.W_OK)}')
     log.info(f'    Writing docs to: "{default_dir_docs}" can_write={os.access(default_dir_docs, os.W_OK)}')
     log.info(f'    Writing libs to: "{default_dir_libs}" can_write={os.access(default_dir_libs, os.W_OK)}')
+    log.info(f'    Writing logs to: "{default_dir_logs}" can_write={os.access(default_dir_logs, os.W_OK)}')
 
 
 def start(config):
@@ -149,6 +153,7 @@ def start(config):
     mkdir(default_dir_repo, verbose=True)
     mkdir(default_dir_docs, verbose=True)
     mkdir(default_dir_libs, verbose=True)
+    mkdir(default_dir_logs, verbose=True)
 
 
 
@@ -164,10 +169,18 @@ def _get_absolute_paths_by_extension(directory, extension):
 
 
 def get_scripts_in_repo(extension='.ipynb'):
+    if extension == repo_index.ext:
+        return list(repo_index.get_scripts().keys())
     return list(helpers_papermill.get_repo_scripts(default_dir_repo, extension).keys())
 
     # return _get_absolute_paths_by_extension(default_dir_repo, extension)
 
+def resolve_script_path(script_in_path:str) -> str:
+    """the path of a notebook as given or, if it does not exist, the first notebook in the repo whose file name contains it"""
+    if not os.path.exists(script_in_path):
+        return repo_index.find(script_in_path) or script_in_path
+    return script_in_path
+
 def get_id_data_from_path(s):
     """helper function to get id from a path
 
@@ -224,6 +237,34 @@ def get_default_doc_name(script_id:int, device_id:str):
     time = datetime.datetime.utcnow().strftime(timeformats_str)
     return f'{time}_{script_id}_{device_id}_d_exported_doc'
 
+def get_log_filepath(script_id:int, make_dir=False):
+    """the path of the (rotating) log file holding the stdout/stderr of all runs of a script"""
+    if make_dir:
+        mkdir(default_dir_logs, raise_ex=True)
+    return join(default_dir_logs, f'script_{script_id}.log')
+
+def read_log_tail(script_id:int, n_bytes:int=10_000, offset:int|None=None):
+    """read the log file of a script.
+
+    Args:
+        script_id (int): the id of the script
+        n_bytes (int, optional): max number of bytes to read from the end of the file. Defaults to 10_000.
+        offset (int | None, optional): if given, read everything after this byte position instead of the tail. Defaults to None.
+
+    Returns:
+        tuple[bytes, int]: the data read and the current size of the log file (to use as offset for the next call)
+    """
+    pth = get_log_filepath(script_id)
+    if not os.path.exists(pth):
+        return b'', 0
+    
+    with open(pth, 'rb') as fp:
+        size = fp.seek(0, os.SEEK_END)
+        if offset is None or offset > size: # offset > size means the log was rotated
+            offset = max(0, size - n_bytes)
+        fp.seek(offset)
+        return fp.read(size - offset), size
+
 def get_script_save_dir(dtime:datetime.datetime, experiment_id:int, device_id:str, experiment_name:str, tag:str=None, make_dir=False):
     time = dtime.strftime(timeformat_str)
     tag = ('_' + tag.strip().replace(' ', '')) if tag else ''
@@ -0,0 +1,107 @@
+"""
+minimal parser for standard 5 field cron expressions ("minute hour day_of_month month day_of_week")
+to compute the next fire time of recurring schedules. All times are naive UTC like the rest of the DB.
+
+supports: "*", lists "1,2,5", ranges "1-5", steps "*/15" and "10-40/10", month and weekday names
+("jan", "mon") and the macros @yearly, @annually, @monthly, @weekly, @daily, @midnight and @hourly.
+"""
+
+import datetime
+
+MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+
+NAMES_MONTH = {k: i+1 for i, k in enumerate('jan feb mar apr may jun jul aug sep oct nov dec'.split())}
+NAMES_DOW = {k: i for i, k in enumerate('sun mon tue wed thu fri sat'.split())}
+
+# (min, max, names) for minute, hour, day of month, month, day of week
+FIELDS = [(0, 59, {}), (0, 23, {}), (1, 31, {}), (1, 12, NAMES_MONTH), (0, 7, NAMES_DOW)]
+
+
+def _parse_value(s:str, names:dict) -> int:
+    s = s.strip().lower()
+    return names[s] if s in names else int(s)
+
+
+def _parse_field(s:str, vmin:int, vmax:int, names:dict) -> set[int]:
+    values = set()
+    for part in s.split(','):
+        rng, _, step = part.partition('/')
+        step = int(step) if step else 1
+        assert step > 0, f'step must be > 0 in "{part}"'
+        if rng == '*':
+            a, b = vmin, vmax
+        elif '-' in rng:
+            a, b = (_parse_value(v, names) for v in rng.split('-', 1))
+        else:
+            a = _parse_value(rng, names)
+            b = vmax if step > 1 else a
+        assert vmin <= a <= b <= vmax, f'"{part}" is out of the range {vmin}-{vmax}'
+        values.update(range(a, b+1, step))
+    return values
+
+
+class CronExpr():
+    """a parsed cron expression
+
+    Args:
+        expr (str): the cron expression e.G. "*/15 8-18 * * mon-fri"
+    """
+
+    def __init__(self, expr:str) -> None:
+        self.expr = expr
+        fields = MACROS.get(expr.strip().lower(), expr).split()
+        assert len(fields) == 5, f'a cron expression needs 5 fields (minute hour day_of_month month day_of_week) but got {expr=}'
+        self.minutes, self.hours, self.days, self.months, dows = [_parse_field(f, *spec) for f, spec in zip(fields, FIELDS)]
+        self.dows = {d % 7 for d in dows} # 0 and 7 are both sunday
+
+        # like in vixie cron: if both day fields are restricted, a day matches if any of them does
+        self.dom_restricted = fields[2] != '*'
+        self.dow_restricted = fields[4] != '*'
+
+    def __repr__(self) -> str:
+        return f'CronExpr({self.expr!r})'
+
+    def _match_day(self, t:datetime.datetime) -> bool:
+        dom = t.day in self.days
+        dow = (t.isoweekday() % 7) in self.dows
+        if self.dom_restricted and self.dow_restricted:
+            return dom or dow
+        return dom and dow
+
+    def get_next(self, after:datetime.datetime) -> datetime.datetime:
+        """the first time matching this expression strictly after "after" (with minute resolution)"""
+        t = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        t_end = t + datetime.timedelta(days=5*366)
+        while t < t_end:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._match_day(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f'{self} never fires')
+
+
+def get_next_fire(after:datetime.datetime, cron:str='', interval_sec:float=0, t_start:datetime.datetime|None=None) -> datetime.datetime:
+    """the next fire time after "after" for either a cron expression or a fixed interval (aligned to t_start)"""
+    if cron:
+        return CronExpr(cron).get_next(after)
+
+    assert interval_sec and interval_sec > 0, 'need to give either a cron expression or an interval_sec > 0'
+    t_start = after if t_start is None else t_start
+    if t_start > after:
+        return t_start
+    n = int((after - t_start).total_seconds() // interval_sec) + 1
+    return t_start + datetime.timedelta(seconds=n * interval_sec)
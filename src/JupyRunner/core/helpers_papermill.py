@@ -146,6 +146,32 @@ def get_info(p):
     return info
         
         
+SCRAP_MIMETYPE = 'application/scrapbook.scrap.json+json'
+
+def get_outputs(nb) -> dict:
+    """collect the outputs a notebook declared for the scripts depending on it (see pipelines). These are
+    the values glued with scrapbook (sb.glue("name", value)) and the JSON outputs of the cells tagged "outputs"
+    (e.G. IPython.display.display({"application/json": {"name": value}}, raw=True))
+
+    Args:
+        nb: the executed notebook (a dict like notebook node)
+
+    Returns:
+        dict: output name -> value
+    """
+    ret = {}
+    for cell in nb.get('cells', []):
+        is_tagged = 'outputs' in cell.get('metadata', {}).get('tags', [])
+        for output in cell.get('outputs', []):
+            data = output.get('data', {})
+            scrap = data.get(SCRAP_MIMETYPE)
+            if isinstance(scrap, dict) and scrap.get('name'):
+                ret[scrap['name']] = scrap.get('data')
+            elif is_tagged and isinstance(data.get('application/json'), dict):
+                ret.update(data['application/json'])
+    return ret
+
+
 def get_repo_scripts(repo_dir, ext='.ipynb'):
     """crawl a directory with ipynb scripts in and get the papermill info for each of them
 
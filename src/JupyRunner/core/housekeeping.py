@@ -0,0 +1,73 @@
+"""
+periodic background tasks of the API server (e.G. reaping scripts of dead runners). Each task is
+registered with its own interval and runs in one shared daemon thread.
+"""
+
+import threading
+import time
+import traceback
+
+from JupyRunner.core import helpers
+
+log = helpers.log
+
+t_interval = 5
+enabled = True
+
+tasks = {}
+
+_thread = None
+_stop = threading.Event()
+
+
+def setup(config):
+    global t_interval, enabled
+    cnfg = config.get('housekeeping', {}) or {}
+    t_interval = cnfg.get('t_interval', t_interval)
+    enabled = bool(cnfg.get('enabled', enabled))
+
+
+def start(config):
+    global _thread
+    if not enabled:
+        log.info('housekeeping is disabled')
+        return
+    if _thread is None or not _thread.is_alive():
+        _stop.clear()
+        _thread = threading.Thread(target=_run, name='housekeeping', daemon=True)
+        _thread.start()
+
+
+def stop():
+    _stop.set()
+
+
+def add_task(name:str, fun, interval:float):
+    """register fun() to be called every interval seconds (0 or less disables the task)"""
+    tasks[name] = dict(fun=fun, interval=interval, t_next=0, n_runs=0, t_last=None, last_result=None, last_error='')
+
+
+def get_info():
+    return {k: {kk: vv for kk, vv in v.items() if not kk in ['fun', 't_next']} for k, v in tasks.items()}
+
+
+def tick():
+    for name, task in list(tasks.items()):
+        if task['interval'] <= 0 or time.monotonic() < task['t_next']:
+            continue
+        try:
+            task['last_result'] = task['fun']()
+            task['last_error'] = ''
+        except Exception as err:
+            log.error(f'ERROR in housekeeping task "{name}": {err}')
+            traceback.print_exception(err)
+            task['last_error'] = str(err)
+        task['n_runs'] += 1
+        task['t_last'] = helpers.now_iso()
+        task['t_next'] = time.monotonic() + task['interval']
+
+
+def _run():
+    log.info(f'housekeeping started with {t_interval=} and tasks={list(tasks)}')
+    while not _stop.wait(t_interval):
+        tick()
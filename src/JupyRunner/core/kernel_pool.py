@@ -0,0 +1,283 @@
+"""
+optional pool of pre started and pre warmed jupyter kernels, which are handed to
+papermill executions instead of starting a fresh kernel for every single run.
+
+NOTE: the pool lives within the process which calls `start`, so it only makes sense
+for long living executors (e.G. a procserver with do_direct_running) and not for the
+one-shot run_script.py processes.
+"""
+
+import contextlib
+import queue
+import threading
+
+from JupyRunner.core import helpers
+
+log = helpers.log
+
+config = None
+pool = None
+own_kernels = False # start a fresh kernel for a run if the pool has none, so it can be shut down (see shutdown_kernel_of)
+running = {} # owner (e.G. script id) -> kernel manager in use
+cancelled = set() # owners whose run was cancelled (see shutdown_kernel_of), they get no new kernel
+_running_lock = threading.Lock()
+
+default_config = {
+    'size': 0,
+    'kernel_name': 'python3',
+    'preload_modules': ['numpy', 'pandas', 'matplotlib'],
+    'recycle': 'restart',
+    'max_uses': 1,
+    'startup_timeout': 60,
+}
+
+
+class Cancelled(Exception):
+    """the run of the owner was cancelled before it got its kernel"""
+
+
+def get_pool_config(cnfg):
+    return {**default_config, **(cnfg.get('kernel_pool', {}) or {})}
+
+
+def make_preload_code(modules:list[str], path_to_libs:str|None=None):
+    """python code which will be executed in each fresh kernel before it is handed out"""
+    lines = ['import sys']
+    if path_to_libs:
+        lines.append(f'sys.path.insert(0, {path_to_libs!r}) if {path_to_libs!r} not in sys.path else None')
+    for module in modules:
+        lines.append(f'try:\n    import {module}\nexcept ImportError:\n    pass')
+    return '\n'.join(lines)
+
+
+def setup(cnfg):
+    global config
+    config = cnfg
+
+
+def start(cnfg):
+    global config, pool
+    config = cnfg
+    pconfig = get_pool_config(config)
+    if pool is None and pconfig['size'] > 0:
+        preload_code = make_preload_code(pconfig['preload_modules'], config.get('pathes', {}).get('default_dir_libs'))
+        pool = KernelPool(pconfig['size'],
+                          kernel_name=pconfig['kernel_name'],
+                          preload_code=preload_code,
+                          recycle=pconfig['recycle'],
+                          max_uses=pconfig['max_uses'],
+                          startup_timeout=pconfig['startup_timeout'])
+        pool.fill()
+    return pool
+
+
+def stop():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+    pool = None
+
+
+@contextlib.contextmanager
+def _get_pool_kernel():
+    if pool is None:
+        yield None
+    else:
+        with pool.kernel() as km:
+            yield km
+
+
+@contextlib.contextmanager
+def get_kernel(owner=None):
+    """yields a warm kernel manager from the pool or None if the pool is disabled or empty (-> papermill starts its own kernel).
+    With own_kernels a fresh kernel is started instead of None. The kernel is registered for the owner while in use.
+    Raises Cancelled if the run of the owner was cancelled in the meantime"""
+    raise_if_cancelled(owner)
+    with _get_pool_kernel() as km:
+        is_own = km is None and own_kernels
+        if is_own:
+            from jupyter_client.manager import KernelManager
+            km = KernelManager(kernel_name=get_pool_config(config or {})['kernel_name'])
+            km.start_kernel()
+
+        try:
+            if owner is not None:
+                with _running_lock: # together with the check, so a cancel either sees the kernel or stops the run here
+                    raise_if_cancelled(owner)
+                    if km is not None:
+                        running[owner] = km
+            yield km
+        finally:
+            if owner is not None:
+                with _running_lock:
+                    running.pop(owner, None)
+            if is_own:
+                try:
+                    km.shutdown_kernel(now=True)
+                except Exception as err:
+                    log.error(f'ERROR while shutting down kernel {km}: {err}')
+
+
+def raise_if_cancelled(owner):
+    if owner is not None and owner in cancelled:
+        raise Cancelled(f'the run of {owner=} was cancelled')
+
+
+def clear_cancelled(owner):
+    """forget the cancellation of the owner (when its run has ended)"""
+    with _running_lock:
+        cancelled.discard(owner)
+
+
+def shutdown_kernel_of(owner) -> bool:
+    """cancel the run of the owner: shut down the kernel it currently uses (which makes its execution fail) and 
+    refuse new kernels for it until clear_cancelled. Returns whether there was a kernel to shut down"""
+    with _running_lock:
+        cancelled.add(owner)
+        km = running.get(owner)
+    if km is None:
+        return False
+    log.warning(f'shutting down the kernel of {owner=}')
+    km.shutdown_kernel(now=True)
+    return True
+
+
+class KernelPool():
+    """a fixed size pool of started kernel managers with the preload code already executed
+
+    Args:
+        size (int): number of kernels to keep warm
+        kernel_name (str, optional): the kernel spec to start. Defaults to 'python3'.
+        preload_code (str, optional): code to execute in each fresh kernel. Defaults to ''.
+        recycle (str, optional): 'restart' to restart each kernel after use or 'reuse' to hand out the same kernel up to max_uses times. Defaults to 'restart'.
+        max_uses (int, optional): max number of executions per kernel before restarting it for recycle='reuse'. Defaults to 1.
+        startup_timeout (float, optional): timeout in seconds for a kernel to get ready. Defaults to 60.
+    """
+
+    def __init__(self, size:int, kernel_name:str='python3', preload_code:str='', recycle:str='restart', max_uses:int=1, startup_timeout:float=60) -> None:
+        assert recycle in ['restart', 'reuse'], f'recycle must be either "restart" or "reuse" but was {recycle=}'
+        self.size = size
+        self.kernel_name = kernel_name
+        self.preload_code = preload_code
+        self.recycle = recycle
+        self.max_uses = max(1, max_uses)
+        self.startup_timeout = startup_timeout
+
+        self.idle = queue.Queue()
+        self.uses = {}
+        self.n_busy = 0
+        self.n_starting = 0
+        self.is_shutdown = False
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'KernelPool(size={self.size}, idle={self.idle.qsize()}, busy={self.n_busy}, recycle={self.recycle})'
+
+    def _warmup(self, km):
+        kc = km.client()
+        kc.start_channels()
+        try:
+            kc.wait_for_ready(timeout=self.startup_timeout)
+            if self.preload_code:
+                reply = kc.execute_interactive(self.preload_code, timeout=self.startup_timeout, store_history=False)
+                if reply['content'].get('status') != 'ok':
+                    log.warning(f'preload code failed in kernel {km}: {reply["content"]}')
+        finally:
+            kc.stop_channels()
+        self.uses[id(km)] = 0
+        return km
+
+    def _start_kernel(self):
+        from jupyter_client.manager import KernelManager
+
+        km = KernelManager(kernel_name=self.kernel_name)
+        km.start_kernel()
+        return self._warmup(km)
+
+    def _spawn(self, km=None):
+        with self._lock:
+            self.n_starting += 1
+        threading.Thread(target=self._add, args=(km,), daemon=True).start()
+
+    def _add(self, km=None):
+        try:
+            if km is None:
+                km = self._start_kernel()
+            else:
+                km.restart_kernel(now=True)
+                km = self._warmup(km)
+
+            if self.is_shutdown:
+                self._shutdown_kernel(km)
+            else:
+                self.idle.put(km)
+        except Exception as err:
+            log.error(f'ERROR while starting kernel for {self}')
+            log.exception(err)
+            if km is not None:
+                self._shutdown_kernel(km)
+        finally:
+            with self._lock:
+                self.n_starting -= 1
+
+    def _shutdown_kernel(self, km):
+        try:
+            self.uses.pop(id(km), None)
+            km.shutdown_kernel(now=True)
+        except Exception as err:
+            log.error(f'ERROR while shutting down kernel {km}: {err}')
+
+    def fill(self):
+        """start kernels in the background until the pool is full"""
+        with self._lock:
+            n_missing = self.size - self.idle.qsize() - self.n_busy - self.n_starting
+        for _ in range(max(0, n_missing)):
+            self._spawn()
+
+    def acquire(self, timeout:float|None=0):
+        """get a warm kernel manager or None if none is available within timeout"""
+        try:
+            km = self.idle.get(block=bool(timeout), timeout=timeout if timeout else None)
+        except queue.Empty:
+            log.info(f'no warm kernel available in {self}')
+            self.fill() # replace kernels which failed to restart
+            return None
+
+        if not km.is_alive():
+            log.warning(f'kernel {km} in pool is dead. Replacing it')
+            self._shutdown_kernel(km)
+            self._spawn()
+            return self.acquire(timeout)
+
+        with self._lock:
+            self.n_busy += 1
+        return km
+
+    def release(self, km, failed=False):
+        """give a kernel back after use. It will be restarted (or reused) in the background"""
+        self.uses[id(km)] = self.uses.get(id(km), 0) + 1
+        if self.recycle == 'reuse' and not failed and self.uses[id(km)] < self.max_uses and km.is_alive():
+            self.idle.put(km)
+        else:
+            self._spawn(km)
+
+        with self._lock:
+            self.n_busy -= 1
+
+    @contextlib.contextmanager
+    def kernel(self):
+        km = self.acquire()
+        failed = False
+        try:
+            yield km
+        except Exception:
+            failed = True
+            raise
+        finally:
+            if km is not None:
+                self.release(km, failed=failed)
+
+    def shutdown(self):
+        self.is_shutdown = True
+        while not self.idle.empty():
+            self._shutdown_kernel(self.idle.get_nowait())
@@ -0,0 +1,349 @@
+"""
+launches the run_script jobs of the procserver either as fresh "python run_script.py --id ..."
+subprocesses or as children of a forkserver, which has papermill, nbconvert, sqlmodel etc. already
+imported, so each job only pays for a fork instead of a full interpreter startup. With
+do_direct_running (and direct_mode "thread") the jobs run in threads of the procserver itself.
+
+The stdout/stderr of each job is drained by background threads into a size capped, rotating
+log file per script (see filesys_storage_api.get_log_filepath).
+"""
+
+import multiprocessing
+import os
+import subprocess
+import sys
+import threading
+import traceback
+
+from JupyRunner.core import helpers, filesys_storage_api, kernel_pool
+
+log = helpers.log
+
+PRELOAD_MODULES = [
+    'yaml',
+    'sqlmodel',
+    'papermill',
+    'nbconvert',
+    'JupyRunner.core.schema',
+    'JupyRunner.core.scriptrunner',
+    'JupyRunner.core.launcher',
+]
+
+config = None
+launcher = 'subprocess'
+log_max_bytes = 10_000_000
+log_backup_count = 2
+log_err_tail_bytes = 4000
+pump_join_timeout_sec = 10
+_ctx = None
+
+
+def setup(cnfg):
+    global config, launcher, log_max_bytes, log_backup_count, log_err_tail_bytes, pump_join_timeout_sec
+    config = cnfg
+    launcher = config.get('procserver', {}).get('launcher', 'subprocess')
+    log_max_bytes = config.get('procserver', {}).get('log_max_bytes', log_max_bytes)
+    log_backup_count = config.get('procserver', {}).get('log_backup_count', log_backup_count)
+    log_err_tail_bytes = config.get('procserver', {}).get('log_err_tail_bytes', log_err_tail_bytes)
+    pump_join_timeout_sec = config.get('procserver', {}).get('pump_join_timeout_sec', pump_join_timeout_sec)
+    if config.get('procserver', {}).get('do_direct_running', 0) and config.get('procserver', {}).get('direct_mode', 'thread') == 'thread':
+        launcher = 'thread'
+    if launcher == 'forkserver' and not 'forkserver' in multiprocessing.get_all_start_methods():
+        log.warning(f'{launcher=} is not available on this platform. Falling back to "subprocess"')
+        launcher = 'subprocess'
+    assert launcher in ['subprocess', 'forkserver', 'thread'], f'procserver.launcher must be either "subprocess", "forkserver" or "thread" but was {launcher=}'
+
+
+def start(cnfg):
+    if launcher == 'forkserver':
+        get_context()
+
+
+def get_context():
+    """get the forkserver context and start the forkserver with all heavy modules preloaded"""
+    global _ctx
+    if _ctx is None:
+        _ctx = multiprocessing.get_context('forkserver')
+        _ctx.set_forkserver_preload(PRELOAD_MODULES)
+        log.info(f'starting forkserver with {PRELOAD_MODULES=}')
+    return _ctx
+
+
+def launch(script_id:int):
+    """start a job for the given script id and return a subprocess.Popen like job object for it. 
+    The output of the job is continuously drained into the rotating per script log file."""
+    logfile = RotatingLogFile(filesys_storage_api.get_log_filepath(script_id, make_dir=True), max_bytes=log_max_bytes, backup_count=log_backup_count)
+    logfile.write(f'===== {helpers.now_iso()} starting job for {script_id=} with {launcher=} =====\n'.encode())
+    if launcher == 'forkserver':
+        return launch_forked(script_id, logfile)
+    elif launcher == 'thread':
+        log.info(f'STARTING THREAD... for job {script_id=} (log: {logfile.path})')
+        return ThreadJob(script_id, logfile)
+    else:
+        return launch_subprocess(script_id, logfile)
+
+
+def launch_subprocess(script_id:int, logfile:'RotatingLogFile') -> 'SubprocessJob':
+    run_script_path = config['procserver']['run_script_path']
+
+    cmds = [run_script_path, '--id', str(script_id)]
+    if os.name == 'nt':
+        cmds = [config['procserver']['pythonpath_for_win']] + cmds
+    else:
+        cmds = ['python'] + cmds
+
+    s = ' '.join(cmds)
+    log.info(f'RUNNING... "{s}" (log: {logfile.path})')
+    if os.name == 'nt' and 'TESTING' in config and config['TESTING']:
+        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_CONSOLE)
+    else:
+        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    
+    return SubprocessJob(p, logfile, p.stdout, p.stderr)
+
+
+def launch_forked(script_id:int, logfile:'RotatingLogFile') -> 'ForkedJob':
+    ctx = get_context()
+    r_out, w_out = ctx.Pipe(duplex=False)
+    r_err, w_err = ctx.Pipe(duplex=False)
+
+    log.info(f'FORKING... job for {script_id=} (log: {logfile.path})')
+    p = ctx.Process(target=_run_forked, args=(script_id, config, w_out, w_err), name=f'jupyrun_{script_id}')
+    p.start()
+    w_out.close()
+    w_err.close()
+    return ForkedJob(p, logfile, r_out, r_err)
+
+
+def _run_forked(script_id, cnfg, w_out, w_err):
+    """entry point of a forked job (runs in the child process)"""
+
+    # same as stdout=PIPE, stderr=PIPE for the subprocess
+    for fd, conn in [(1, w_out), (2, w_err)]:
+        os.dup2(conn.fileno(), fd)
+        conn.close()
+
+    from JupyRunner.core import scriptrunner
+
+    helpers.set_loglevel(cnfg)
+    if scriptrunner.config != cnfg:
+        # setup only: pruning the shared caches (scriptrunner.start) is up to the procserver and the housekeeping, not to each job
+        scriptrunner.setup(cnfg)
+
+    try:
+        log.info(f'forked job with PID={os.getpid()} and {script_id=} is starting')
+        scriptrunner.run_job(script_id)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class RotatingLogFile():
+    """a thread safe, size capped log file which rotates to path.1 ... path.N when it gets bigger than max_bytes"""
+
+    def __init__(self, path:str, max_bytes:int=10_000_000, backup_count:int=2) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._lock = threading.Lock()
+        self._fp = open(self.path, 'ab')
+
+    def _rotate(self):
+        self._fp.close()
+        if self.backup_count > 0:
+            for i in range(self.backup_count - 1, 0, -1):
+                src, dst = f'{self.path}.{i}', f'{self.path}.{i+1}'
+                if os.path.exists(src):
+                    os.replace(src, dst)
+            os.replace(self.path, f'{self.path}.1')
+        self._fp = open(self.path, 'wb')
+
+    def write(self, data:bytes):
+        with self._lock:
+            if self._fp.closed:
+                return
+            if self.max_bytes > 0 and self._fp.tell() + len(data) > self.max_bytes and self._fp.tell() > 0:
+                self._rotate()
+            self._fp.write(data)
+            self._fp.flush()
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+class OutputPump(threading.Thread):
+    """continuously drains a pipe into a log file (so the child never blocks on a full pipe) and keeps the last tail_bytes in memory"""
+
+    def __init__(self, stream, logfile:RotatingLogFile, tail_bytes:int=4000) -> None:
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.logfile = logfile
+        self.tail_bytes = tail_bytes
+        self.tail = b''
+
+    def run(self):
+        try:
+            fd = self.stream.fileno()
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                self.logfile.write(chunk)
+                self.tail = (self.tail + chunk)[-self.tail_bytes:] if self.tail_bytes else b''
+        except (OSError, ValueError) as err:
+            log.debug(f'output pump for {self.logfile.path} stopped with {err=}')
+        finally:
+            self.stream.close()
+
+
+class _Job():
+    """base class for the job objects, which mimic the parts of the subprocess.Popen interface the procserver relies on"""
+
+    def __init__(self, logfile:RotatingLogFile, stream_out, stream_err) -> None:
+        self.logfile = logfile
+        self.pumps = [OutputPump(stream_out, logfile, log_err_tail_bytes), OutputPump(stream_err, logfile, log_err_tail_bytes)]
+        for pump in self.pumps:
+            pump.start()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(pid={self.pid}, returncode={self.returncode})'
+
+    def communicate(self):
+        """wait for the job to end and return the tail of its (stdout, stderr). The full output is in the log file"""
+        self.wait()
+        for pump in self.pumps:
+            pump.join(pump_join_timeout_sec)
+            if pump.is_alive():
+                # e.G. a grand child process inherited the pipe and keeps it open
+                log.warning(f'{self}: the output pump for {self.logfile.path} did not end within {pump_join_timeout_sec=}. Its output is discarded from now on')
+        self.logfile.close()
+        return self.pumps[0].tail, self.pumps[1].tail
+
+
+class SubprocessJob(_Job):
+
+    def __init__(self, process:subprocess.Popen, logfile:RotatingLogFile, stream_out, stream_err) -> None:
+        self.process = process
+        super().__init__(logfile, stream_out, stream_err)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def poll(self):
+        return self.process.poll()
+
+    def wait(self, timeout=None):
+        return self.process.wait(timeout)
+
+    def terminate(self):
+        self.process.terminate()
+
+    def kill(self):
+        self.process.kill()
+
+
+class ForkedJob(_Job):
+    """wraps a multiprocessing.Process"""
+
+    def __init__(self, process:multiprocessing.Process, logfile:RotatingLogFile, stream_out, stream_err) -> None:
+        self.process = process
+        self.args = process.name
+        super().__init__(logfile, stream_out, stream_err)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.exitcode
+
+    def poll(self):
+        return None if self.process.is_alive() else self.process.exitcode
+
+    def wait(self, timeout=None):
+        self.process.join(timeout)
+        if self.process.is_alive():
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.process.exitcode
+
+    def terminate(self):
+        self.process.terminate()
+
+    def kill(self):
+        self.process.kill()
+
+
+class ThreadJob():
+    """runs the job in a thread of the procserver itself. Terminating or killing it shuts down the kernel of
+    its run (see kernel_pool.own_kernels), which makes papermill fail, or keeps it from getting a kernel at all.
+    A killed job is only done (poll) once its thread has really ended. The output of the thread can not be
+    separated from the procserver's, so only the traceback of a failed job ends up in its log file."""
+
+    def __init__(self, script_id:int, logfile:RotatingLogFile) -> None:
+        self.script_id = script_id
+        self.logfile = logfile
+        self.args = f'jupyrun_{script_id}'
+        self.returncode = None
+        self.err_tail = b''
+        self._terminated = False
+        self._killed = False
+        self._done = threading.Event()
+        kernel_pool.clear_cancelled(script_id) # from an earlier run of the same script
+        self.thread = threading.Thread(target=self._run, name=self.args, daemon=True)
+        self.thread.start()
+
+    def __repr__(self) -> str:
+        return f'ThreadJob(script_id={self.script_id}, returncode={self.returncode})'
+
+    def _run(self):
+        from JupyRunner.core import scriptrunner
+        returncode, err_tail = 0, b''
+        try:
+            scriptrunner.run_job(self.script_id)
+        except BaseException:
+            tb = traceback.format_exc().encode()
+            self.logfile.write(tb)
+            returncode, err_tail = 1, tb[-log_err_tail_bytes:] if log_err_tail_bytes else b''
+        finally:
+            kernel_pool.clear_cancelled(self.script_id)
+            self.returncode, self.err_tail = -9 if self._killed else returncode, err_tail
+            self._done.set()
+
+    @property
+    def pid(self):
+        return os.getpid()
+
+    def poll(self):
+        return self.returncode if self._done.is_set() else None
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self.returncode
+
+    def terminate(self):
+        if self._terminated or self._done.is_set():
+            return
+        self._terminated = True
+        if not kernel_pool.shutdown_kernel_of(self.script_id):
+            log.warning(f'{self} has no kernel (yet) to shut down. It will not get one')
+
+    def kill(self):
+        self.terminate()
+        if not self._done.is_set():
+            log.warning(f'{self} is still running after its kernel was shut down. It stays running (poll) until its thread ends')
+            self._killed = True
+
+    def communicate(self):
+        """wait for the job to end (unless it was killed) and return (b'', the tail of the traceback if it failed)"""
+        if not self._killed:
+            self.wait()
+        self.logfile.close()
+        return b'', self.err_tail
@@ -0,0 +1,250 @@
+"""
+DAG pipelines of scripts: every stage declares the stages it depends on ("depends_on") and is held (HOLD)
+until all of its parents have FINISHED. Independent stages run in parallel, a stage with "foreach" fans out
+into one script per value and a stage depending on it joins all of them.
+
+The outputs (data_json["outputs"], collected from the executed notebook by helpers_papermill.get_outputs) and
+the datafile ids of all parents are passed to a child as the parameter "parents" (see get_parents_info).
+"""
+
+import copy
+import os
+import threading
+
+from sqlmodel import select
+
+from JupyRunner.core import schema, helpers, filesys_storage_api
+from JupyRunner.core import db_interface as dbi
+
+log = helpers.log
+
+STATUS = schema.STATUS
+
+_lock = threading.RLock()
+_advancing = set()
+
+
+def setup(config):
+    pass
+
+def start(config):
+    pass
+
+
+def is_done(status) -> bool:
+    return schema.STATUS_DICT[str(status)] > schema.STATUS_DICT['AWAITING_POST_PROC']
+
+def is_failed(status) -> bool:
+    return is_done(status) and status != STATUS.FINISHED
+
+
+def expand_stages(stages:dict) -> tuple[dict, dict]:
+    """validate a pipeline definition and expand all "foreach" stages into their instances.
+
+    Args:
+        stages (dict): stage name -> script kwargs (as for /action/script/run) plus the optional keys "depends_on"
+            (list of stage names) and "foreach" (a single key -> list of values to fan out over. The key can be a
+            script field like "device_id" or a script parameter)
+
+    Returns:
+        tuple[dict, dict]: instance name -> script kwargs and instance name -> list of parent instance names
+    """
+    assert stages and isinstance(stages, dict), 'need to give at least one stage!'
+
+    instances_per_stage = {}
+    instances = {}
+    for name, stage in stages.items():
+        stage = copy.deepcopy(stage)
+        stage.pop('depends_on', None)
+        foreach = stage.pop('foreach', None)
+        assert stage.get('script_in_path'), f'need to give "script_in_path" for {name=}'
+
+        if not foreach:
+            instances[name] = stage
+            instances_per_stage[name] = [name]
+            continue
+
+        assert isinstance(foreach, dict) and len(foreach) == 1, f'"foreach" must be a dict with exactly one key -> list of values but got {foreach=} for {name=}'
+        (key, values), = foreach.items()
+        instances_per_stage[name] = []
+        for value in values:
+            kwargs = copy.deepcopy(stage)
+            if key in schema.Script.model_fields:
+                kwargs[key] = value
+            else:
+                kwargs['script_params_json'] = {**(kwargs.get('script_params_json') or {}), key: value}
+            instances[f'{name}[{value}]'] = kwargs
+            instances_per_stage[name].append(f'{name}[{value}]')
+
+    deps = {}
+    for name, stage in stages.items():
+        parents = stage.get('depends_on', []) or []
+        for p in parents:
+            assert p in stages, f'{name=} depends on the unknown stage {p=}'
+        for instance in instances_per_stage[name]:
+            deps[instance] = [i for p in parents for i in instances_per_stage[p]]
+
+    # Kahn's algorithm to detect cycles
+    n_open = {k: len(v) for k, v in deps.items()}
+    todo = [k for k, n in n_open.items() if n == 0]
+    n_done = 0
+    while todo:
+        k = todo.pop()
+        n_done += 1
+        for child, parents in deps.items():
+            if k in parents:
+                n_open[child] -= 1
+                if n_open[child] == 0:
+                    todo.append(child)
+    assert n_done == len(deps), f'the pipeline has a cycle in the stages {[k for k, n in n_open.items() if n > 0]}'
+
+    return instances, deps
+
+
+def create_pipeline(name:str, stages:dict, comments:str='', submitter:str='') -> schema.Pipeline:
+    """validate and create a pipeline with all its scripts (in HOLD) in one transaction and start the root stages"""
+    instances, deps = expand_stages(stages)
+    for instance, kwargs in instances.items():
+        kwargs['script_in_path'] = filesys_storage_api.resolve_script_path(kwargs['script_in_path'])
+        assert os.path.exists(kwargs['script_in_path']), f'the notebook "{kwargs["script_in_path"]}" of the stage "{instance}" does not exist'
+
+    with dbi.se() as session:
+        pipeline = schema.Pipeline(name=name, stages_json=stages, deps_json=deps, comments=comments)
+        session.add(pipeline)
+        session.flush()
+
+        scripts = {}
+        for instance, kwargs in instances.items():
+            script = schema.Script(**kwargs)
+            script.submitter = script.submitter or submitter or None
+            script.status = STATUS.HOLD
+            script.pipeline_id = pipeline.id
+            script.data_json = {**(script.data_json or {}), 'pipeline_stage': instance}
+            session.add(script)
+            scripts[instance] = script
+        session.flush()
+
+        pipeline.script_ids_json = {k: v.id for k, v in scripts.items()}
+        session.commit()
+        pipeline_id = pipeline.id
+
+    log.info(f'created pipeline {pipeline_id=} {name=} with N={len(instances)} scripts')
+    advance(pipeline_id)
+    return dbi.get(schema.Pipeline, pipeline_id)
+
+
+def get_scripts(session, pipeline:schema.Pipeline) -> dict[str, schema.Script]:
+    ids = pipeline.script_ids_json or {}
+    scripts = {s.id: s for s in session.exec(select(schema.Script).where(schema.Script.id.in_(list(ids.values())))).all()}
+    return {k: scripts[v] for k, v in ids.items() if v in scripts}
+
+
+def get_parents_info(session, scripts:dict[str, schema.Script], parents:list[str]) -> dict:
+    """the info about the parent scripts to pass to a child script as the parameter "parents" """
+    ids = [scripts[p].id for p in parents]
+    datafiles = session.exec(select(schema.Datafile.id, schema.Datafile.script_id).where(schema.Datafile.script_id.in_(ids))).all()
+    return {p: {
+                'script_id': scripts[p].id,
+                'device_id': scripts[p].device_id,
+                'outputs': (scripts[p].data_json or {}).get('outputs', {}),
+                'datafile_ids': [i for i, sid in datafiles if sid == scripts[p].id],
+                'script_out_path': scripts[p].script_out_path,
+            } for p in parents}
+
+
+def advance(pipeline_id:int):
+    """start all held stages whose parents have FINISHED, abort all stages behind failed ones and finish the pipeline when all stages are done"""
+    with _lock:
+        if pipeline_id in _advancing:
+            return # called again through the status listener by the changes below
+        _advancing.add(pipeline_id)
+        try:
+            _advance(pipeline_id)
+        finally:
+            _advancing.discard(pipeline_id)
+
+
+def _advance(pipeline_id:int):
+    with dbi.se() as session:
+        pipeline = session.get(schema.Pipeline, pipeline_id)
+        if pipeline is None or is_done(pipeline.status):
+            return
+        scripts = get_scripts(session, pipeline)
+        deps = pipeline.deps_json or {}
+        is_cancelling = pipeline.status == STATUS.CANCELLING
+
+        to_abort = {}
+        for instance, script in scripts.items():
+            if is_failed(script.status):
+                for child in pipeline.get_descendants(instance):
+                    if scripts[child].status == STATUS.HOLD:
+                        to_abort.setdefault(child, instance)
+
+        to_release = {}
+        for instance, script in scripts.items():
+            if script.status == STATUS.HOLD and not instance in to_abort and all(scripts[p].status == STATUS.FINISHED for p in deps.get(instance, [])):
+                to_release[instance] = get_parents_info(session, scripts, deps.get(instance, []))
+
+    stati = {k: v.status for k, v in scripts.items()}
+    for instance, failed in to_abort.items():
+        msg = f'{helpers.now_iso()} aborted by pipeline {pipeline_id} since the stage "{failed}" it depends on did not finish ({stati[failed]})'
+        dbi.set_property(schema.Script, scripts[instance].id, status=STATUS.ABORTED, errors=(scripts[instance].errors or '') + '\n' + msg)
+        stati[instance] = STATUS.ABORTED
+
+    for instance, parents in to_release.items():
+        script = scripts[instance]
+        params = {**(script.script_params_json or {}), 'parents': parents}
+        log.info(f'pipeline {pipeline_id}: starting stage "{instance}" (script={script.id})')
+        dbi.set_property(schema.Script, script.id, status=STATUS.INITIALIZING, script_params_json=params)
+        stati[instance] = STATUS.INITIALIZING
+
+    if all(is_done(v) for v in stati.values()):
+        if not any(is_failed(v) for v in stati.values()):
+            status = STATUS.FINISHED
+        else:
+            status = STATUS.CANCELLED if is_cancelling else STATUS.FAILED
+        log.info(f'pipeline {pipeline_id} is done with {status=}')
+        dbi.set_property(schema.Pipeline, pipeline_id, status=status, time_finished=helpers.get_utcnow())
+
+
+def on_status_change(obj, status_old=None):
+    """status listener to be registered in the db_interface"""
+    if not isinstance(obj, schema.Script) or obj.status == status_old or not is_done(obj.status):
+        return
+    if obj.pipeline_id is not None:
+        advance(obj.pipeline_id)
+
+
+def get_pipeline_info(pipeline_id:int) -> dict|None:
+    """the pipeline with the status and script id of each of its stages"""
+    with dbi.se() as session:
+        pipeline = session.get(schema.Pipeline, pipeline_id)
+        if pipeline is None:
+            return None
+        scripts = get_scripts(session, pipeline)
+        dc = pipeline.model_dump()
+        dc['stages'] = {k: {'script_id': v.id, 'status': v.status, 'depends_on': pipeline.deps_json.get(k, [])} for k, v in scripts.items()}
+    return dc
+
+
+def cancel_pipeline(pipeline_id:int) -> dict:
+    """abort all held and queued stages and cancel all running ones"""
+    with dbi.se() as session:
+        pipeline = session.get(schema.Pipeline, pipeline_id)
+        assert pipeline is not None, f'pipeline {pipeline_id=} not found'
+        if not is_done(pipeline.status):
+            pipeline.status = STATUS.CANCELLING
+            session.commit()
+        scripts = get_scripts(session, session.get(schema.Pipeline, pipeline_id))
+
+    ret = {}
+    for instance, script in scripts.items():
+        if is_done(script.status):
+            continue
+        if schema.STATUS_DICT[str(script.status)] < schema.STATUS_DICT['STARTING']:
+            status = STATUS.ABORTED
+        else:
+            status = STATUS.CANCELLING
+        dbi.set_property(schema.Script, script.id, status=status)
+        ret[instance] = status
+    return ret
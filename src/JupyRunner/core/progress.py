@@ -0,0 +1,194 @@
+"""
+live per cell progress of running scripts.
+
+The runner attaches a ProgressReporter to the papermill notebook execution manager (see attach), which is called
+on the start and completion of every cell and publishes one compact record per script (Script.progress_json) at most
+every min_interval_sec plus once at the start and the end of the notebook:
+
+    index       index of the current cell in the notebook
+    cell        number of the current code cell (1 based)
+    n_cells     number of code cells
+    t_start     start of the notebook execution
+    t_cell      start of the current cell
+    t_update    time of the record
+    elapsed_sec seconds since t_start
+    eta_sec     estimated seconds until all cells are done (None if unknown)
+    done        whether the notebook execution is done
+    durations   seconds per cell (None for non code and cached cells). Only set once done
+
+The ETA is based on the median duration of each cell in the last n_history FINISHED runs of the same script_name
+(see db_interface.get_cell_durations) and falls back to the mean duration of the cells executed so far.
+"""
+
+import contextlib
+import datetime
+import statistics
+import time
+
+from papermill.engines import NBClientEngine, papermill_engines
+
+from JupyRunner.core import helpers
+
+log = helpers.log
+
+ENGINE_NAME = 'jupyrunner_progress'
+
+enabled = True
+min_interval_sec = 5
+n_history = 10
+
+
+def setup(cnfg):
+    global enabled, min_interval_sec, n_history
+    cnfg_p = cnfg.get('progress', {}) or {}
+    enabled = bool(cnfg_p.get('enabled', enabled))
+    min_interval_sec = cnfg_p.get('min_interval_sec', min_interval_sec)
+    n_history = cnfg_p.get('n_history', n_history)
+
+
+def start(cnfg):
+    pass
+
+
+def _zulustr(t:float) -> str:
+    return helpers.make_zulustr(datetime.datetime.fromtimestamp(t, datetime.timezone.utc))
+
+
+def get_median_durations(runs:list[list]) -> list:
+    """the median duration per cell index over several runs (lists of seconds or None per cell)"""
+    n = max((len(r) for r in runs), default=0)
+    ret = []
+    for i in range(n):
+        values = [r[i] for r in runs if i < len(r) and r[i] is not None]
+        ret.append(statistics.median(values) if values else None)
+    return ret
+
+
+def get_eta(history:list, durations:dict, code_indices:list[int], index:int, elapsed_in_cell:float=0) -> float|None:
+    """the estimated seconds until all code cells after and including the current one (index) are done.
+
+    Args:
+        history (list): the typical duration per cell index of earlier runs (None where unknown)
+        durations (dict): cell index -> duration of the cells executed in this run
+        code_indices (list[int]): the indices of all code cells
+        index (int): the index of the current cell
+        elapsed_in_cell (float, optional): the seconds the current cell is already running. Defaults to 0.
+
+    Returns:
+        float|None: the seconds or None if there is neither a history nor an executed cell for some remaining cell
+    """
+    executed = [v for v in durations.values() if v is not None]
+    fallback = sum(executed) / len(executed) if executed else None
+    eta = 0.
+    for i in code_indices:
+        if i < index or (i == index and index in durations):
+            continue
+        expected = history[i] if i < len(history) and history[i] is not None else fallback
+        if expected is None:
+            return None
+        eta += max(expected - elapsed_in_cell, 0) if i == index else expected
+    return eta
+
+
+class ProgressReporter():
+    """builds the progress record (see module doc) from the cell hooks and publishes it with send (rate limited)"""
+
+    def __init__(self, send, history:list|None=None, min_interval_sec:float=5) -> None:
+        self.send = send
+        self.history = history or []
+        self.min_interval_sec = min_interval_sec
+        self.code_indices = []
+        self.durations = {}
+        self.index = -1
+        self.t_start = self.t_cell = None
+        self.t_sent = None
+
+    def start(self, cells:list):
+        self.code_indices = [i for i, c in enumerate(cells) if c.get('cell_type') == 'code']
+        self.t_start = self.t_cell = time.time()
+
+    def get_record(self, done:bool=False) -> dict:
+        now = time.time()
+        record = dict(
+            index=self.index,
+            cell=sum(1 for i in self.code_indices if i <= self.index),
+            n_cells=len(self.code_indices),
+            t_start=_zulustr(self.t_start),
+            t_cell=_zulustr(self.t_cell),
+            t_update=_zulustr(now),
+            elapsed_sec=round(now - self.t_start, 1),
+            eta_sec=0 if done else get_eta(self.history, self.durations, self.code_indices, self.index, now - self.t_cell),
+            done=done,
+        )
+        if record['eta_sec']:
+            record['eta_sec'] = round(record['eta_sec'], 1)
+        if done:
+            record['durations'] = [self.durations.get(i) for i in range(max(self.code_indices, default=-1) + 1)]
+        return record
+
+    def publish(self, force:bool=False, done:bool=False):
+        if not force and self.t_sent is not None and time.monotonic() - self.t_sent < self.min_interval_sec:
+            return
+        self.t_sent = time.monotonic()
+        try:
+            self.send(self.get_record(done=done))
+        except Exception as err:
+            log.warning(f'could not publish the progress: {err}')
+
+    def on_cell_start(self, cell, index:int):
+        self.index = index
+        self.t_cell = time.time()
+        self.publish(force=index == (self.code_indices[0] if self.code_indices else 0))
+
+    def on_cell_complete(self, cell, index:int):
+        if cell.get('cell_type') == 'code':
+            is_cached = cell.get('metadata', {}).get('jupyrunner', {}).get('cached')
+            self.durations[index] = None if is_cached else round(time.time() - self.t_cell, 3)
+        self.publish()
+
+    def finish(self):
+        self.publish(force=True, done=True)
+
+
+@contextlib.contextmanager
+def attach(nb_man, reporter:ProgressReporter|None):
+    """call the reporter from the cell hooks of a papermill NotebookExecutionManager while in the context"""
+    if reporter is None:
+        yield nb_man
+        return
+
+    cell_start, cell_complete = nb_man.cell_start, nb_man.cell_complete
+
+    def on_cell_start(cell, cell_index=None, **kwargs):
+        cell_start(cell, cell_index, **kwargs)
+        reporter.on_cell_start(cell, cell_index)
+
+    def on_cell_complete(cell, cell_index=None, **kwargs):
+        cell_complete(cell, cell_index, **kwargs)
+        reporter.on_cell_complete(cell, cell_index)
+
+    nb_man.cell_start, nb_man.cell_complete = on_cell_start, on_cell_complete
+    reporter.start(nb_man.nb.cells)
+    try:
+        yield nb_man
+    finally:
+        nb_man.cell_start, nb_man.cell_complete = cell_start, cell_complete
+        reporter.finish()
+
+
+def get_engine_kwargs(send, history:list|None=None) -> dict:
+    """the kwargs for papermill.execute_notebook to publish the progress with send (empty if disabled)"""
+    if not enabled:
+        return {}
+    return dict(engine_name=ENGINE_NAME, progress_reporter=ProgressReporter(send, history=history, min_interval_sec=min_interval_sec))
+
+
+class ProgressEngine(NBClientEngine):
+    """the default papermill engine with a ProgressReporter (select with engine_name=ENGINE_NAME)"""
+
+    @classmethod
+    def execute_managed_notebook(cls, nb_man, kernel_name, progress_reporter=None, **kwargs):
+        with attach(nb_man, progress_reporter):
+            return super().execute_managed_notebook(nb_man, kernel_name, **kwargs)
+
+papermill_engines.register(ENGINE_NAME, ProgressEngine)
@@ -0,0 +1,212 @@
+"""
+content addressed cache for the HTML renders of notebooks, shared by the runner, /show and trigger_upload.
+
+A render is stored as <default_dir>/<key[:2]>/<key>.html where the key is the sha256 of the notebook file content
+and the exporter settings (exporter, nbconvert version and exporter_kwargs), so a notebook is converted only once
+no matter which path asks for it first. Hits refresh the mtime of the file and the least recently used renders are
+deleted once the cache grows beyond max_size_mb. The cache directory is only walked by evict (on start, as a housekeeping
+task and once the running size total of the renders added since exceeds max_size_mb), not on every render.
+
+Renders can run in a process pool (n_workers) so neither the event loop of the server nor the threads calling them
+are blocked by nbconvert holding the GIL.
+"""
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+
+import nbconvert
+
+from JupyRunner.core import helpers
+
+log = helpers.log
+
+default_dir = ''
+max_size_mb = 500
+evict_interval_sec = 600
+n_workers = 2
+start_method = 'spawn'
+exporter_kwargs = {}
+
+_executor = None
+_lock = threading.Lock()
+
+size_total = None # bytes in the cache as of the last evict plus the renders added since (None before the first evict)
+_size_lock = threading.Lock()
+
+
+def setup(cnfg):
+    global default_dir, max_size_mb, evict_interval_sec, n_workers, start_method, exporter_kwargs
+    cnfg_rc = cnfg.get('render_cache', {}) or {}
+    default_dir = cnfg.get('pathes', {}).get('default_dir_rendercache', os.path.join(cnfg.get('pathes', {}).get('default_dir_meas', ''), '_rendercache'))
+    max_size_mb = cnfg_rc.get('max_size_mb', max_size_mb)
+    evict_interval_sec = cnfg_rc.get('evict_interval_sec', evict_interval_sec)
+    n_workers = cnfg_rc.get('n_workers', n_workers)
+    start_method = cnfg_rc.get('start_method', start_method)
+    exporter_kwargs = cnfg_rc.get('exporter_kwargs', exporter_kwargs) or {}
+
+
+def start(cnfg):
+    evict()
+
+
+def get_executor() -> concurrent.futures.ProcessPoolExecutor|None:
+    """the process pool for renders (started on first use), None if n_workers <= 0"""
+    global _executor
+    if n_workers <= 0:
+        return None
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context(start_method))
+        return _executor
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def get_settings() -> dict:
+    return {'exporter': 'HTMLExporter', 'nbconvert': nbconvert.__version__, 'exporter_kwargs': exporter_kwargs}
+
+
+def get_key(content:bytes, settings:dict) -> str:
+    h = hashlib.sha256(content)
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def get_path(key:str, cache_dir:str='') -> str:
+    return os.path.join(cache_dir or default_dir, key[:2], key + '.html')
+
+
+def lookup(key:str) -> str|None:
+    """the cached render for the key (and mark it as recently used) or None"""
+    path = get_path(key)
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            html_data = fp.read()
+    except OSError:
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return html_data
+
+
+def _render(content:bytes, settings:dict, cache_dir:str, key:str) -> str:
+    """convert a notebook to HTML and store it in the cache (runs in the process pool, so only uses its arguments)"""
+    import nbformat
+    nb = nbformat.reads(content.decode('utf-8'), as_version=4)
+    html_data, _ = nbconvert.HTMLExporter(**settings.get('exporter_kwargs', {})).from_notebook_node(nb)
+    if cache_dir:
+        path = get_path(key, cache_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            fp.write(html_data)
+        os.replace(tmp, path)
+    return html_data
+
+
+def _prepare(path:str) -> tuple[bytes, dict, str, str|None]:
+    with open(path, 'rb') as fp:
+        content = fp.read()
+    settings = get_settings()
+    key = get_key(content, settings)
+    return content, settings, key, lookup(key)
+
+
+def render_html(path:str, use_pool:bool=False) -> str:
+    """the HTML render of the notebook at path from the cache or converted now (in the process pool if use_pool)"""
+    content, settings, key, html_data = _prepare(path)
+    if html_data is not None:
+        log.debug(f'render cache hit for {path=}')
+        return html_data
+
+    executor = get_executor() if use_pool else None
+    if executor is None:
+        html_data = _render(content, settings, default_dir, key)
+    else:
+        html_data = executor.submit(_render, content, settings, default_dir, key).result()
+    log.debug(f'rendered {path=} to the render cache')
+    if _add_size(key):
+        evict()
+    return html_data
+
+
+async def render_html_async(path:str) -> str:
+    """as render_html, but without blocking the event loop (the conversion runs in the process pool)"""
+    loop = asyncio.get_running_loop()
+    content, settings, key, html_data = await loop.run_in_executor(None, _prepare, path)
+    if html_data is not None:
+        log.debug(f'render cache hit for {path=}')
+        return html_data
+
+    html_data = await loop.run_in_executor(get_executor(), _render, content, settings, default_dir, key)
+    log.debug(f'rendered {path=} to the render cache')
+    if _add_size(key):
+        await loop.run_in_executor(None, evict)
+    return html_data
+
+
+def _add_size(key:str) -> bool:
+    """add a new render to the running size total and return True if the cache has grown beyond max_size_mb. 
+    Processes which never walked the cache (e.G. the jobs) leave the eviction to the server"""
+    global size_total
+    try:
+        size = os.path.getsize(get_path(key))
+    except OSError:
+        return False
+    with _size_lock:
+        if size_total is None:
+            return False
+        size_total += size
+        return size_total > max_size_mb * 1024**2
+
+
+def evict(max_bytes:float|None=None) -> list[str]:
+    """delete the least recently used renders until the cache is below max_bytes (defaults to max_size_mb)"""
+    global size_total
+    max_bytes = max_size_mb * 1024**2 if max_bytes is None else max_bytes
+    if not default_dir:
+        return []
+    if not os.path.isdir(default_dir):
+        with _size_lock:
+            size_total = 0
+        return []
+
+    files = []
+    for root, _, names in os.walk(default_dir):
+        for name in names:
+            if name.endswith('.html'):
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+
+    total = sum(f[1] for f in files)
+    removed = []
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+    with _size_lock:
+        size_total = total
+    if removed:
+        log.info(f'evicted N={len(removed)} renders from the render cache')
+    return removed
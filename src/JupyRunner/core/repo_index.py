@@ -0,0 +1,284 @@
+"""
+persistent index of the notebooks in the script repository (default_dir_repo).
+
+Maps each notebook path to its mtime, size and info (script_name, script_version and papermill parameters, see
+helpers_papermill.get_info) and is stored as a sidecar JSON file (filepath). Only new and changed files (by mtime
+and size) are inspected again, either by the periodic rescan (refresh, registered as a housekeeping task) or
+immediately for the changed files reported by a file watcher, if "watchdog" is installed. Cold scans (e.G. of a
+fresh server or after a bulk "git pull" into the repo) inspect the notebooks in a process pool (n_workers).
+Lookups of notebooks the index does not know yet (find, get_info) refresh it right away.
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from JupyRunner.core import helpers, helpers_papermill
+
+log = helpers.log
+
+repo_dir = ''
+filepath = ''
+rescan_interval_sec = 60
+use_watcher = True
+n_workers = 4
+min_parallel = 32
+start_method = 'spawn'
+ext = '.ipynb'
+
+status = dict(running=False, n_total=0, n_done=0, t_start=None, n_indexed=0, t_last_refresh=None, dt_last_refresh=None)
+
+_index = {}
+_scanned = False
+_lock = threading.RLock()
+_refresh_lock = threading.Lock()
+_observer = None
+
+
+def setup(cnfg):
+    global repo_dir, filepath, rescan_interval_sec, use_watcher, n_workers, min_parallel, start_method
+    cnfg_ri = cnfg.get('repo_index', {}) or {}
+    pathes = cnfg.get('pathes', {})
+    repo_dir = pathes.get('default_dir_repo', repo_dir)
+    filepath = cnfg_ri.get('filepath', os.path.join(pathes.get('default_dir_meas', ''), '_repo_index.json'))
+    rescan_interval_sec = cnfg_ri.get('rescan_interval_sec', rescan_interval_sec)
+    use_watcher = bool(cnfg_ri.get('use_watcher', use_watcher))
+    n_workers = min(int(cnfg_ri.get('n_workers', n_workers)), os.cpu_count() or 1) # more would only compete for the cores
+    min_parallel = cnfg_ri.get('min_parallel', min_parallel)
+    start_method = cnfg_ri.get('start_method', start_method)
+
+
+def start(cnfg):
+    load()
+    refresh()
+    if use_watcher:
+        start_watcher()
+
+
+def load():
+    global _index
+    try:
+        with open(filepath, 'r', encoding='utf-8') as fp:
+            dc = json.load(fp)
+    except (OSError, ValueError):
+        return
+    if dc.get('repo_dir') == repo_dir:
+        with _lock:
+            _index = dc.get('scripts', {})
+
+
+def save():
+    if not filepath:
+        return
+    with _lock:
+        dc = {'repo_dir': repo_dir, 't_last': helpers.now_iso(), 'scripts': _index}
+        tmp = filepath + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+            with open(tmp, 'w', encoding='utf-8') as fp:
+                json.dump(dc, fp)
+            os.replace(tmp, filepath)
+        except OSError as err:
+            log.warning(f'could not save the repo index to {filepath=}: {err}')
+
+
+def is_notebook(path:str) -> bool:
+    name = os.path.basename(path)
+    return name.endswith(ext) and not name.startswith('.') and not name.endswith('-checkpoint' + ext)
+
+
+def _is_current(entry:dict|None, st:os.stat_result) -> bool:
+    return bool(entry) and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size
+
+
+def _inspect(path:str) -> tuple[str, dict|None]:
+    """the index entry for one notebook or None if it can not be read (runs in the process pool, errors stay per file)"""
+    try:
+        st = os.stat(path)
+        return path, dict(mtime=st.st_mtime, size=st.st_size, info=helpers_papermill.get_info(path))
+    except OSError:
+        return path, None
+    except Exception as err:
+        log.error(f'ERROR while indexing notebook {path=}: {err}')
+        return path, dict(mtime=st.st_mtime, size=st.st_size, info={'script_name': os.path.basename(path), 'script_version': '', 'params': {'ERROR': str(err)}})
+
+
+def inspect_many(paths:list[str]):
+    """yield the index entries (see _inspect) for many notebooks, in a process pool of n_workers if there are at least
+    min_parallel of them, and keep track of the progress in the scan status (see get_status)"""
+    status.update(running=True, n_total=len(paths), n_done=0, t_start=helpers.now_iso())
+    t_log = time.monotonic()
+    pending = set(paths)
+    try:
+        if n_workers > 0 and len(paths) >= max(min_parallel, 2):
+            log.info(f'repo index: inspecting N={len(paths)} notebooks with {n_workers=}')
+            try:
+                ctx = multiprocessing.get_context(start_method)
+                with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx) as executor:
+                    chunksize = max(1, len(paths) // (4 * n_workers))
+                    for path, entry in executor.map(_inspect, paths, chunksize=chunksize):
+                        pending.discard(path)
+                        status['n_done'] += 1
+                        if time.monotonic() - t_log > 5:
+                            t_log = time.monotonic()
+                            log.info(f"repo index: inspected {status['n_done']}/{len(paths)} notebooks")
+                        yield path, entry
+            except Exception as err:
+                log.warning(f'repo index: the process pool failed ({err!r}), inspecting the remaining N={len(pending)} notebooks serially')
+
+        for p in [p for p in paths if p in pending]:
+            status['n_done'] += 1
+            yield _inspect(p)
+    finally:
+        status['running'] = False
+
+
+def _update(path:str) -> bool:
+    """inspect one notebook again if it changed and return whether the index changed"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return _index.pop(path, None) is not None
+    if _is_current(_index.get(path), st):
+        return False
+    _, entry = _inspect(path)
+    if entry is None:
+        return _index.pop(path, None) is not None
+    _index[path] = entry
+    return True
+
+
+def refresh(paths:list[str]|None=None) -> int:
+    """update the index for the given paths (or rescan the whole repo) and return the number of changed entries"""
+    with _refresh_lock: # no concurrent scans
+        return _refresh(paths)
+
+
+def _refresh(paths:list[str]|None) -> int:
+    global _scanned
+    t0 = time.monotonic()
+    is_full = paths is None
+    if is_full:
+        found = set()
+        for root, _, files in os.walk(repo_dir): # outside of the lock, since the repo may be on a slow mount
+            found.update(os.path.join(root, f).replace('\\', '/') for f in files if is_notebook(f))
+
+    n = 0
+    todo = []
+    with _lock:
+        if is_full:
+            paths = found | set(_index)
+        for p in sorted(paths):
+            if not is_notebook(p):
+                continue
+            try:
+                st = os.stat(p)
+            except OSError:
+                n += _index.pop(p, None) is not None
+                continue
+            if not _is_current(_index.get(p), st):
+                todo.append(p)
+
+    # the inspection runs outside of the lock so the index can be served meanwhile
+    entries = dict(inspect_many(todo)) if todo else {}
+
+    with _lock:
+        for p, entry in entries.items():
+            if entry is None:
+                n += _index.pop(p, None) is not None
+            else:
+                _index[p] = entry
+                n += 1
+        _scanned = _scanned or is_full
+        status.update(n_indexed=len(_index), t_last_refresh=helpers.now_iso(), dt_last_refresh=round(time.monotonic() - t0, 3))
+        if n:
+            log.info(f'repo index: N={n} notebooks changed')
+            save()
+    return n
+
+
+def get_status() -> dict:
+    """the state of the index and the progress of the current (or last) inspection"""
+    return dict(status, repo_dir=repo_dir, watcher=_observer is not None)
+
+
+def get_scripts() -> dict[str, dict]:
+    """notebook path -> info (see helpers_papermill.get_info) for all notebooks in the repo"""
+    if not _scanned:
+        refresh()
+    with _lock:
+        return {k: v['info'] for k, v in sorted(_index.items())}
+
+
+def find(name:str) -> str|None:
+    """the path of the first notebook whose file name contains name. The repo is rescanned once on a miss, 
+    so new notebooks are found before the next periodic rescan (or without the watcher)"""
+    for i in range(2):
+        for path in get_scripts():
+            if name in os.path.basename(path):
+                return path
+        if i == 0:
+            refresh()
+    return None
+
+
+def get_info(path:str) -> dict:
+    """helpers_papermill.get_info for a single notebook, from the index if it is unchanged"""
+    path = path.replace('\\', '/')
+    with _lock:
+        if path in _index and _update(path):
+            save()
+        if path in _index:
+            return _index[path]['info']
+    if _is_in_repo(path) and is_notebook(path) and os.path.exists(path):
+        refresh([path]) # a new notebook the last scan missed
+        with _lock:
+            if path in _index:
+                return _index[path]['info']
+    return helpers_papermill.get_info(path)
+
+
+def _is_in_repo(path:str) -> bool:
+    if not repo_dir:
+        return False
+    return os.path.abspath(path).startswith(os.path.abspath(repo_dir).rstrip(os.sep) + os.sep)
+
+
+def start_watcher():
+    """refresh the changed notebooks on file system events (needs the optional package "watchdog")"""
+    global _observer
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        log.info(f'"watchdog" is not installed, the repo index is only rescanned every {rescan_interval_sec=}')
+        return None
+    if _observer is not None or not os.path.isdir(repo_dir):
+        return _observer
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory and event.event_type in ['moved', 'deleted']:
+                refresh()
+                return
+            paths = [getattr(event, 'src_path', ''), getattr(event, 'dest_path', '')]
+            paths = [p.replace('\\', '/') for p in paths if p and is_notebook(p)]
+            if paths:
+                refresh(paths)
+
+    _observer = Observer()
+    _observer.daemon = True
+    _observer.schedule(Handler(), repo_dir, recursive=True)
+    _observer.start()
+    log.info(f'watching {repo_dir=} for changed notebooks')
+    return _observer
+
+
+def stop_watcher():
+    global _observer
+    if _observer is not None:
+        _observer.stop()
+        _observer = None
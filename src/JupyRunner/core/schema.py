@@ -1,3 +1,4 @@
+import copy
 import enum, json, datetime
 import hashlib
 import os, sys
@@ -6,8 +7,9 @@ import re
 
 from typing import Optional, List
 from sqlmodel import Field, SQLModel, Relationship, Enum, String, Column, JSON
+from sqlalchemy import Index
 
-from JupyRunner.core import helpers
+from JupyRunner.core import helpers, helpers_cron
 import JupyRunner.core.filesys_storage_api as filesys
 
 STATUS_DICT = {
@@ -26,7 +28,8 @@ STATUS_DICT = {
     "CANCELLED": 1001,
     "FAILED": 1000,
     "FAULTY": 1002,
-    "POST_PROC_FAILED": 1003
+    "POST_PROC_FAILED": 1003,
+    "EXPIRED": 1004
 }
 
 STATUS_MEAS_DICT = {
@@ -61,6 +64,7 @@ class STATUS(enum.StrEnum):
     CANCELLED = "CANCELLED"
     FAILED = "FAILED"
     FAULTY = "FAULTY"
+    EXPIRED = "EXPIRED"
 
 status_dc = {str(s.name): STATUS_DICT[s.name] for s in STATUS}
 
@@ -119,11 +123,32 @@ class Device(SQLModel, table=True):
     def append_error_msg(self, err):
         self.errors += '\n' + str(err)
 
+    def get_max_concurrent(self, default:int=1) -> int:
+        """max number of scripts which may use this device at the same time (data_json key "max_concurrent", <= 0 for unlimited)"""
+        dc = self.data_json if self.data_json else {}
+        try:
+            return int(dc.get('max_concurrent', default))
+        except (TypeError, ValueError):
+            return default
+
 def get_default_params():
     return {'follow_up_script' : {'script_in_path': '', 'script_params_json': {}}}
 
-class Script(SQLModel, table=True):
+def get_params_hash(params:dict|None) -> str:
+    """sha256 over the canonical JSON (sorted keys, no whitespace) of script parameters without the follow_up_script, 
+    which does not change the result of the script itself"""
+    params = {k: v for k, v in (params or {}).items() if k != 'follow_up_script'}
+    s = json.dumps(params, sort_keys=True, separators=(',', ':'), ensure_ascii=True, default=json_serial)
+    return hashlib.sha256(s.encode()).hexdigest()
 
+class Script(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_script_status_start_condition', 'status', 'start_condition'), # queue and qry_scripts
+        Index('ix_script_start_condition', 'start_condition'),
+        Index('ix_script_device_id_status', 'device_id', 'status'), # device locks
+        Index('ix_script_status_lease_expires', 'status', 'lease_expires'), # reaper
+        Index('ix_script_script_name_status_time_finished', 'script_name', 'status', 'time_finished'), # cell durations
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     script_name: str = Field(default='', max_length=255, nullable=False)
@@ -151,6 +176,18 @@ class Script(SQLModel, table=True):
 
     papermill_json: Optional[dict] = Field(sa_column=Column(JSON))
     data_json: Optional[dict] = Field(sa_column=Column(JSON), default_factory=lambda: {})
+    progress_json: Optional[dict] = Field(sa_column=Column(JSON), default=None)
+
+    priority: int = Field(default=0, nullable=False)
+    pipeline_id: Optional[int] = Field(default=None, nullable=True, index=True)
+    batch_id: Optional[str] = Field(default=None, max_length=64, nullable=True, index=True)
+    params_hash: Optional[str] = Field(default=None, max_length=64, nullable=True, index=True)
+    submitter: Optional[str] = Field(default=None, max_length=255, nullable=True)
+
+    claimed_by: Optional[str] = Field(default=None, max_length=255, nullable=True)
+    lease_expires: Optional[datetime.datetime] = Field(default=None, nullable=True)
+    last_heartbeat: Optional[datetime.datetime] = Field(default=None, nullable=True)
+    retries: int = Field(default=0, nullable=False)
 
     last_time_changed: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
 
@@ -223,6 +260,10 @@ class Script(SQLModel, table=True):
             self.script_version = hashlib.md5(f.read()).hexdigest() + '_' + dtlast_change
         return self.script_version
     
+    def set_params_hash(self):
+        self.params_hash = get_params_hash(self.script_params_json)
+        return self.params_hash
+
 
     def set_script_out_path(self, force_overwrite=False):
         # BUG: There is some form of bug here with the default script dir folder, but it seems to be working for now (somehow)!
@@ -265,6 +306,93 @@ class Script(SQLModel, table=True):
     def append_error_msg(self, err):
         self.errors += '\n' + str(err)
 
+    def test_for_runner(self, runner_id:str|None=None, runner_ip:str|None=None) -> bool:
+        """test whether or not a runner with the given id (None for the default runner) or ip should run this script"""
+        dc = self.data_json if self.data_json else {}
+
+        def test(req_runner_id, my_runner_id):
+            if my_runner_id is None: # default runner
+                return req_runner_id is None # --> can run only if no specific runner is needed
+            else: # specific runner
+                return req_runner_id == my_runner_id # --> yep I am the one who should run this
+
+        if test(dc.get('runner_id', None), runner_id):
+            return True
+        return runner_ip is not None and test(dc.get('runner_ip', dc.get('runner_id', None)), runner_ip)
+    
+    def get_slot_cost(self) -> int:
+        """the number of runner slots this script occupies while running (data_json key "slot_cost", defaults to 1, at least 1)"""
+        dc = self.data_json if self.data_json else {}
+        try:
+            return max(int(dc.get('slot_cost', 1)), 1) # a free job would let a runner start an unlimited number of them
+        except (TypeError, ValueError):
+            return 1
+
+    def get_deadline(self, max_runtime_sec:float=0, t_start:datetime.datetime|None=None) -> datetime.datetime:
+        """the time at which a started script has to be terminated: its end_condition or t_start + max runtime 
+        (data_json key "max_runtime_sec", falls back to max_runtime_sec, <= 0 for none), whatever is earlier"""
+        dc = self.data_json if self.data_json else {}
+        try:
+            max_runtime_sec = float(dc.get('max_runtime_sec', max_runtime_sec) or 0)
+        except (TypeError, ValueError):
+            pass
+        deadline = self.end_condition
+        if deadline.tzinfo is not None:
+            deadline = deadline.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        if max_runtime_sec > 0:
+            t_start = helpers.get_utcnow() if t_start is None else t_start
+            deadline = min(deadline, t_start + datetime.timedelta(seconds=max_runtime_sec))
+        return deadline
+
+    def get_max_retries(self, default:int=0) -> int:
+        """how often this script is requeued if its runner died while running it (data_json key "max_retries")"""
+        dc = self.data_json if self.data_json else {}
+        try:
+            return max(int(dc.get('max_retries', default)), 0)
+        except (TypeError, ValueError):
+            return default
+
+    def get_memoize_ttl(self, default:float=0) -> float:
+        """the max age in seconds of an identical FINISHED run (same script_version and params_hash) which may be reused 
+        instead of running this script. Scripts opt in with data_json["memoize"] and can set data_json["memoize_ttl_sec"] 
+        (falls back to default). Scripts with a device are never memoized, since their result depends on the device state, 
+        unless data_json["device_independent"] is set. Returns 0 if the script can not be memoized"""
+        dc = self.data_json if self.data_json else {}
+        if not dc.get('memoize') or (self.device_id and not dc.get('device_independent')):
+            return 0
+        try:
+            return max(float(dc.get('memoize_ttl_sec', default) or 0), 0)
+        except (TypeError, ValueError):
+            return default
+
+    def get_progress(self, now:datetime.datetime|None=None) -> dict:
+        """the live progress record of the run (see JupyRunner.core.progress) with elapsed_sec and eta_sec extrapolated 
+        from the last update to now and the seconds the current cell is running (cell_sec). Empty if there is none"""
+        dc = dict(self.progress_json) if self.progress_json else {}
+        if not dc or dc.get('done') or not self.status in ['RUNNING', 'CANCELLING']:
+            return dc
+        now = helpers.get_utcnow() if now is None else now
+        try:
+            age = max((now - helpers.parse_zulutime(dc['t_update'])).total_seconds(), 0)
+            dc['cell_sec'] = round(max((now - helpers.parse_zulutime(dc['t_cell'])).total_seconds(), 0), 1)
+        except (KeyError, TypeError, ValueError):
+            return dc
+        dc['elapsed_sec'] = round(dc.get('elapsed_sec', 0) + age, 1)
+        if dc.get('eta_sec') is not None:
+            dc['eta_sec'] = round(max(dc['eta_sec'] - age, 0), 1)
+        return dc
+
+    def get_progress_str(self, now:datetime.datetime|None=None) -> str:
+        """a short text like "cell 3/12 | 1:05 | ETA 0:40" for the progress of a running script (empty if there is none)"""
+        dc = self.get_progress(now)
+        if not dc or dc.get('done') or not self.status in ['RUNNING', 'CANCELLING']:
+            return ''
+        fmt = lambda sec: str(datetime.timedelta(seconds=int(sec)))
+        s = f"cell {dc.get('cell', '?')}/{dc.get('n_cells', '?')} | {fmt(dc.get('elapsed_sec', 0))}"
+        if dc.get('eta_sec') is not None:
+            s += f" | ETA {fmt(dc['eta_sec'])}"
+        return s
+
     def test_for_start_condition(self):
         if self.start_condition:
             tstart = self.start_condition
@@ -276,8 +404,8 @@ class Script(SQLModel, table=True):
 
 class Datafile(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    script_id: int = Field(nullable=False, foreign_key="script.id")
-    device_id: str = Field(max_length=255, nullable=True, foreign_key="device.id")
+    script_id: int = Field(nullable=False, foreign_key="script.id", index=True)
+    device_id: str = Field(max_length=255, nullable=True, foreign_key="device.id", index=True)
     filename: str = Field(max_length=255, nullable=False, default="")
 
     tags: List[str] = Field(sa_column=Column(JSON), default_factory=lambda: [])
@@ -313,6 +441,90 @@ class ProjectVariable(SQLModel, table=True):
     def append_error_msg(self, err):
         self.errors += '\n' + str(err)
 
-schema_dc = {cls.__name__: cls.__tablename__ for cls in [Script, Datafile, ProjectVariable, Device]}
-schema_cls_dc = {cls: cls.__tablename__ for cls in [Script, Datafile, ProjectVariable, Device]}
+class Pipeline(SQLModel, table=True):
+    """a DAG of scripts. Each stage (instance) is one script, which is held until all its parents have FINISHED"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(default='', max_length=255, nullable=False)
+    status: STATUS = Field(default=STATUS.RUNNING)
+
+    stages_json: Optional[dict] = Field(sa_column=Column(JSON), default_factory=lambda: {})
+    deps_json: Optional[dict] = Field(sa_column=Column(JSON), default_factory=lambda: {})
+    script_ids_json: Optional[dict] = Field(sa_column=Column(JSON), default_factory=lambda: {})
+
+    errors: str = Field(default='', nullable=False)
+    comments: str = Field(default='', nullable=False)
+    time_initiated: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
+    time_finished: Optional[datetime.datetime] = Field(default=None, nullable=True)
+    last_time_changed: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
+
+    def append_error_msg(self, err):
+        self.errors += '\n' + str(err)
+
+    def get_children(self, instance:str) -> list[str]:
+        return [k for k, parents in (self.deps_json or {}).items() if instance in parents]
+
+    def get_descendants(self, instance:str) -> list[str]:
+        ret, todo = [], self.get_children(instance)
+        while todo:
+            k = todo.pop(0)
+            if not k in ret:
+                ret.append(k)
+                todo += self.get_children(k)
+        return ret
+
+
+class Schedule(SQLModel, table=True):
+    """a recurring job. Each time next_fire has passed a new Script is created from template_json"""
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(default='', max_length=255, nullable=False)
+    enabled: bool = Field(default=True, nullable=False)
+
+    cron: str = Field(default='', max_length=255, nullable=False)
+    interval_sec: float = Field(default=0, nullable=False)
+    
+    template_json: Optional[dict] = Field(sa_column=Column(JSON), default_factory=lambda: {'script_in_path': '', 'script_params_json': {}})
+
+    next_fire: Optional[datetime.datetime] = Field(default=None, nullable=True, index=True)
+    last_fire: Optional[datetime.datetime] = Field(default=None, nullable=True)
+    last_script_id: Optional[int] = Field(default=None, nullable=True)
+    n_fired: int = Field(default=0, nullable=False)
+
+    comments: str = Field(default='', nullable=False)
+    time_initiated: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
+    last_time_changed: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
+
+    def validate_trigger(self):
+        assert bool(self.cron) != bool(self.interval_sec and self.interval_sec > 0), f'need to give either "cron" or "interval_sec" for a schedule but got {self.cron=} {self.interval_sec=}'
+        if self.cron:
+            helpers_cron.CronExpr(self.cron)
+        assert (self.template_json or {}).get('script_in_path'), 'need to give "script_in_path" in "template_json"!'
+
+    def get_next_fire(self, after:datetime.datetime|None=None) -> datetime.datetime:
+        after = helpers.get_utcnow() if after is None else after
+        return helpers_cron.get_next_fire(after, cron=self.cron, interval_sec=self.interval_sec, t_start=self.time_initiated)
+
+    def make_script(self, t_fire:datetime.datetime) -> Script:
+        """construct a new script from the template (not committed yet)"""
+        kwargs = {k:v for k, v in copy.deepcopy(self.template_json or {}).items() if not k in ['id', 'status', 'start_condition']}
+        kwargs['data_json'] = {**(kwargs.get('data_json') or {}), 'schedule_id': self.id}
+        script = Script(**kwargs)
+        script.submitter = script.submitter or f'schedule:{self.name or self.id}'
+        script.start_condition = t_fire
+        if script.end_condition <= t_fire:
+            script.end_condition = t_fire + datetime.timedelta(hours=7*24)
+        return script
+
+class SchemaMigration(SQLModel, table=True):
+    """one applied migration of the DB (see db_interface.MIGRATIONS)"""
+
+    version: int = Field(primary_key=True)
+    name: str = Field(default='', max_length=255, nullable=False)
+    time_applied: datetime.datetime = Field(nullable=False, default_factory=helpers.get_utcnow)
+    dt_sec: float = Field(default=0, nullable=False)
+
+
+schema_dc = {cls.__name__: cls.__tablename__ for cls in [Script, Datafile, ProjectVariable, Device, Schedule, Pipeline]}
+schema_cls_dc = {cls: cls.__tablename__ for cls in [Script, Datafile, ProjectVariable, Device, Schedule, Pipeline]}
 schema_cls_dc_inv = {v:k for k, v in schema_cls_dc.items()}
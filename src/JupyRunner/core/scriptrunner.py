@@ -3,10 +3,9 @@ import hashlib
 import json
 import time
 import papermill
-import nbconvert
 import os
 
-from JupyRunner.core import schema, api_interface, filesys_storage_api
+from JupyRunner.core import schema, api_interface, filesys_storage_api, helpers_papermill, kernel_pool, cell_cache, progress, render_cache
 from JupyRunner.core.schema import Script, STATUS
 from JupyRunner.core.helpers import log, get_utcnow, make_zulustr, now_iso
 from JupyRunner.core import helpers_mattermost
@@ -20,6 +19,7 @@ full_api = None
 var_api = None
 dfi_api = None
 device_api = None
+batcher = None
 
 def send_mattermost_failed(script:Script, err: Exception):
     s = ''
@@ -34,8 +34,12 @@ def send_mattermost_status(script:Script):
 def setup(cnfg):
     api_interface.setup(cnfg)
     helpers_mattermost.setup(cnfg)
+    kernel_pool.setup(cnfg)
+    cell_cache.setup(cnfg)
+    progress.setup(cnfg)
+    render_cache.setup(cnfg)
 
-    global config, api, url, full_api, var_api, dfi_api, device_api
+    global config, api, url, full_api, var_api, dfi_api, device_api, batcher
     config = cnfg
 
     
@@ -46,10 +50,15 @@ def setup(cnfg):
     device_api = api_interface.DeviceClient(url)
     var_api = api_interface.ProjectVariableClient(url)
     full_api = api_interface.APIClient(url)
+    cnfg_http = config.get('http', {})
+    batcher = api_interface.PatchBatcher(api, max_n=cnfg_http.get('batch_max_n', 50), max_delay=cnfg_http.get('batch_max_delay_sec', 0.5))
 
 def start(cnfg):
     api_interface.start(cnfg)
     helpers_mattermost.start(cnfg)
+    cell_cache.start(cnfg)
+    progress.start(cnfg)
+    render_cache.start(cnfg)
 
     global config
     config = cnfg
@@ -77,6 +86,7 @@ def _pre(script:Script, is_test=False):
     
     script.set_script_name()
     script.set_script_version()
+    script.set_params_hash()
     script.set_script_out_path()
     if not is_test:
         script = commit(script)
@@ -123,6 +133,23 @@ def _pre(script:Script, is_test=False):
 
     return script, all_params
 
+def complete_from_cache(script:Script) -> Script|None:
+    """let the server complete a script which opted in for memoization (data_json["memoize"]) with the results of an 
+    identical earlier run and post its follow up script. Returns None if it has to be run"""
+    if not (script.data_json or {}).get('memoize'):
+        return None
+    
+    memo = api.memoize(script.id)
+    if memo is None:
+        return None
+    
+    log.info(f"Script {script.id}: completed from the cached run {memo.data_json.get('memoized_from')}")
+    try:
+        init_follow_up_script(memo)
+    except Exception as err:
+        log.error(f'ERROR while posting the follow up script of memoized script {script.id}: {err}')
+    return memo
+
 def pre_check(script:Script):
     dummy_script = Script(**script.model_dump())
     dummy_script.id = time.time_ns()
@@ -145,6 +172,30 @@ def init_follow_up_script(script):
     
     return None
 
+def get_progress_kwargs(script:Script) -> dict:
+    """the papermill kwargs to publish the live progress of the script to its progress_json (see JupyRunner.core.progress)"""
+    if not progress.enabled:
+        return {}
+    try:
+        history = api.get_cell_durations(script.script_name, n_last=progress.n_history)
+    except Exception as err:
+        log.warning(f'Script {script.id}: could not get the cell durations of earlier runs for the ETA: {err}')
+        history = []
+    return progress.get_engine_kwargs(lambda record: batcher.patch(script.id, progress_json=record), history=history)
+
+def flush_patches():
+    """send the batched patches now (errors are logged and the patches are kept for the next flush)"""
+    try:
+        batcher.flush()
+    except Exception as err:
+        log.warning(f'could not send the batched patches: {err}')
+
+def run_job(script_id:int):
+    """runs the script with the given id and posts its follow up script (everything a single job does)"""
+    script = run_script(script_id)
+    init_follow_up_script(script)
+    return script
+
 def run_script(script_id:int):
     """
     Runs a Jupyter script using Papermill and converts the output to HTML.
@@ -169,27 +220,33 @@ def run_script(script_id:int):
         log.info(f"Script {script.id}: Running")
         
         time.sleep(0.1)
-        script = set_prop_remote(script, status = STATUS.RUNNING, time_started = get_utcnow())
+        kernel_pool.raise_if_cancelled(script.id) # a cancelled thread job must not set it RUNNING again
+        script = set_prop_remote(script, status = STATUS.RUNNING, time_started = get_utcnow(), progress_json = {})
         assert script.status == STATUS.RUNNING, 'status was not set to running!'
         
         helpers_mattermost.send_mattermost(f'Script {script.id}: RUNNING with:  {script.script_in_path} (VER:{script.script_version}) -> {script.script_out_path}')
-        # Run the script using Papermill
-        nb = papermill.execute_notebook(
-            script.script_in_path,
-            script.script_out_path,
-            parameters=all_params,
-            kernel_name="python3"
-        )
+        # Run the script using Papermill (on a warm kernel from the pool if there is one)
+        with kernel_pool.get_kernel(owner=script.id) as km:
+            kwargs = {'km': km} if km is not None else {}
+            kwargs.update(get_progress_kwargs(script))
+            kwargs.update(cell_cache.get_engine_kwargs(script))
+            nb = papermill.execute_notebook(
+                script.script_in_path,
+                script.script_out_path,
+                parameters=all_params,
+                kernel_name="python3",
+                **kwargs
+            )
 
         log.info(f"Script {script.id}: Finished running with Papermill")
+        flush_patches() # the last progress record must not overwrite the commit below
 
         # Set script status to FINISHING
         script = set_prop_remote(script, status = STATUS.FINISHING)
         log.info(f"Script {script.id}: Finishing on")
 
-        # Convert the output notebook to HTML
-        html_exporter = nbconvert.HTMLExporter()
-        html_data, resources = html_exporter.from_filename(script.script_out_path)
+        # Convert the output notebook to HTML (through the render cache, which /show and trigger_upload share)
+        html_data = render_cache.render_html(script.script_out_path)
         new_out = script.script_out_path.replace(".ipynb", ".html")
         with open(new_out, "w", encoding='utf-8') as f:
             f.write(html_data)
@@ -197,6 +254,9 @@ def run_script(script_id:int):
         script.time_finished = get_utcnow()
 
         script.papermill_json = nb.get('metadata', {}).get('papermill', {})
+        outputs = helpers_papermill.get_outputs(nb)
+        if outputs:
+            script.data_json = {**(script.data_json or {}), 'outputs': outputs}
         err = nb.get('exception', '')
 
 
@@ -228,6 +288,7 @@ def run_script(script_id:int):
         return script
 
     except Exception as e:
+        flush_patches()
         raise
         log.error(f"Script {script.id}: Error running script: {e}")
         script.status = STATUS.ERROR
@@ -1,30 +1,32 @@
 
 from contextlib import asynccontextmanager
+import copy
 import datetime
 import json
 import os
 import subprocess
 import time
 import traceback
-from typing import Annotated, Any, Callable, Dict, List
+from typing import Annotated, Any, Callable, Dict, List, Literal
 import zipfile
-import nbconvert
+import itertools
+import uuid
 import pydocmaker as pyd
 import urllib.parse
 import asyncio
 
 from fastapi import FastAPI, Form, HTTPException, Path, Query, Request, Response, UploadFile, File
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.responses import FileResponse
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 from jinja2 import Environment, FileSystemLoader
 
 
 from JupyRunner.core import db_interface as dbi
-from JupyRunner.core import schema, helpers, filesys_storage_api, helpers_mattermost, helpers_papermill, scriptrunner
+from JupyRunner.core import schema, helpers, filesys_storage_api, helpers_mattermost, helpers_papermill, scriptrunner, dispatch_events, housekeeping, pipelines, render_cache, repo_index
 from JupyRunner.io import nextcloud_api, redmine_api, local_filesys_api
 import JupyRunner
 
@@ -43,7 +45,7 @@ with open('config.yaml', 'r') as fp:
 
 helpers.set_loglevel(config)
 
-modules = [dbi, filesys_storage_api, scriptrunner]
+modules = [dbi, filesys_storage_api, repo_index, scriptrunner, dispatch_events, housekeeping, pipelines]
 serializers = {
     'nextcloud': nextcloud_api,
     'redmine': redmine_api,
@@ -55,18 +57,45 @@ serializers_doc = {k:v for k, v in serializers.items()}
 for module in modules:
     module.setup(config)
 
-for module in modules:
-    module.start(config)
+redmine_api.setup(config['wiki_uploader'])
+filesys_storage_api.start(config) # the static mounts below need the directories
 
 
-redmine_api.setup(config['wiki_uploader'])
+def start_modules():
+    """start the DB, the repo index, the housekeeping thread and the serializers. Runs in the lifespan of the app and 
+    not on import, since the spawned workers of the render cache and repo index pools import this file again"""
+    global serializers
+    for module in modules:
+        module.start(config)
+
+    dbi.add_status_listener(dispatch_events.on_status_change)
+    dbi.add_status_listener(pipelines.on_status_change)
+
+    housekeeping.add_task('reap_expired_leases', dbi.reap_expired_leases, config.get('housekeeping', {}).get('reaper_interval_sec', 30))
+    housekeeping.add_task('materialize_schedules', dbi.materialize_schedules, config.get('housekeeping', {}).get('schedule_interval_sec', 10))
+    housekeeping.add_task('rescan_repo_index', repo_index.refresh, repo_index.rescan_interval_sec)
+    housekeeping.add_task('evict_render_cache', render_cache.evict, render_cache.evict_interval_sec)
+    housekeeping.add_task('expire_queued_scripts', dbi.expire_queued_scripts, config.get('housekeeping', {}).get('expire_interval_sec', 60))
 
+    serializers = {k:v.start(config) for k, v in serializers.items() if k in config.get('storage_locations')}
+    log.info('STARTED!')
 
-serializers = {k:v.start(config) for k, v in serializers.items() if k in config.get('storage_locations')}
 
-log.info('STARTED!')
+def stop_modules():
+    housekeeping.stop()
+    repo_index.stop_watcher()
+    render_cache.shutdown()
+    log.info('END!')
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_modules()
+    yield
+    stop_modules()
+
+
+app = FastAPI(lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")  # You can use this for more complex templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -80,20 +109,6 @@ app.mount("/libs", StaticFiles(directory=filesys_storage_api.default_dir_libs),
 feedback_requests = {}
 feedback_answers = {}
 
-# @asynccontextmanager
-# async def lifespan(app: FastAPI):
-#     global serializers
-
-#     log.info('STARTED!')
-
-#     yield
-
-#     for k, v in serializers.items():
-#         v.destruct()
-
-#     log.info('END!')
-
-
 @app.middleware("http")
 async def log_requests(request: Request, call_next: Callable) -> Response:
     log.debug(f"Received request: {request.method} {request.url}")
@@ -145,8 +160,16 @@ async def ui(page:str, request: Request):
 
 @app.get("/info")
 def info():
-    return {'t_started': t_started, 'schema': schema.schema_dc, 'sys_info': helpers.get_sys_info()}
+    return {'t_started': t_started, 'schema': schema.schema_dc, 'sys_info': helpers.get_sys_info(), 'housekeeping': housekeeping.get_info(), 'repo_index': repo_index.get_status(), 'db': dbi.get_db_info()}
+
+
 
+@app.get("/events/wait")
+async def events_wait(since:int|None=Query(default=None, description='the last event seq number seen by the client. Omit to get the current seq number immediately'),
+                timeout:float=Query(default=30, description='max time in seconds to block before returning without any new events')):
+    """long polling endpoint for the procservers. Blocks until any script entered a status which needs a runner (or timeout). 
+    Waits on the event loop, so the waiting runners do not use up the threadpool of the sync endpoints"""
+    return await dispatch_events.await_events(since, timeout)
 
 
 @app.get("/ping")
@@ -297,11 +320,48 @@ def get_script_full(script_id):
         dc['datafiles'] = [d.model_dump() for d in obj.datafiles]
     return dc
 
+
+@app.get("/script/{script_id}/log", response_model=None)
+async def get_script_log(script_id: int,
+                         tail:int = Query(default=10_000, description='max number of bytes to return from the end of the log'),
+                         follow:bool = Query(default=False, description='keep the connection open and stream new output as server sent events until the script has ended'),
+                         t_poll:float = Query(default=1.0, description='interval in seconds to check for new output if follow is set')):
+    """get the stdout/stderr log of a script (also while it is still running)"""
+    obj = await asyncio.to_thread(dbi.get, schema.Script, script_id)
+    if not obj:
+        raise HTTPException(status_code=404, detail="Script not found")
+
+    # the file and db reads run in threads, so the event loop keeps serving the other requests
+    data, offset = await asyncio.to_thread(filesys_storage_api.read_log_tail, script_id, tail)
+    if not follow:
+        return PlainTextResponse(data.decode('utf-8', errors='replace'))
+
+    def to_sse(data:bytes, event='log'):
+        lines = data.decode('utf-8', errors='replace').splitlines() or ['']
+        return f'event: {event}\n' + ''.join(f'data: {line}\n' for line in lines) + '\n'
+
+    async def stream(data, offset):
+        if data:
+            yield to_sse(data)
+        while True:
+            await asyncio.sleep(max(0.1, t_poll))
+            data, offset = await asyncio.to_thread(filesys_storage_api.read_log_tail, script_id, tail, offset)
+            if data:
+                yield to_sse(data)
+                continue
+            obj = await asyncio.to_thread(dbi.get, schema.Script, script_id)
+            if not obj or schema.status_dc.get(str(obj.status), 0) >= 100:
+                yield to_sse(str(obj.status if obj else 'DELETED').encode(), event='end')
+                break
+
+    return StreamingResponse(stream(data, offset), media_type='text/event-stream')
+
     
 # Create a new script
 @app.post("/script")
-def create_script(script: schema.Script) -> schema.Script:
+def create_script(script: schema.Script, request: Request) -> schema.Script:
     log.debug('POST /script')
+    script.submitter = get_submitter(request, script.model_dump())
     assert script.id is None or script.id < 1725603466, f'{script.id=} are you trying to commit a timestamp to an id?'
     res = dbi.commit(script)
     log.debug(f'POST /script -> {res=}')
@@ -358,6 +418,19 @@ async def patch_script(script_id:int, request: Request):
     assert script_id is None or script_id < 1725603466, f'{script_id=} are you trying to commit a timestamp to an id?'
     return dbi.set_property(schema.Script, script_id, **(await request.json()))
     
+@app.patch("/script")
+async def patch_scripts(request: Request) -> list[schema.Script]:
+    """set the properties of many scripts in one transaction. The body is a list of dicts with the "id" and the properties to set"""
+    changes = {}
+    for kwargs in await request.json():
+        kwargs = dict(kwargs)
+        script_id = int(kwargs.pop('id'))
+        changes[script_id] = {**changes.get(script_id, {}), **kwargs}
+    try:
+        return dbi.set_properties_many(schema.Script, changes)
+    except KeyError as err:
+        raise HTTPException(status_code=404, detail=str(err))
+
 @app.put("/script/{script_id}")
 def put_script(script_id:int, script: schema.Script):
     assert script_id == script.id, f'trying to set a object with mismatching id! {script_id=} vs. {script.id=}'
@@ -405,6 +478,85 @@ def get_var():
     return dbi.get_all(schema.ProjectVariable)
 
 
+class PipelineRequest(BaseModel):
+    name: str = ''
+    comments: str = ''
+    stages: Dict[str, Dict[str, Any]] = Field(description='stage name -> script kwargs (as for /action/script/run) plus "depends_on" (list of stage names) and "foreach" ({key: [values]} to fan out, e.G. over device_id)',
+                                              examples=[{'measure': {'script_in_path': 'measure.ipynb', 'foreach': {'device_id': ['dev1', 'dev2']}},
+                                                         'analyse': {'script_in_path': 'analyse.ipynb', 'depends_on': ['measure']}}])
+
+@app.post("/pipeline")
+def post_pipeline(req: PipelineRequest, request: Request) -> schema.Pipeline:
+    """create a DAG of scripts. Each stage starts as soon as all stages it depends on have FINISHED and gets their outputs and datafile ids as the parameter "parents" """
+    try:
+        return pipelines.create_pipeline(req.name, req.stages, req.comments, submitter=get_submitter(request))
+    except AssertionError as err:
+        raise HTTPException(status_code=400, detail=f'invalid pipeline: {err}')
+
+@app.get("/pipeline")
+def get_pipelines() -> list[schema.Pipeline]:
+    return dbi.get_all(schema.Pipeline)
+
+@app.get("/pipeline/{pipeline_id}")
+def get_pipeline(pipeline_id:int) -> Dict[str, Any]:
+    dc = pipelines.get_pipeline_info(pipeline_id)
+    if dc is None:
+        raise HTTPException(status_code=404, detail="pipeline not found")
+    return dc
+
+@app.post("/action/pipeline/{pipeline_id}/cancel")
+def action_pipeline_cancel(pipeline_id:int) -> Dict[str, Any]:
+    get_pipeline(pipeline_id)
+    return pipelines.cancel_pipeline(pipeline_id)
+
+
+@app.get("/schedule")
+def get_schedules() -> list[schema.Schedule]:
+    return dbi.get_all(schema.Schedule)
+
+@app.get("/schedule/{schedule_id}")
+def get_schedule(schedule_id:int) -> schema.Schedule:
+    obj = dbi.get(schema.Schedule, schedule_id)
+    if not obj:
+        raise HTTPException(status_code=404, detail="schedule not found")
+    return obj
+
+@app.post("/schedule")
+def post_schedule(obj: schema.Schedule, request: Request) -> schema.Schedule:
+    """create a recurring job. Give either a cron expression ("*/15 8-18 * * mon-fri", "@daily", ...) or interval_sec and 
+    the script to create in template_json (the same fields as for /action/script/run)"""
+    obj.template_json = {**(obj.template_json or {}), 'submitter': get_submitter(request, obj.template_json)}
+    try:
+        obj.validate_trigger()
+        if obj.next_fire is None:
+            obj.next_fire = obj.get_next_fire()
+    except Exception as err:
+        raise HTTPException(status_code=400, detail=f'invalid schedule: {err}')
+    return dbi.commit(obj)
+
+@app.patch("/schedule/{schedule_id}")
+async def patch_schedule(schedule_id:int, request: Request) -> schema.Schedule:
+    """change a schedule (set "enabled" to false to stop it). next_fire is recomputed if the trigger changes"""
+    kwargs = await request.json()
+    obj = get_schedule(schedule_id)
+    obj.sqlmodel_update(kwargs)
+    try:
+        obj.validate_trigger()
+        if 'next_fire' not in kwargs and ({'cron', 'interval_sec', 'enabled'} & set(kwargs)):
+            kwargs['next_fire'] = obj.get_next_fire()
+    except Exception as err:
+        raise HTTPException(status_code=400, detail=f'invalid schedule: {err}')
+    return dbi.set_property(schema.Schedule, schedule_id, **kwargs)
+
+@app.post("/action/schedule/{schedule_id}/fire")
+def action_schedule_fire(schedule_id:int) -> schema.Script:
+    """create a script from the schedule right now (next_fire is not changed)"""
+    obj = get_schedule(schedule_id)
+    script = dbi.commit(obj.make_script(helpers.get_utcnow()))
+    dbi.set_property(schema.Schedule, schedule_id, last_fire=script.start_condition, last_script_id=script.id, n_fired=obj.n_fired + 1)
+    return script
+
+
 
 @app.get("/downloadq")
 async def download_file_qry(path: str = Query(...)):
@@ -694,22 +846,54 @@ async def qry_scripts(start_date:datetime.datetime|None=Query(default=None),
                 script_in_path:str=Query(default=''),
                 script_version:str=Query(default=''),
                 out_path:str=Query(default=''),
-                n_max:int=Query(default=-1), skipn:int=Query(default=0)):
-    dc = dbi.qry_tabledata(t_min=start_date, t_max=end_date, stati=stati, script_name=script_name, script_in_path=script_in_path, script_version=script_version, 
-                             out_path=out_path, n_max=n_max, skipn=skipn)
+                n_max:int=Query(default=-1), skipn:int=Query(default=0),
+                cursor:str|None=Query(default=None, description='the next_cursor or prev_cursor of the last page (only used with n_max > 0 and without skipn)'),
+                order:str=Query(default='desc', description='"asc" | "desc" by start_condition')):
+    try:
+        dc = dbi.qry_tabledata(t_min=start_date, t_max=end_date, stati=stati, script_name=script_name, script_in_path=script_in_path, script_version=script_version, 
+                                out_path=out_path, n_max=n_max, skipn=skipn, cursor=cursor, order=order)
+    except (ValueError, AssertionError) as err:
+        raise HTTPException(status_code=400, detail=str(err))
     return dc
 
+@app.get("/qry/queue")
+def qry_queue(policy:str = Query(default='fair_share', description='"fifo" | "priority" | "fair_share"'),
+              share_key:str = Query(default='submitter', description='"device_id" | "submitter"'),
+              n_max:int = Query(default=100)) -> list[schema.Script]:
+    """all due WAITING_TO_RUN scripts in the order the runners would start them (without weights)"""
+    try:
+        q = dbi.get_queue_query(policy=policy, share_key=share_key)
+    except AssertionError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    with dbi.se() as session:
+        return session.exec(q.limit(n_max)).all()
+
 @app.get("/qry/script")
-async def qry_scripts(t_min:datetime.datetime|None=Query(default=None), 
+async def qry_scripts(response:Response,
+                t_min:datetime.datetime|None=Query(default=None), 
                 t_max:datetime.datetime|None=Query(default=None), 
                 stati:list[schema.STATUS]|None=Query(default=None),
                 script_name:str=Query(default=''),
                 script_in_path:str=Query(default=''),
                 script_version:str=Query(default=''),
                 out_path:str=Query(default=''),
-                n_max:int=Query(default=-1), skipn:int=Query(default=0)):
-    return dbi.qry_scripts(t_min=t_min, t_max=t_max, stati=stati, script_name=script_name, script_in_path=script_in_path, script_version=script_version, 
-                             out_path=out_path, n_max=n_max, skipn=skipn)
+                n_max:int=Query(default=-1), skipn:int=Query(default=0),
+                cursor:str|None=Query(default=None, description='the X-Next-Cursor or X-Prev-Cursor header of the last page'),
+                order:str=Query(default='asc', description='"asc" | "desc" by start_condition')):
+    """the scripts matching the filters. With n_max > 0 (and no skipn) the pages are fetched by cursor and the 
+    cursors for the next and previous page are returned in the X-Next-Cursor and X-Prev-Cursor headers"""
+    kwargs = dict(t_min=t_min, t_max=t_max, stati=stati, script_name=script_name, script_in_path=script_in_path, script_version=script_version, out_path=out_path)
+    try:
+        if skipn or (n_max <= 0 and not cursor):
+            return dbi.qry_scripts(n_max=n_max, skipn=skipn, order=order, **kwargs)
+        with dbi.se() as session:
+            page = dbi.qry_scripts_page(session, n_max=n_max, cursor=cursor, order=order, **kwargs)
+    except (ValueError, AssertionError) as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    for k, header in [('next_cursor', 'X-Next-Cursor'), ('prev_cursor', 'X-Prev-Cursor')]:
+        if page[k]:
+            response.headers[header] = page[k]
+    return page['data']
 
 @app.get("/qry/script/{script_id}/datafiles")
 async def ids_projectvariable(script_id:int):
@@ -733,6 +917,20 @@ async def ids_projectvariable(script_id:int, html:int = Query(default=0, descrip
             return script.docs_json
     
     
+@app.get("/qry/script/cell_durations")
+def qry_cell_durations(script_name:str = Query(description='the script_name to get the typical cell durations for'),
+                       n_last:int = Query(default=10, description='the number of the last FINISHED runs to take the median over')) -> list:
+    """the median duration in seconds per cell index of the last runs of a script (None for non code cells)"""
+    return dbi.get_cell_durations(script_name, n_last=n_last)
+
+@app.get("/qry/script/{script_id}/progress")
+def qry_script_progress(script_id:int):
+    """the live progress record of a script (see JupyRunner.core.progress) extrapolated to now"""
+    obj = dbi.get(schema.Script, script_id)
+    if not obj:
+        raise HTTPException(status_code=404, detail="script not found")
+    return {'script_id': obj.id, 'status': obj.status, **obj.get_progress(), 'text': obj.get_progress_str()}
+
 @app.get("/qry/script/{script_id}/params")
 async def ids_projectvariable(script_id:int):
     with dbi.se() as session:
@@ -773,6 +971,18 @@ async def ids_projectvariable(device_id:str):
             raise HTTPException(status_code=404, detail="device not found")
         return d.datafiles
 
+@app.get("/qry/device/locks")
+def qry_device_locks() -> list[Dict[str, Any]]:
+    """the concurrency limit of each device and the scripts currently holding it"""
+    return dbi.get_device_locks()
+
+@app.get("/qry/device/{device_id}/lock")
+def qry_device_lock(device_id:str) -> Dict[str, Any]:
+    """the concurrency limit of one device and the scripts currently holding it"""
+    if not dbi.get(schema.Device, device_id):
+        raise HTTPException(status_code=404, detail="device not found")
+    return dbi.get_device_locks(device_id)[0]
+
 @app.get("/qry/device/{device_id}/scripts")
 async def ids_projectvariable(device_id:str):
     with dbi.se() as session:
@@ -852,8 +1062,7 @@ def action_trigger_upload(script_id:int, is_dryrun:int=Query(default=0, descript
 
                     uploaded = False
                     if abspath.endswith('.ipynb'):
-                        html_exporter = nbconvert.HTMLExporter()
-                        html_data, resources = html_exporter.from_filename(abspath)
+                        html_data = render_cache.render_html(abspath, use_pool=True)
                         rp = remote_path[:-len('.ipynb')] + '.html'
                         
                         content = html_data.encode()
@@ -897,6 +1106,52 @@ def action_trigger_upload(script_id:int, is_dryrun:int=Query(default=0, descript
         raise
     
 
+class SchedulerConfig(BaseModel):
+    model_config = {'extra': 'forbid'}
+    policy: Literal['fifo', 'priority', 'fair_share'] = 'fair_share'
+    share_key: Literal['device_id', 'submitter'] = 'submitter'
+    weights: Dict[str, float] | None = None
+
+class ClaimRequest(BaseModel):
+    runner_id: str | None = None
+    runner_ip: str | None = None
+    n_max: int = 1
+    max_cost: int | None = None
+    cost_cap: int | None = None
+    lease_sec: float = 120
+    scheduler: dict | None = Field(default=None, description='policy ("fifo" | "priority" | "fair_share"), share_key ("device_id" | "submitter") and weights for the queue order')
+
+class LeaseRequest(BaseModel):
+    runner_id: str | None = None
+    runner_ip: str | None = None
+    script_ids: list[int] = []
+    lease_sec: float = 120
+
+@app.post("/action/script/claim")
+def action_script_claim(req: ClaimRequest) -> list[schema.Script]:
+    """atomically moves up to n_max eligible scripts from WAITING_TO_RUN to STARTING for one runner and leases them to it"""
+    kwargs = req.model_dump()
+    try:
+        if req.scheduler is not None:
+            kwargs['scheduler'] = SchedulerConfig.model_validate(req.scheduler).model_dump()
+    except ValidationError as err:
+        raise HTTPException(status_code=400, detail=f'invalid scheduler: {err}')
+    return dbi.claim_scripts(**kwargs)
+
+@app.post("/action/script/renew_lease")
+def action_script_renew_lease(req: LeaseRequest) -> Dict[str, Any]:
+    ids = dbi.renew_leases(**req.model_dump())
+    return {'success': len(ids) == len(req.script_ids), 'renewed': ids, 'lost': [i for i in req.script_ids if not i in ids]}
+
+
+@app.post("/action/script/{script_id}/memoize")
+def action_script_memoize(script_id:int) -> schema.Script|None:
+    """complete a queued script with the results of an identical earlier run if it opted in (data_json["memoize"]). 
+    Returns the FINISHED script on a cache hit and null otherwise"""
+    get_script(script_id)
+    return dbi.memoize_script(script_id)
+
+
 @app.get("/action/kill/{script_int}")
 def kill(script_id:int):
     
@@ -991,6 +1246,7 @@ async def action_script_run(request: Request):
     """
 
     kwargs = helpers.split_flat_dict_into_nested(await request.query_params)
+    kwargs['submitter'] = get_submitter(request, kwargs)
     return _action_script(kwargs, False)
 
 
@@ -1009,8 +1265,14 @@ async def action_script_pre_test(request: Request):
 @app.post("/action/script/run")
 async def action_script_run(request: Request):
     kwargs = helpers.split_flat_dict_into_nested(await request.json())
+    kwargs['submitter'] = get_submitter(request, kwargs)
     return _action_script(kwargs, False)
 
+def get_submitter(request: Request, kwargs:dict|None=None) -> str:
+    """who submitted a script (the fair share group of the queue): the "submitter" field, the X-Submitter header or the client host"""
+    submitter = (kwargs or {}).get('submitter') or request.headers.get('X-Submitter') or (request.client.host if request.client else '')
+    return str(submitter)[:255]
+
 def _action_script(kwargs, test_only=False):
     errormsg = ''
     res = {}
@@ -1020,12 +1282,7 @@ def _action_script(kwargs, test_only=False):
 
         script_in_path = kwargs.get('script_in_path')
         assert script_in_path, f'"script_in_path" can not be empty!'
-        if not os.path.exists(script_in_path):
-            repo_scripts = filesys_storage_api.get_scripts_in_repo()
-            for scriptname in repo_scripts:
-                if script_in_path in os.path.basename(scriptname):
-                    kwargs['script_in_path'] = scriptname
-                    break
+        kwargs['script_in_path'] = filesys_storage_api.resolve_script_path(script_in_path)
             
         device_id = kwargs.get('device_id')
         if device_id:
@@ -1047,8 +1304,93 @@ def _action_script(kwargs, test_only=False):
 
 
 
+class SweepRequest(BaseModel):
+    template: Dict[str, Any] = Field(description='the script kwargs as for /action/script/run (script_in_path, script_params_json, device_id, ...) shared by all scripts',
+                                     examples=[{'script_in_path': 'example_script.ipynb', 'script_params_json': {'param1': 1}}])
+    grid: Dict[str, List[Any]] = Field(default={}, description='param name -> list of values. One script is created for each combination', examples=[{'freq': [1, 2, 3], 'power': [-10, 0]}])
+    params_list: List[Dict[str, Any]] = Field(default=[], description='explicit list of param sets (each one is combined with the grid)')
+    batch_id: str | None = Field(default=None, description='will be generated if not given')
+    test_only: bool = False
+
+
+def make_sweep_params(grid:dict, params_list:list) -> list[dict]:
+    keys = list(grid)
+    combos = [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+    return [{**p, **g} for p in (params_list or [{}]) for g in combos]
+
+
+@app.post("/action/script/sweep")
+def action_script_sweep(req: SweepRequest, request: Request) -> Dict[str, Any]:
+    """submit one script per parameter combination. The notebook and parameters are validated only once 
+    and all scripts are inserted in one transaction with a shared batch_id (see /batch/{batch_id}). The runners 
+    still check each script (AWAITING_CHECK), which sets its output path and params hash and applies memoization"""
+    kwargs = helpers.split_flat_dict_into_nested(dict(req.template))
+    kwargs['submitter'] = get_submitter(request, kwargs)
+    params = make_sweep_params(req.grid, req.params_list)
+    max_n = config.get('globals', {}).get('max_sweep_size', 10000)
+    if not params:
+        raise HTTPException(status_code=400, detail='the sweep is empty!')
+    if len(params) > max_n:
+        raise HTTPException(status_code=400, detail=f'the sweep has N={len(params)} scripts, which is more than the allowed {max_n=}')
+
+    try:
+        script_in_path = kwargs.get('script_in_path')
+        assert script_in_path, f'need to give "script_in_path" in the template!'
+        kwargs['script_in_path'] = filesys_storage_api.resolve_script_path(script_in_path)
+        assert os.path.exists(kwargs['script_in_path']), f'given path {script_in_path=} does not exist'
+
+        device_id = kwargs.get('device_id')
+        if device_id:
+            assert dbi.get(schema.Device, device_id), f'the given {device_id=} does not exist in the database!'
+
+        # validate once with the first param set (the notebook is the same for all)
+        base_params = kwargs.pop('script_params_json', None) or {}
+        template = schema.Script(**kwargs, script_params_json={**base_params, **params[0]})
+        scriptrunner.pre_check(template)
+        template.set_script_name()
+        template.set_script_version()
+    except Exception as err:
+        raise HTTPException(status_code=400, detail=f'ERROR: {type(err)=} | {err=}')
+
+    nb_params = helpers_papermill.get_params(repo_index.get_info(template.script_in_path))
+    unknown = sorted({k for p in params for k in p} - set(nb_params)) if nb_params and not 'ERROR' in nb_params else []
+    warnings = [f'the params {unknown} are not declared in the parameters cell of the notebook'] if unknown else []
+
+    batch_id = req.batch_id or uuid.uuid4().hex
+    if req.test_only:
+        return {'success': True, 'batch_id': batch_id, 'n': len(params), 'test_only': True, 'warnings': warnings, 'script_ids': []}
+
+    dc = template.model_dump(exclude={'id', 'script_params_json'})
+    scripts = []
+    for p in params:
+        # each script gets its own copy of the nested dicts (e.G. data_json), since they are changed per script later
+        script = schema.Script(**copy.deepcopy(dc), script_params_json=copy.deepcopy({**base_params, **p}))
+        script.batch_id = batch_id
+        script.status = schema.STATUS.AWAITING_CHECK
+        scripts.append(script)
+    
+    ids = dbi.insert_many(scripts)
+    log.info(f'submitted sweep {batch_id=} with N={len(ids)} scripts')
+    return {'success': True, 'batch_id': batch_id, 'n': len(ids), 'test_only': False, 'warnings': warnings, 'script_ids': ids}
+
+
+@app.get("/batch/{batch_id}")
+def get_batch(batch_id:str) -> Dict[str, Any]:
+    """aggregated status and progress of all scripts of a batch"""
+    info = dbi.get_batch_info(batch_id)
+    if not info['n_total']:
+        raise HTTPException(status_code=404, detail="batch not found")
+    return info
+
+@app.post("/action/batch/{batch_id}/cancel")
+def action_batch_cancel(batch_id:str) -> Dict[str, Any]:
+    """abort all queued and cancel all running scripts of a batch"""
+    get_batch(batch_id)
+    return dbi.cancel_batch(batch_id)
+
+
 @app.get('/action/script/rerun/{script_id}')  
-def action_script_rerun(script_id:int):
+def action_script_rerun(script_id:int, resume:bool=Query(default=False, description='record the cells and resume from the first changed or failed cell of the last recorded run (see cell_cache)')):
     try:
 
         with dbi.se() as session:
@@ -1063,12 +1405,19 @@ def action_script_rerun(script_id:int):
             err = helpers.limit_len('' if not obj.errors else obj.errors)
             obj.comments = str(obj.comments) + f'<<< [{helpers.now_iso()}] | rerun of original run with status="{status.name}" and {obj.time_started=} ... {obj.time_finished=} with err="{err}" requested now >>>'
 
-            obj.status = schema.STATUS.AWAITING_CHECK
             obj.errors = ''
-            obj.time_started = ''
+            obj.time_started = None
+            obj.retries = 0
+            if resume:
+                obj.data_json = {**(obj.data_json or {}), 'cell_cache': True}
+            session.commit()
+
+        obj = dbi.set_property(schema.Script, script_id, status=schema.STATUS.AWAITING_CHECK)
 
         return dict(command='rerun', id=script_id, success=True, status=obj.status, comments=obj.comments, obj_new = obj, obj_old=obj_old)
     
+    except HTTPException:
+        raise
     except Exception as err:
         log.exception(err)
         s = traceback.format_exception(err, limit=5)
@@ -1086,7 +1435,7 @@ async def repo_get_dirname() -> str:
 @app.get("/repo/get/params")
 async def repo_get_params(script_name : str = Query(default='', description='The script path to get the params for')) -> dict[str,dict] | dict:
     repo = filesys_storage_api.default_dir_repo
-    scripts = helpers_papermill.get_repo_scripts(repo)
+    scripts = repo_index.get_scripts()
     
     fun = helpers_papermill.get_params
     if not script_name:
@@ -1104,7 +1453,7 @@ async def repo_get_params(script_name : str = Query(default='', description='The
 @app.get("/repo/get/all")
 async def repo_get_params(script_name : str = Query(default='', description='The script path to get the params for')) -> dict[str,dict] | dict:
     repo = filesys_storage_api.default_dir_repo
-    scripts = helpers_papermill.get_repo_scripts(repo)
+    scripts = repo_index.get_scripts()
 
     if scripts: 
         return scripts
@@ -1137,8 +1486,7 @@ async def send_report(path: str, request: Request):
     if os.path.exists(path):
         if path and path.endswith('.ipynb'):
             if not filesys_storage_api.default_dir_data in path:
-                html_exporter = nbconvert.HTMLExporter()
-                html_data, resources = html_exporter.from_filename(path)
+                html_data = await render_cache.render_html_async(path)
                 return HTMLResponse(html_data, status_code=200)
             else:
                 n = len('.ipynb')
@@ -1146,8 +1494,7 @@ async def send_report(path: str, request: Request):
                 if not os.path.exists(path) and os.path.exists(npath):
                     path = npath
                 if not os.path.exists(npath):
-                    html_exporter = nbconvert.HTMLExporter()
-                    html_data, resources = html_exporter.from_filename(path)
+                    html_data = await render_cache.render_html_async(path)
                     with open(npath, "w", encoding='utf-8') as f:
                         f.write(html_data)
                 
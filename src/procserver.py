@@ -4,10 +4,12 @@
 the processing core to run jupyter notebooks in papermill
 """
 
+import asyncio
 import datetime
-import subprocess
 import shutil
+import subprocess
 import sys, os
+import threading
 import time
 import traceback
 
@@ -22,6 +24,7 @@ if __name__ == '__main__':
 
 from JupyRunner.core import schema, filesys_storage_api
 from JupyRunner.core import scriptrunner as runner
+from JupyRunner.core import kernel_pool, launcher, api_interface
 
 from JupyRunner.core.helpers import get_utcnow, make_zulustr, parse_zulutime, log, set_loglevel, get_primary_ip
 from JupyRunner.core.helpers_mattermost import send_mattermost
@@ -30,13 +33,36 @@ my_runner_id = os.environ.get('RUNNER_ID', None)
 
 config =  None
 run_directly = None
+direct_inline = None
+direct_pool_size = None
+use_event_wakeup = None
+event_seq = None
 
 processes = {}
+slot_costs = {}
+max_slots = None
+claim_n_max = None
+lease_sec = None
+scheduler = None
+heartbeat_sec = None
+max_runtime_sec = None
+deadlines = {}
+slot_info_last = None
+running_directly = set()
+lost_leases = set()
+abandoned = set() # cancelled jobs which are still running (thread jobs), they keep their slot until they have really ended
+use_asyncio = None
+async_concurrency = None
+cancel_interval_sec = None
+http_max_connections = None
+
+_jobs_lock = threading.RLock() # guards processes, slot_costs, deadlines, running_directly, lost_leases and abandoned, which are also used from other threads
+_stopping = set() # jobs which are currently being cancelled
 
 with open('config.yaml', 'r') as fp:
     config = yaml.safe_load(fp)
 
-modules = [runner, filesys_storage_api]
+modules = [runner, filesys_storage_api, launcher]
 for module in modules:
     module.setup(config)
 
@@ -48,6 +74,25 @@ set_loglevel(config)
 
 api = runner.api
 run_directly = config.get('procserver', {}).get('do_direct_running', 0)
+direct_inline = run_directly and launcher.launcher != 'thread'
+direct_pool_size = config.get('procserver', {}).get('direct_pool_size', 2)
+use_event_wakeup = config.get('procserver', {}).get('use_event_wakeup', 1)
+max_slots = config.get('procserver', {}).get('max_slots', 0)
+claim_n_max = config.get('procserver', {}).get('claim_n_max', 10)
+lease_sec = config.get('procserver', {}).get('lease_sec', 120)
+scheduler = config.get('procserver', {}).get('scheduler', None)
+heartbeat_sec = config.get('procserver', {}).get('heartbeat_sec', lease_sec / 4)
+max_runtime_sec = config.get('procserver', {}).get('max_runtime_sec', 0)
+use_asyncio = config.get('procserver', {}).get('use_asyncio', 0)
+async_concurrency = config.get('procserver', {}).get('async_concurrency', 8)
+cancel_interval_sec = config.get('procserver', {}).get('cancel_interval_sec', 2)
+http_max_connections = config.get('procserver', {}).get('http_max_connections', 20)
+
+if run_directly:
+    # only a long living executor can make use of warm kernels
+    kernel_pool.start(config)
+    # jobs in threads can only be cancelled by shutting down their kernel
+    kernel_pool.own_kernels = not direct_inline
 
 commit = runner.commit
 set_prop_remote = runner.set_prop_remote
@@ -58,35 +103,6 @@ def get_script(script_id:int) -> schema.Script:
     return api.get(script_id)
 
 
-def test_shall_I_run_this_script(script, by_ip=False):
-
-    
-    dc = script.data_json
-
-    if by_ip:
-        req_runner_id = dc.get('runner_ip', dc.get('runner_id', None))
-        _my_runner_id = get_primary_ip()
-    else:
-        req_runner_id = dc.get('runner_id', None)
-        _my_runner_id = my_runner_id
-
-    if _my_runner_id is None: # default runner
-        if req_runner_id is None: # no specific runner needed
-            return True # --> can run
-        else:
-            return False # --> specific runner needed
-    else: # specific runner
-        if req_runner_id is None:
-            return False # --> default runner should run the script, not me
-        elif req_runner_id == _my_runner_id:
-            return True # --> yep I am the one who should run this
-        else:
-            return False # --> nope someone else should run this
-
-
-
-
-
 def get_running_processes():
     return [ get_script(int(key)) for key in processes.keys()]
 
@@ -101,20 +117,44 @@ def test_is_running(key):
 def test_is_started(key):
     return key in processes
 
+def get_slot_cost(script):
+    cost = script.get_slot_cost()
+    # a job bigger than the whole pool can still run if the pool is empty
+    return min(cost, max_slots) if max_slots else cost
+
+def get_used_slots():
+    with _jobs_lock:
+        return sum(slot_costs.get(key, 1) for key in processes)
+
+def get_free_slots():
+    free_slots = max_slots - get_used_slots() if max_slots else float('inf')
+    if run_directly and not direct_inline:
+        free_slots = min(free_slots, direct_pool_size - len(processes))
+    return free_slots
+
+def get_slot_info():
+    return {
+        'runner_id': my_runner_id,
+        'max_slots': max_slots,
+        'used_slots': get_used_slots(),
+        'free_slots': get_free_slots() if max_slots else None,
+        'jobs': [dict(script_id=k, cost=slot_costs.get(k, 1)) for k in list(processes)],
+    }
+
 def finish(p, id):
     log.info(f'{id} DONE. returncode:{p.returncode}')
     retcode = p.poll()
     out, err = p.communicate()
     
-    out = out.decode(sys.stdout.encoding)
-    err = err.decode(sys.stderr.encoding)
+    out = out.decode(sys.stdout.encoding, errors='replace')
+    err = err.decode(sys.stderr.encoding, errors='replace')
 
     obj = get_script(id)
     if retcode:
         obj.append_error_msg(err)
         log.error('ERROR: ' + err)
         log.debug('setting status: FAILED...' )
-        obj = set_prop_remote(id, status = schema.STATUS.FAILED, errors = obj.errors)
+        runner.batcher.patch(id, status = schema.STATUS.FAILED, errors = obj.errors)
 
         s = ''
         s += f'\nFAILED on processing for script {id}'
@@ -125,45 +165,117 @@ def finish(p, id):
     return id
 
 
-def start_job(id):
+def start_job(id, cost=1, deadline:datetime.datetime|None=None):
 
     assert id not in processes, f'cannot start job {id=} since it is still running!'
     assert id, 'need to give an id!'
-    run_script_path = config['procserver']['run_script_path']
     
-    cmds = [run_script_path, '--id', str(id)]
-    if os.name == 'nt':
-        cmds = [config['procserver']['pythonpath_for_win']] + cmds
-    else:
-        cmds = ['python'] + cmds
-
-    s = ' '.join(cmds)
-    log.info(f'RUNNING... "{s}"')
-    if os.name == 'nt' and 'TESTING' in config and config['TESTING']:
-        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, creationflags=subprocess.CREATE_NEW_CONSOLE)
-    else:
-        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-    processes[id] = p
-
-def cancle_job(id):
-    if not test_is_running(id):
-        return 404, {'ERROR': 'no such job found within running jobs'}
-    else:
+    p = launcher.launch(id)
+    with _jobs_lock:
+        processes[id] = p
+        slot_costs[id] = cost
+        deadlines[id] = deadline
+
+def cancle_job(id, status=schema.STATUS.CANCELLED, reason=''):
+    with _jobs_lock:
+        if not test_is_running(id) or id in _stopping:
+            return 404, {'ERROR': 'no such job found within running jobs'}
         p = processes[id]
+        _stopping.add(id)
+
+    try:
         p.terminate()
-        p.wait(timeout=config['procserver']['terminate_timeout_sec'])
+        try:
+            p.wait(timeout=config['procserver']['terminate_timeout_sec'])
+        except subprocess.TimeoutExpired:
+            log.warning(f'job for {id=} did not terminate in time. Killing it...')
         p.kill()
         out, err = p.communicate()
-        out = out.decode(sys.stdout.encoding)
-        err = err.decode(sys.stderr.encoding)
+        out = out.decode(sys.stdout.encoding, errors='replace')
+        err = err.decode(sys.stderr.encoding, errors='replace')
         
         obj = get_script(id)
         obj.append_error_msg(err)
-        obj = set_prop_remote(obj, status = schema.STATUS.CANCELLED, errors = obj.errors)
+        if reason:
+            obj.append_error_msg(reason)
+        obj = set_prop_remote(obj, status = status, errors = obj.errors)
+    finally:
+        with _jobs_lock:
+            deadlines.pop(id, None)
+            _stopping.discard(id)
+            if p.poll() is None:
+                log.warning(f'job for {id=} is still running after being killed. Keeping its slot until it has ended')
+                abandoned.add(id)
+            else:
+                processes.pop(id, None)
+                slot_costs.pop(id, None)
+
+
+def get_t_next_deadline(t_max:float) -> float:
+    """seconds until the next running job hits its deadline (capped to t_max)"""
+    with _jobs_lock: # cancle_job pops from deadlines in other threads
+        t_next = [(d - get_utcnow()).total_seconds() for k, d in deadlines.items() if d is not None and k in processes]
+    return max(0.1, min([t_max] + t_next))
+
+
+def tick_deadlines():
+    """terminate all jobs which are running past their end_condition or max runtime"""
+    log.debug(f'tick_deadlines...')
+    now = get_utcnow()
+    with _jobs_lock:
+        jobs = list(deadlines.items())
+    for script_id, deadline in jobs:
+        if deadline is None or now < deadline or not test_is_running(script_id):
+            continue
+        try:
+            reason = f'{make_zulustr(now)} terminated by runner since it exceeded its deadline {make_zulustr(deadline)} (end_condition or max_runtime_sec)'
+            log.warning(f'script {script_id}: {reason}')
+            cancle_job(script_id, status=schema.STATUS.EXPIRED, reason=reason)
+        except Exception as err:
+            log.exception(f'ERROR while terminating script {script_id} which exceeded its deadline: {err}')
+
+
+def _check_script(script:schema.Script) -> tuple[schema.Script, schema.STATUS|None]:
+    """the initial checks of a new script and its new status (None if it was completed from the cache)"""
+    try:
+        log.info('CHECKING for ' + str(script))
+
+        
+        log.debug('checking...')
+        runner.pre_check(script)
         
-        del processes[id]
+        log.debug('actually setting...')
+        script = runner.prepare_for_run(script)
+        if runner.complete_from_cache(script):
+            return script, None
 
+        stat = schema.STATUS.WAITING_TO_RUN
+        log.debug(f'   FROM: {script.script_in_path}')
+        log.debug(f'     TO: {script.script_out_path}')
+
+    except Exception as err:
+        
+        script.append_error_msg(str(err))
+        log.error('ERROR: ' + str(err))
+        stat = schema.STATUS.FAULTY
+    
+    log.info(f'DONE CHECKING with {script.id} --> {stat}')
+    return script, stat
+
+
+def check_script(script:schema.Script):
+    """initial checks of a new script, which is then WAITING_TO_RUN, FAULTY or completed from the cache (the new status 
+    is batched, see runner.flush_patches)"""
+    script, stat = _check_script(script)
+    if stat is not None:
+        runner.batcher.patch(script.id, status=stat, errors=script.errors)
+
+
+async def acheck_script(aapi:api_interface.AsyncScriptClient, script:schema.Script):
+    """as check_script, but only the checks run in a thread (prepare_for_run already committed the script)"""
+    script, stat = await asyncio.to_thread(_check_script, script)
+    if stat is not None:
+        await aapi.patch(script.id, status=stat, errors=script.errors)
 
 
 def tick_awaiting_check():
@@ -175,31 +287,23 @@ def tick_awaiting_check():
     log.debug(f'got N={len(scripts)} scripts which need attention...')
 
     for script in scripts:
-        try:
-            log.info('CHECKING for ' + str(script))
-
-            
-            log.debug('checking...')
-            runner.pre_check(script)
-            
-            log.debug('actually setting...')
-            script = runner.prepare_for_run(script)
-            stat = schema.STATUS.WAITING_TO_RUN
-            log.debug(f'   FROM: {script.script_in_path}')
-            log.debug(f'     TO: {script.script_out_path}')
-
-        except Exception as err:
-            
-            script.append_error_msg(str(err))
-            log.error('ERROR: ' + str(err))
-            stat = schema.STATUS.FAULTY
+        check_script(script)
+    runner.flush_patches() # before tick_start claims them
         
-        script.status = stat
 
-        log.info(f'DONE CHECKING with {script.id} --> {stat}')
+def cancel_script(script:schema.Script):
+    """cancel the job of a CANCELLING script if it is running on this runner"""
+    if not test_is_running(script.id):
+        return
+    try:
+        cancle_job(script.id)
+    except Exception as err:
+        script.append_error_msg(str(err))
+        log.error('ERROR: ' + str(err))
+        set_prop_remote(script, status=schema.STATUS.FAULTY, errors=script.errors)
+
+    log.info('DONE CANCELLING ' + str(script))
 
-        script = commit(script)
-        
 
 def tick_cancelling():
     log.debug(f'tick_cancelling...')
@@ -209,19 +313,7 @@ def tick_cancelling():
     log.debug(f'got N={len(scripts)} scripts which need attention...')
 
     for script in scripts:
-        try:
-            if test_is_running(script.id):
-                cancle_job(script.id)
-            stat = script.status
-        except Exception as err:
-            script.append_error_msg(str(err))
-            log.error('ERROR: ' + str(err))
-            stat = schema.STATUS.FAULTY
-        
-        log.debug('setting status... ' + stat)
-        script = set_prop_remote(script, status=stat, errors=script.errors)
-
-        log.info('DONE CHECKING with ' + str(script))
+        cancel_script(script)
         
 
 
@@ -229,10 +321,19 @@ def tick_cleanup():
     log.debug(f'tick_cleanup...')
     # clean up if finished
     to_remove = []
-    for script_id, p in processes.items():
+    with _jobs_lock:
+        jobs = [(k, p) for k, p in processes.items() if not k in _stopping]
+    for script_id, p in jobs:
         try:
             
-            if not test_is_running(script_id):
+            if not test_is_running(script_id) and (script_id in lost_leases or script_id in abandoned):
+                log.warning(f'DISCARDING job for script {script_id} since its lease was lost or it was cancelled, {p}')
+                p.communicate()
+                with _jobs_lock:
+                    lost_leases.discard(script_id)
+                    abandoned.discard(script_id)
+                to_remove.append(script_id)
+            elif not test_is_running(script_id):
                 log.info(f'CLEANING UP PROCESSES for script {script_id}, {p}')
                 k = finish(p, script_id)
                 to_remove.append(k)
@@ -243,70 +344,272 @@ def tick_cleanup():
             obj.append_error_msg(err_msg=str(err))
             log.exception(f'ERROR while cleaining up {key}, {p}')
             log.exception('ERROR: ' + str(err))
-            set_prop_remote(obj, status=schema.STATUS.FAULTY, errors=obj.errors)
+            runner.batcher.patch(script_id, status=schema.STATUS.FAULTY, errors=obj.errors)
+    runner.flush_patches()
     
     for key in to_remove:
-        removed = processes.pop(key)
+        with _jobs_lock:
+            removed = processes.pop(key)
+            slot_costs.pop(key, None)
+            deadlines.pop(key, None)
         log.debug('removed: ' + str(removed) )
         
 
+def get_claim_kwargs(free_slots) -> dict:
+    return dict(runner_id=my_runner_id, 
+                runner_ip=get_primary_ip(), 
+                n_max=int(free_slots) if max_slots or run_directly else claim_n_max, 
+                max_cost=int(free_slots) if max_slots and not direct_inline else None, 
+                cost_cap=max_slots if max_slots else None,
+                lease_sec=lease_sec,
+                scheduler=scheduler)
+
+
+def _start_script(script:schema.Script) -> Exception|None:
+    """run (directly) or start the job for a claimed script and return the error if it could not be started"""
+    try:
+        assert script.status == schema.STATUS.STARTING, f'claimed script is not STARTING but {script.status=}'
+        log.info('STARTING PROCESSING for ' + str(script))
+        
+        if direct_inline:
+            with _jobs_lock:
+                running_directly.add(script.id)
+            try:
+                runner.run_job(script.id)
+            finally:
+                with _jobs_lock:
+                    running_directly.discard(script.id)
+            log.info('DONE RUNNING with ')
+            
+        else:
+            start_job(script.id, get_slot_cost(script), script.get_deadline(max_runtime_sec))
+
+            log.info('DONE STARTING with ' + str(script))
+            
+    except Exception as err:
+
+        traceback.print_exception(err)
+        script.append_error_msg(str(err))
+        log.error('ERROR: ' + str(err))
+        log.error('setting status... ' + schema.STATUS.FAULTY)
+        return err
+
+
+def start_script(script:schema.Script):
+    """run (directly) or start the job for a claimed script (FAULTY if that fails)"""
+    if _start_script(script) is not None:
+        script = set_prop_remote(script.id, status=schema.STATUS.FAULTY, errors=script.errors)
+        assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
+        script = api.get(script.id)
+        assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
+
+    log.debug(f'tick_start...DONE with script={script.id} {script.status=}')
+
+
+async def astart_script(aapi:api_interface.AsyncScriptClient, script:schema.Script):
+    """as start_script, but only starting the job runs in a thread"""
+    if await asyncio.to_thread(_start_script, script) is not None:
+        script = await aapi.patch(script.id, status=schema.STATUS.FAULTY, errors=script.errors)
+        assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
+        script = await aapi.get(script.id)
+        assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
+
+    log.debug(f'tick_start...DONE with script={script.id} {script.status=}')
+
+
 def tick_start():
     log.debug(f'tick_start...')
-    stati = [schema.STATUS.STARTING, schema.STATUS.WAITING_TO_RUN]
-    stat = None
-    scripts = api.qry(stati=stati)
-    log.debug(f'got N={len(scripts)} scripts which need attention...')
+
+    free_slots = 1 if direct_inline else get_free_slots()
+    if free_slots <= 0:
+        log.debug(f'tick_start... no free slots ({get_used_slots()=})')
+        return
+    
+    # claiming is atomic on the server, so several runners can share one queue
+    scripts = api.claim(**get_claim_kwargs(free_slots))
+    
+    log.debug(f'claimed N={len(scripts)} scripts to start...')
     for script in scripts:
+        start_script(script)
+
+
+def get_leased_ids() -> list[int]:
+    """the ids of all scripts this runner is working on"""
+    with _jobs_lock:
+        return list(processes) + list(running_directly)
+
+
+def tick_renew_leases():
+    """send a heartbeat for all scripts this runner is working on by renewing their leases on the server"""
+    log.debug(f'tick_renew_leases...')
+    script_ids = get_leased_ids()
+    if not script_ids:
+        return
+    
+    res = api.renew_leases(script_ids, runner_id=my_runner_id, runner_ip=get_primary_ip(), lease_sec=lease_sec)
+    on_lost_leases(res.get('lost', []))
+
+
+async def atick_renew_leases(aapi:api_interface.AsyncScriptClient):
+    """as tick_renew_leases, but with the async client"""
+    script_ids = get_leased_ids()
+    if not script_ids:
+        return
+    res = await aapi.renew_leases(script_ids, runner_id=my_runner_id, runner_ip=get_primary_ip(), lease_sec=lease_sec)
+    on_lost_leases(res.get('lost', []))
+
+
+def on_lost_leases(script_ids:list[int]):
+    """terminate the jobs of all scripts whose lease was lost"""
+    for script_id in script_ids:
+        with _jobs_lock:
+            p = processes.get(script_id)
+            is_new = p is not None and not script_id in lost_leases
+            if is_new:
+                lost_leases.add(script_id)
+        if is_new:
+            # the server has given the script to someone else (or failed it) --> the result of this job is void
+            log.error(f'lost the lease for the running script {script_id}. Terminating its job...')
+            p.terminate()
+        elif p is None:
+            log.warning(f'lost the lease for the running script {script_id}')
+
+
+def run_heartbeat():
+    """renews the leases in the background, so long ticks (e.G. direct running) do not let them expire"""
+    log.info(f'heartbeat thread started with {heartbeat_sec=}')
+    while True:
+        time.sleep(heartbeat_sec)
         try:
-            key = script.id
-
-            if not test_is_running(key) and \
-                script.test_for_start_condition() and \
-                    (test_shall_I_run_this_script(script) or test_shall_I_run_this_script(script, by_ip=True)):
-                
-                log.info('STARTING PROCESSING for ' + str(script))
-                log.debug('setting status... ' + schema.STATUS.STARTING)
-                script = set_prop_remote(script, status = schema.STATUS.STARTING)
-                assert script.status == schema.STATUS.STARTING
-                
-                if run_directly:
-                    runner.run_script(script.id)
-                    log.info('DONE RUNNING with ')
-                    runner.init_follow_up_script(script)
-                    
-                else:
-                    start_job(script.id)
-
-                    log.info('DONE STARTING with ' + str(script))
-            else:
-                log.debug('test_is_running:          ' + str(test_is_running(key)))
-                log.debug('test_for_start_condition: ' + str(script.test_for_start_condition()))
-                
+            tick_renew_leases()
         except Exception as err:
+            log.error(f'ERROR while sending heartbeat: {err}')
 
-            traceback.print_exception(err)
-            script.append_error_msg(str(err))
-            log.error('ERROR: ' + str(err))
-            stat = schema.STATUS.FAULTY
-            log.error('setting status... ' + stat)
-            script = set_prop_remote(script.id, status=stat, errors=script.errors)
-            
-            assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
-            script = api.get(script.id)
-            assert script.status == schema.STATUS.FAULTY, f'status was not set to faulty! but is {script.status=}'
 
-        log.debug(f'tick_start...DONE with script={script.id} {script.status=}')
+async def arun_heartbeat(aapi:api_interface.AsyncScriptClient):
+    """as run_heartbeat, but as a task of the asyncio runner loop"""
+    log.info(f'heartbeat task started with {heartbeat_sec=}')
+    while True:
+        await asyncio.sleep(heartbeat_sec)
+        try:
+            await atick_renew_leases(aapi)
+        except Exception as err:
+            log.error(f'ERROR while sending heartbeat: {err}')
 
-    
 
 def tick():
     log.debug(f'tick... ')
     tick_awaiting_check()
     tick_cancelling()
+    tick_deadlines()
     tick_cleanup()
+    if not heartbeat_sec:
+        tick_renew_leases()
     tick_start()
+    update_slot_info()
     log.debug(f'tick... DONE')
 
+async def _gather(*aws):
+    """run all awaitables concurrently and log (instead of raise) their errors"""
+    for res in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(res, Exception):
+            log.error(f'ERROR in runner loop: {res}')
+            traceback.print_exception(res)
+
+
+async def atick_awaiting_check(aapi:api_interface.AsyncScriptClient, sem:asyncio.Semaphore):
+    stati = [schema.STATUS.INITIALIZING, schema.STATUS.AWAITING_CHECK]
+    scripts = await aapi.qry(stati=stati)
+    log.debug(f'got N={len(scripts)} scripts which need attention...')
+
+    async def check(script):
+        async with sem:
+            await acheck_script(aapi, script)
+
+    await _gather(*(check(script) for script in scripts))
+
+
+async def atick_cancelling(aapi:api_interface.AsyncScriptClient):
+    scripts = [s for s in await aapi.qry(stati=[schema.STATUS.CANCELLING]) if test_is_running(s.id)]
+    await _gather(*(asyncio.to_thread(cancel_script, script) for script in scripts))
+
+
+async def atick_start(aapi:api_interface.AsyncScriptClient, sem:asyncio.Semaphore):
+    free_slots = 1 if direct_inline else get_free_slots()
+    if free_slots <= 0:
+        log.debug(f'tick_start... no free slots ({get_used_slots()=})')
+        return
+    
+    scripts = await aapi.claim(**get_claim_kwargs(free_slots))
+    log.debug(f'claimed N={len(scripts)} scripts to start...')
+
+    async def start(script):
+        async with sem:
+            await astart_script(aapi, script)
+
+    await _gather(*(start(script) for script in scripts))
+
+
+async def atick_jobs(aapi:api_interface.AsyncScriptClient, sem:asyncio.Semaphore):
+    await asyncio.to_thread(tick_deadlines)
+    await asyncio.to_thread(tick_cleanup)
+    if not heartbeat_sec:
+        await atick_renew_leases(aapi)
+    await atick_start(aapi, sem)
+    await asyncio.to_thread(update_slot_info)
+
+
+async def atick(aapi:api_interface.AsyncScriptClient, sem:asyncio.Semaphore):
+    """one tick of the asyncio runner loop. The initial checks run concurrently to the job handling 
+    and both process up to async_concurrency scripts at once"""
+    log.debug(f'atick... ')
+    await _gather(atick_awaiting_check(aapi, sem), atick_jobs(aapi, sem))
+    log.debug(f'atick... DONE')
+
+
+async def arun_cancelling(aapi:api_interface.AsyncScriptClient):
+    """fast path for cancelling, which does not wait for the (possibly slow) main tick"""
+    while True:
+        await asyncio.sleep(cancel_interval_sec)
+        if not processes:
+            continue
+        try:
+            await atick_cancelling(aapi)
+        except Exception as err:
+            log.error(f'ERROR while cancelling: {err}')
+
+
+async def arun(t_sleep:float):
+    """the asyncio runner loop (procserver.use_asyncio) with one pooled async HTTP client"""
+    aapi = api_interface.AsyncScriptClient(runner.url, max_connections=http_max_connections)
+    sem = asyncio.Semaphore(async_concurrency)
+    task_cancelling = asyncio.create_task(arun_cancelling(aapi))
+    task_heartbeat = asyncio.create_task(arun_heartbeat(aapi)) if heartbeat_sec else None
+    log.info(f'asyncio runner loop started with {async_concurrency=} {cancel_interval_sec=}')
+
+    i = 0
+    try:
+        while(1):
+            try:
+                if i % 100 == 0:
+                    log.info('procserver is still alive!')
+                    await asyncio.to_thread(update_ticker, t_sleep)
+
+                await atick(aapi, sem)
+                i += 1
+
+                await await_wakeup(aapi, get_t_next_deadline(t_sleep))
+            except Exception as err:
+                log.error(err)
+                traceback.print_exception(err)
+                await asyncio.sleep(t_sleep) # no busy loop while e.G. the server is down
+    finally:
+        task_cancelling.cancel()
+        if task_heartbeat is not None:
+            task_heartbeat.cancel()
+        await aapi.aclose()
+
+
 def startup_testrun():
     dummy_device = runner.device_api.get('dummy_device')
     if dummy_device is None:
@@ -352,9 +655,82 @@ def update_ticker(t_sleep):
     t_last = get_utcnow()
     procserver_info.data_json['t_last'] = make_zulustr(t_last)
     procserver_info.data_json['t_expected_next'] = make_zulustr(t_last + datetime.timedelta(t_sleep))
-    procserver_info.data_json['running_processes'] = [dict(script_id=k, pid=v.pid) for k, v in processes.items()]
+    procserver_info.data_json['running_processes'] = [dict(script_id=k, pid=v.pid) for k, v in list(processes.items())]
+    procserver_info.data_json.setdefault('http_stats', {})[my_runner_id if my_runner_id else 'default'] = api_interface.get_stats()
+    
+    runner.var_api.put(procserver_info)
+
+
+def wait_for_wakeup(t_sleep):
+    """block until the server signals that any script needs attention or t_sleep has passed.
+    falls back to plain sleeping if event wakeup is disabled or the server can not be reached"""
+    global event_seq
+
+    if not use_event_wakeup:
+        time.sleep(t_sleep)
+        return False
+    
+    try:
+        t_start = time.monotonic()
+        res = runner.api_interface.wait_for_events(event_seq, t_sleep)
+        woken, t_again = on_events(res, time.monotonic() - t_start, t_sleep)
+        return wait_for_wakeup(t_again) if t_again else woken
+    except Exception as err:
+        log.warning(f'waiting for events failed with {err=}. Falling back to sleeping for {t_sleep=}')
+        event_seq = None
+        time.sleep(t_sleep)
+        return False
+
+
+async def await_wakeup(aapi:api_interface.AsyncScriptClient, t_sleep:float):
+    """as wait_for_wakeup, but with the async client"""
+    global event_seq
+
+    if not use_event_wakeup:
+        await asyncio.sleep(t_sleep)
+        return False
     
+    try:
+        t_start = time.monotonic()
+        res = await aapi.wait_for_events(event_seq, t_sleep)
+        woken, t_again = on_events(res, time.monotonic() - t_start, t_sleep)
+        return await await_wakeup(aapi, t_again) if t_again else woken
+    except Exception as err:
+        log.warning(f'waiting for events failed with {err=}. Falling back to sleeping for {t_sleep=}')
+        event_seq = None
+        await asyncio.sleep(t_sleep)
+        return False
+
+
+def on_events(res:dict, t_waited:float, t_sleep:float) -> tuple[bool, float]:
+    """keep the event seq of a wait_for_events result and return whether it woke the runner up and how long to wait again"""
+    global event_seq
+    woken = event_seq is not None and not res.get('timed_out', True)
+    event_seq = res['seq']
+    if woken:
+        log.debug(f'woken up by N={len(res.get("events", []))} events (seq={event_seq})')
+    elif event_seq is not None and t_waited < t_sleep:
+        # first call or server restart returns immediately -> wait again for the remaining time
+        return False, t_sleep - t_waited
+    return woken, 0
+
+
+def update_slot_info(force=False):
+    """report the slot occupancy of this runner in the procserver_info project variable (only on changes)"""
+    global slot_info_last
+    info = get_slot_info()
+    if info == slot_info_last and not force:
+        return
+    
+    procserver_info = runner.var_api.get('procserver_info')
+    if procserver_info is None:
+        procserver_info = schema.ProjectVariable(id='procserver_info', data_json={'t_last': None, 't_expected_next': '', 'running_processes': []})
+
+    slots = procserver_info.data_json.get('slots', {})
+    slots[my_runner_id if my_runner_id else 'default'] = {**info, 't_last': make_zulustr(get_utcnow())}
+    procserver_info.data_json['slots'] = slots
     runner.var_api.put(procserver_info)
+    slot_info_last = info
 
 
 def run():
@@ -374,6 +750,13 @@ def run():
     
     startup_testrun()
 
+    if use_asyncio:
+        asyncio.run(arun(t_sleep)) # with its own heartbeat task
+        return
+
+    if heartbeat_sec:
+        threading.Thread(target=run_heartbeat, name='heartbeat', daemon=True).start()
+
     while(1):
         try:
             if i % 100 == 0:
@@ -389,7 +772,7 @@ def run():
 
             
 
-        time.sleep(t_sleep)
+        wait_for_wakeup(get_t_next_deadline(t_sleep))
 
 if __name__ == '__main__':
     log.info('STARTING procserver!')
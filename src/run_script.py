@@ -32,14 +32,10 @@ def run(script_id):
 
     log.info(f'run_script with {PID=} and {script_id=} is starting')
     
+    # setup only: pruning the shared caches (scriptrunner.start) is up to the procserver and the housekeeping, not to each job
     scriptrunner.setup(config)
-    api_interface.setup(config)
-    
-    scriptrunner.start(config)
-    api_interface.start(config)
 
-    script = scriptrunner.run_script(script_id)
-    scriptrunner.init_follow_up_script(script)
+    scriptrunner.run_job(script_id)
 
 
     tend = helpers.get_utcnow()
@@ -54,6 +50,7 @@ def run(script_id):
     seconds = secs
 
     log.info(f'run_script with {PID=} and {script_id=} has finished after: {days} days, {hours:02d}:{minutes:02d}:{seconds:02d}"')
+    log.debug(f'run_script with {PID=} and {script_id=} HTTP latencies: {api_interface.get_stats()}')
 
 
 if __name__ == "__main__":
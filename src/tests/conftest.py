@@ -0,0 +1,24 @@
+import pytest
+
+from JupyRunner.core import db_interface as dbi
+
+
+@pytest.fixture
+def make_db(tmp_path, monkeypatch):
+    """set up and start the db_interface on a temporary DB, e.G. make_db(memoize_ttl_sec=3600) with the given "db" config.
+    The status listeners, the sqlite profile and the other module globals setup changes are reset after the test"""
+    for name in ['engine', 'sqlite_file_name', 'device_max_concurrent', 'max_retries', 'memoize_ttl_sec']:
+        monkeypatch.setattr(dbi, name, getattr(dbi, name))
+    monkeypatch.setattr(dbi, 'status_listeners', [])
+    monkeypatch.setattr(dbi, 'sqlite_profile', dict(dbi.sqlite_profile)) # setup updates it in place
+    engines = []
+
+    def make(**cnfg_db):
+        dbi.setup({'db': {'filepath': str(tmp_path / 'test.db'), **cnfg_db}})
+        dbi.start({})
+        engines.append(dbi.engine)
+        return dbi.engine
+
+    yield make
+    for engine in engines:
+        engine.dispose()
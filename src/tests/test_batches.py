@@ -0,0 +1,36 @@
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, schema
+
+STATUS = schema.STATUS
+
+
+def test_insert_many_and_cancel_batch(make_db):
+    make_db()
+    notified = []
+    listener = lambda obj, status_old=None: notified.append((obj.id, obj.status, status_old))
+    dbi.add_status_listener(listener) # the status listeners are reset after each test by make_db
+    ids = dbi.insert_many([schema.Script(batch_id='b1', status=STATUS.WAITING_TO_RUN, script_params_json={'x': i}) for i in range(5)])
+    other = dbi.insert_many([schema.Script(batch_id='b2', status=STATUS.WAITING_TO_RUN)])
+    assert len(ids) == 5 and len(set(ids)) == 5 and all(ids)
+    assert len(notified) == 6
+
+    dbi.set_property(schema.Script, ids[0], status=STATUS.RUNNING)
+    dbi.set_property(schema.Script, ids[1], status=STATUS.FINISHED)
+    info = dbi.get_batch_info('b1')
+    assert info['n_total'] == 5 and info['n_running'] == 1 and info['n_finished'] == 1 and info['n_queued'] == 3
+    assert info['script_ids'] == ids
+
+    notified.clear()
+    ret = dbi.cancel_batch('b1')
+    assert ret == {str(STATUS.ABORTED): ids[2:], str(STATUS.CANCELLING): ids[:1]}
+    assert sorted((i, s) for i, s, _ in notified) == sorted([(i, STATUS.ABORTED) for i in ids[2:]] + [(ids[0], STATUS.CANCELLING)])
+    assert dbi.cancel_batch('b1') == {} # nothing left to cancel
+
+    with dbi.se() as session:
+        assert session.get(schema.Script, ids[1]).status == STATUS.FINISHED
+        assert session.get(schema.Script, other[0]).status == STATUS.WAITING_TO_RUN
@@ -0,0 +1,36 @@
+import nbformat
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core.cell_cache import get_cell_hashes, get_n_unchanged, get_checkpoint
+
+c = nbformat.v4.new_code_cell
+md = nbformat.v4.new_markdown_cell
+
+
+def test_cell_hashes_chain():
+    cells = [c('x = 1', metadata={'tags': ['injected-parameters']}), md('# title'), c('y = x'), c('print(y)')]
+    h = get_cell_hashes(cells, 'seed')
+    assert h[1] is None and len(set(h)) == 4
+
+    # a change propagates to all following cells, but not to the ones before
+    h2 = get_cell_hashes([cells[0], cells[1], c('y = 2 * x'), cells[3]], 'seed')
+    assert h2[0] == h[0] and h2[2] != h[2] and h2[3] != h[3]
+
+    # the injected parameters only enter through the seed
+    assert get_cell_hashes([c('x = 2', metadata={'tags': ['injected-parameters']})] + cells[1:], 'seed') == h
+    assert get_cell_hashes(cells, 'other')[0] != h[0]
+
+
+def test_resume_point(tmp_path):
+    h = ['a', None, 'b', 'c', 'd']
+    ckpt = tmp_path / 'checkpoint_2.pkl'
+    ckpt.write_bytes(b'')
+    record = {0: dict(hash='a', status='ok'), 2: dict(hash='b', status='ok', checkpoint=str(ckpt)), 3: dict(hash='c', status='error')}
+    assert get_n_unchanged(record, h) == 3
+    assert get_checkpoint(record, 3) == (2, str(ckpt))
+    assert get_checkpoint(record, 2) == (-1, None)
@@ -0,0 +1,173 @@
+import datetime
+import threading
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, schema, helpers
+
+STATUS = schema.STATUS
+
+
+def add_waiting(n, **kwargs):
+    t0 = helpers.get_utcnow() - datetime.timedelta(minutes=1)
+    return dbi.insert_many([schema.Script(script_name='test_claims', status=STATUS.WAITING_TO_RUN, start_condition=t0, **kwargs) for _ in range(n)])
+
+
+def test_concurrent_claims_are_disjoint(make_db):
+    make_db()
+    ids = add_waiting(20)
+
+    claimed = {}
+    def claim(runner_ip):
+        claimed[runner_ip] = []
+        while scripts := dbi.claim_scripts(runner_ip=runner_ip, n_max=3):
+            claimed[runner_ip] += [s.id for s in scripts]
+
+    threads = [threading.Thread(target=claim, args=(ip,)) for ip in ['10.0.0.1', '10.0.0.2', '10.0.0.3']]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    all_claimed = [i for v in claimed.values() for i in v]
+    assert sorted(all_claimed) == sorted(ids) # each script exactly once
+    with dbi.se() as session:
+        for i in ids:
+            script = session.get(schema.Script, i)
+            assert script.status == STATUS.STARTING and script.lease_expires is not None
+
+
+def test_expired_leases_are_requeued(make_db):
+    make_db()
+    ids = add_waiting(3)
+    dbi.set_property(schema.Script, ids[2], data_json={'max_retries': 1})
+    claimed = [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=3, lease_sec=60)]
+    assert sorted(claimed) == sorted(ids)
+    dbi.set_property(schema.Script, ids[1], status=STATUS.RUNNING)
+    dbi.set_property(schema.Script, ids[2], status=STATUS.RUNNING)
+
+    assert dbi.reap_expired_leases() == {} # not expired yet
+    later = helpers.get_utcnow() + datetime.timedelta(seconds=120)
+    ret = dbi.reap_expired_leases(now=later)
+    assert sorted(ret[str(STATUS.WAITING_TO_RUN)]) == sorted([ids[0], ids[2]])
+    assert ret[str(STATUS.FAILED)] == [ids[1]] # no retries left
+
+    with dbi.se() as session:
+        script = session.get(schema.Script, ids[2])
+        assert script.retries == 1 and script.claimed_by is None and script.lease_expires is None
+        assert 'stopped sending heartbeats' in script.errors
+
+    # the requeued scripts can be claimed again
+    assert sorted(s.id for s in dbi.claim_scripts(runner_ip='10.0.0.2', n_max=3)) == sorted([ids[0], ids[2]])
+
+
+def test_lost_lease_is_reported(make_db):
+    make_db()
+    ids = add_waiting(2)
+    dbi.claim_scripts(runner_ip='10.0.0.1', n_max=2, lease_sec=60)
+
+    assert sorted(dbi.renew_leases(runner_ip='10.0.0.1', script_ids=ids)) == sorted(ids)
+    assert dbi.renew_leases(runner_ip='10.0.0.2', script_ids=ids) == [] # not claimed by this runner
+
+    dbi.reap_expired_leases(now=helpers.get_utcnow() + datetime.timedelta(seconds=120))
+    assert dbi.renew_leases(runner_ip='10.0.0.1', script_ids=ids) == [] # requeued meanwhile
+
+
+def test_device_concurrency_limit(make_db):
+    make_db()
+    dbi.add_many([schema.Device(id='dev1'), schema.Device(id='dev2', data_json={'max_concurrent': 2})])
+    dev1 = add_waiting(2, device_id='dev1')
+    dev2 = add_waiting(3, device_id='dev2')
+
+    claimed = [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=10)]
+    assert sorted(claimed) == sorted(dev1[:1] + dev2[:2]) # one for dev1 (the default) and two for dev2
+    assert dbi.claim_scripts(runner_ip='10.0.0.2', n_max=10) == [] # all devices busy
+
+    locks = {x['device_id']: x for x in dbi.get_device_locks()}
+    assert locks['dev1']['is_locked'] and locks['dev1']['holders'][0]['script_id'] == dev1[0]
+    assert locks['dev2']['n_holders'] == 2 and locks['dev2']['max_concurrent'] == 2
+
+    # a finished script releases its device
+    dbi.set_property(schema.Script, dev1[0], status=STATUS.FINISHED)
+    assert [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.2', n_max=10)] == dev1[1:]
+
+
+def test_expire_queued_scripts(make_db):
+    make_db()
+    now = helpers.get_utcnow()
+    past, future = now - datetime.timedelta(minutes=1), now + datetime.timedelta(hours=1)
+    waiting, held, running, pending = dbi.insert_many([
+        schema.Script(status=STATUS.WAITING_TO_RUN, start_condition=past - datetime.timedelta(hours=1), end_condition=past),
+        schema.Script(status=STATUS.HOLD, end_condition=past),
+        schema.Script(status=STATUS.RUNNING, end_condition=past), # running jobs are terminated by their runner
+        schema.Script(status=STATUS.WAITING_TO_RUN, end_condition=future),
+    ])
+
+    assert sorted(dbi.expire_queued_scripts(now)) == sorted([waiting, held])
+    assert dbi.expire_queued_scripts(now) == []
+    with dbi.se() as session:
+        assert session.get(schema.Script, waiting).status == STATUS.EXPIRED
+        assert 'expired before it was started' in session.get(schema.Script, held).errors
+        assert session.get(schema.Script, running).status == STATUS.RUNNING
+        assert session.get(schema.Script, pending).status == STATUS.WAITING_TO_RUN
+
+    # expired scripts are never claimed
+    assert [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=10)] == [pending]
+
+
+def test_slot_costs_are_at_least_one(make_db):
+    make_db()
+    add_waiting(2, data_json={'slot_cost': 0})
+    add_waiting(2, data_json={'slot_cost': -3})
+    assert [s.get_slot_cost() for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=10, max_cost=3)] == [1, 1, 1]
+
+
+def get_queue(**scheduler):
+    with dbi.se() as session:
+        return [s.id for s in session.exec(dbi.get_queue_query(**scheduler)).all()]
+
+
+def test_priority_beats_fifo(make_db):
+    make_db()
+    low = add_waiting(2)
+    high = add_waiting(1, priority=5)
+
+    assert get_queue(policy='fifo') == low + high
+    assert get_queue(policy='priority') == high + low
+    assert [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=2, scheduler={'policy': 'fair_share'})] == high + low[:1]
+
+
+def test_fair_share_round_robin(make_db):
+    make_db()
+    alice = add_waiting(3, submitter='alice')
+    bob = add_waiting(3, submitter='bob')
+
+    assert get_queue(policy='fifo') == alice + bob
+    assert get_queue(policy='fair_share') == [alice[0], bob[0], alice[1], bob[1], alice[2], bob[2]]
+    claimed = [s.id for s in dbi.claim_scripts(runner_ip='10.0.0.1', n_max=4, scheduler={'policy': 'fair_share', 'share_key': 'submitter'})]
+    assert claimed == [alice[0], bob[0], alice[1], bob[1]]
+
+
+def test_fair_share_weights(make_db):
+    make_db()
+    alice = add_waiting(6, submitter='alice')
+    bob = add_waiting(6, submitter='bob')
+
+    queue = get_queue(policy='fair_share', weights={'alice': 2})
+    assert queue[:6] == [alice[0], alice[1], bob[0], alice[2], alice[3], bob[1]] # twice the share for alice
+    assert get_queue(policy='fair_share', weights={'bob': 2, '__default__': 1})[:3] == [bob[0], alice[0], bob[1]]
+
+
+def test_fair_share_counts_active_jobs(make_db):
+    make_db()
+    dbi.insert_many([schema.Script(script_name='test_claims', status=STATUS.RUNNING, submitter='bob') for _ in range(2)])
+    bob = add_waiting(2, submitter='bob')
+    alice = add_waiting(2, submitter='alice')
+
+    # bob already runs two jobs, so alice goes first even though bobs scripts are older
+    assert get_queue(policy='fair_share') == alice + bob
+    assert get_queue(policy='fifo') == bob + alice
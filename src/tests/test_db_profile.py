@@ -0,0 +1,41 @@
+import pytest
+import sqlalchemy
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi
+
+
+def test_make_engine_pragmas(tmp_path):
+    profile = {**dbi.sqlite_profile, 'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size_kib': 1024, 'mmap_size_mb': 1, 'busy_timeout_ms': 1234}
+    eng = dbi.make_engine(f"sqlite:///{tmp_path / 'test.db'}", profile)
+    with eng.connect() as conn:
+        pragma = lambda name: conn.exec_driver_sql(f'PRAGMA {name}').scalar()
+        assert pragma('journal_mode') == 'wal'
+        assert pragma('synchronous') == 1 # NORMAL
+        assert pragma('cache_size') == -1024
+        assert pragma('mmap_size') == 1024**2
+        assert pragma('busy_timeout') == 1234
+    eng.dispose()
+
+
+def test_check_db_profile(make_db):
+    make_db(sqlite={'synchronous': 'FULL', 'busy_timeout_ms': 2000})
+    info = dbi.check_db_profile()
+    assert info['effective']['journal_mode'] == 'wal'
+    assert info['effective']['synchronous'] == 2 # FULL
+    assert info['effective']['busy_timeout'] == 2000
+
+    # failing statements are not counted and do not mix up the timing of the next one
+    n = dbi.get_query_stats()['n_queries']
+    with dbi.engine.connect() as conn:
+        with pytest.raises(sqlalchemy.exc.OperationalError):
+            conn.exec_driver_sql('SELECT * FROM no_such_table')
+        assert 't_query' in conn.info
+        conn.exec_driver_sql('SELECT 1')
+        assert not 't_query' in conn.info
+    assert dbi.get_query_stats()['n_queries'] == n + 1
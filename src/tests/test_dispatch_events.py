@@ -0,0 +1,61 @@
+import asyncio
+import threading
+import time
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import dispatch_events, schema
+
+
+def notify_later(script_id, dt=0.2):
+    timer = threading.Timer(dt, dispatch_events.notify, args=(script_id, schema.STATUS.WAITING_TO_RUN))
+    timer.start()
+    return timer
+
+
+def test_wait():
+    seq = dispatch_events.wait()['seq'] # no since --> the current seq right away
+
+    t0 = time.monotonic()
+    res = dispatch_events.wait(seq, timeout=0.2)
+    assert res == dict(seq=seq, events=[], timed_out=True) and time.monotonic() - t0 >= 0.2
+
+    notify_later(11)
+    res = dispatch_events.wait(seq, timeout=5)
+    assert res['seq'] == seq + 1 and not res['timed_out']
+    assert [(e['script_id'], e['status']) for e in res['events']] == [(11, 'WAITING_TO_RUN')]
+
+    # a since beyond the current seq means the server was restarted --> return immediately with the new seq
+    t0 = time.monotonic()
+    res = dispatch_events.wait(seq + 1000, timeout=5)
+    assert res == dict(seq=seq + 1, events=[], timed_out=False) and time.monotonic() - t0 < 1
+
+
+def test_await_events():
+    seq = dispatch_events.get_seq()
+    res = asyncio.run(dispatch_events.await_events(seq, timeout=0.2))
+    assert res == dict(seq=seq, events=[], timed_out=True)
+
+    async def main():
+        notify_later(12)
+        return await asyncio.gather(*[dispatch_events.await_events(seq, timeout=5) for _ in range(3)])
+
+    t0 = time.monotonic()
+    for res in asyncio.run(main()): # all waiters are woken up
+        assert [e['script_id'] for e in res['events']] == [12] and not res['timed_out']
+    assert time.monotonic() - t0 < 2
+    assert not dispatch_events._waiters
+    assert asyncio.run(dispatch_events.await_events(seq + 1000))['seq'] == seq + 1
+
+
+def test_on_status_change():
+    seq = dispatch_events.get_seq()
+    dispatch_events.on_status_change(schema.Script(id=13, status=schema.STATUS.RUNNING))
+    dispatch_events.on_status_change(schema.Script(id=13, status=schema.STATUS.CANCELLING), status_old=schema.STATUS.CANCELLING)
+    assert dispatch_events.get_seq() == seq
+    dispatch_events.on_status_change(schema.Script(id=13, status=schema.STATUS.CANCELLING), status_old=schema.STATUS.RUNNING)
+    assert dispatch_events.get_seq() == seq + 1
@@ -0,0 +1,39 @@
+import datetime
+import pytest
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core.helpers_cron import CronExpr, get_next_fire
+
+t0 = datetime.datetime(2026, 10, 18, 11, 27, 30) # a sunday
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('*/15 * * * *', datetime.datetime(2026, 10, 18, 11, 30)),
+    ('0 9 * * mon-fri', datetime.datetime(2026, 10, 19, 9, 0)),
+    ('@daily', datetime.datetime(2026, 10, 19, 0, 0)),
+    ('30 2 1 * *', datetime.datetime(2026, 11, 1, 2, 30)),
+    ('0 0 29 2 *', datetime.datetime(2028, 2, 29, 0, 0)),
+    ('0 12 13 * fri', datetime.datetime(2026, 10, 23, 12, 0)), # day of month OR day of week
+    ('5/20 8-9 * * *', datetime.datetime(2026, 10, 19, 8, 5)),
+    ('0 0 * * 7', datetime.datetime(2026, 10, 25, 0, 0)),
+])
+def test_cron_next(expr, expected):
+    assert CronExpr(expr).get_next(t0) == expected
+
+
+def test_cron_invalid():
+    for expr in ['61 * * * *', '* * * *', '*/0 * * * *']:
+        with pytest.raises(AssertionError):
+            CronExpr(expr)
+
+
+def test_interval_next():
+    t_start = datetime.datetime(2026, 10, 18, 11, 0, 5)
+    assert get_next_fire(t0, interval_sec=600, t_start=t_start) == datetime.datetime(2026, 10, 18, 11, 30, 5)
+    assert get_next_fire(t_start - datetime.timedelta(hours=1), interval_sec=600, t_start=t_start) == t_start
+
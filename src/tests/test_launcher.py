@@ -0,0 +1,64 @@
+import subprocess
+import threading
+import pytest
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import launcher, kernel_pool, scriptrunner
+
+
+def test_thread_job_cancelled_before_kernel(tmp_path, monkeypatch):
+    gate = threading.Event()
+    ran = []
+
+    def run_job(script_id):
+        gate.wait(5) # e.G. still preparing the run when the cancel arrives
+        with kernel_pool.get_kernel(owner=script_id):
+            ran.append(script_id)
+
+    monkeypatch.setattr(scriptrunner, 'run_job', run_job)
+    job = launcher.ThreadJob(1, launcher.RotatingLogFile(str(tmp_path / 'script_1.log')))
+    job.terminate()
+    with pytest.raises(subprocess.TimeoutExpired):
+        job.wait(0.1)
+    job.kill()
+    assert job.poll() is None # keeps its slot while the thread still runs
+    assert job.communicate()[1] == b'' # does not block
+
+    gate.set()
+    assert job.wait(5) == -9
+    assert ran == [] # never got a kernel
+    assert b'Cancelled' in job.err_tail
+    assert not 1 in kernel_pool.cancelled
+
+    # a new run of the same script is not affected
+    job = launcher.ThreadJob(1, launcher.RotatingLogFile(str(tmp_path / 'script_1.log')))
+    assert job.wait(5) == 0 and ran == [1]
+
+
+def test_forked_job(tmp_path, monkeypatch):
+    cnfg = {
+        'globals': {'dbserver_uri': 'http://127.0.0.1:9', 'mattermost_uri': '', 'loglevel': 'INFO'}, # nothing listens there
+        'http': {'retries': 0},
+        'pathes': {'default_dir_libs': str(tmp_path)},
+        'procserver': {'launcher': 'forkserver'},
+    }
+    monkeypatch.setattr(launcher.filesys_storage_api, 'default_dir_logs', str(tmp_path / 'logs'))
+    for name in ['config', 'launcher', 'log_err_tail_bytes']: # setup changes them
+        monkeypatch.setattr(launcher, name, getattr(launcher, name))
+    launcher.setup(cnfg)
+    if launcher.launcher != 'forkserver':
+        pytest.skip('no forkserver on this platform')
+
+    job = launcher.launch(5)
+    out, err = job.communicate()
+    assert job.returncode == 1 # the job can not reach the server
+    assert b'ConnectionError' in err
+
+    text = (tmp_path / 'logs' / 'script_5.log').read_text()
+    assert "starting job for script_id=5 with launcher='forkserver'" in text
+    assert 'forked job with PID=' in text and 'ConnectionError' in text # stdout and stderr of the child
@@ -0,0 +1,48 @@
+import datetime
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, schema, helpers
+
+STATUS = schema.STATUS
+
+
+def add_script(**kwargs):
+    kwargs = {'script_version': 'v1', 'script_params_json': {'freq': 1}, **kwargs}
+    script = schema.Script(**kwargs)
+    script.set_params_hash()
+    return dbi.insert_many([script])[0]
+
+
+def test_memoize_script(make_db):
+    make_db(memoize_ttl_sec=3600)
+    now = helpers.get_utcnow()
+
+    cached = add_script(status=STATUS.FINISHED, time_finished=now - datetime.timedelta(minutes=5), script_out_path='/out/run.html',
+                        data_json={'outputs': {'f0': 1.5}})
+    dbi.add_many([schema.Datafile(script_id=cached, filename='data.csv', file_path='/out/data.csv')])
+
+    opt_in = {'memoize': True}
+    assert dbi.memoize_script(add_script(status=STATUS.WAITING_TO_RUN)) is None # did not opt in
+    assert dbi.memoize_script(add_script(status=STATUS.WAITING_TO_RUN, data_json=opt_in, script_params_json={'freq': 2})) is None
+    assert dbi.memoize_script(add_script(status=STATUS.WAITING_TO_RUN, data_json=opt_in, script_version='v2')) is None
+    assert dbi.memoize_script(add_script(status=STATUS.WAITING_TO_RUN, data_json={**opt_in, 'memoize_ttl_sec': 60})) is None # too old
+    assert dbi.memoize_script(add_script(status=STATUS.RUNNING, data_json=opt_in)) is None # not queued anymore
+
+    script_id = add_script(status=STATUS.AWAITING_CHECK, data_json=opt_in)
+    script = dbi.memoize_script(script_id)
+    assert script.status == STATUS.FINISHED and script.script_out_path == '/out/run.html'
+    assert script.data_json['memoized_from'] == cached and script.data_json['outputs'] == {'f0': 1.5}
+    with dbi.se() as session:
+        source, = session.get(schema.Script, cached).datafiles
+        datafile, = session.get(schema.Script, script_id).datafiles
+        assert datafile.id != source.id and datafile.data_json['memoized_from'] == source.id
+        assert datafile.file_path == '/out/data.csv' and datafile.filename == 'data.csv'
+
+    # a memoized run is never the source of another one, the TTL counts from the real execution
+    again = dbi.memoize_script(add_script(status=STATUS.WAITING_TO_RUN, data_json=opt_in))
+    assert again.data_json['memoized_from'] == cached
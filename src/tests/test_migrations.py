@@ -0,0 +1,29 @@
+import sqlalchemy
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi
+
+
+def get_indexes(table):
+    return {ix['name'] for ix in sqlalchemy.inspect(dbi.engine).get_indexes(table)}
+
+
+def test_migrations(make_db):
+    make_db()
+    assert [m['version'] for m in dbi.get_migrations()] == [v for v, _, _ in dbi.MIGRATIONS]
+    assert {'ix_script_status_start_condition', 'ix_script_device_id_status'} <= get_indexes('script')
+    assert 'ix_datafile_script_id' in get_indexes('datafile')
+    assert dbi.apply_migrations() == []
+
+    # an existing DB from before the migration gets the indexes at the next start
+    with dbi.engine.begin() as conn:
+        conn.execute(sqlalchemy.text('DROP INDEX ix_script_status_start_condition'))
+        conn.execute(sqlalchemy.text('DELETE FROM schemamigration'))
+    dbi.start({})
+    assert 'ix_script_status_start_condition' in get_indexes('script')
+    assert [m['version'] for m in dbi.get_migrations()] == [1]
@@ -0,0 +1,69 @@
+import datetime
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, schema
+
+
+def add_scripts(t0, minutes):
+    dbi.add_many([schema.Script(script_name='test_pagination', start_condition=t0 + datetime.timedelta(minutes=m)) for m in minutes])
+
+
+def get_page(**kwargs):
+    with dbi.se() as session:
+        page = dbi.qry_scripts_page(session, script_name='test_pagination', **kwargs)
+        return [s.id for s in page['data']], page['next_cursor'], page['prev_cursor']
+
+
+def test_keyset_pages(make_db):
+    make_db()
+    t0 = datetime.datetime(2024, 1, 1, 12)
+    add_scripts(t0, [0, 1, 1, 1, 2, 3, 4]) # equal start_conditions are ordered by id
+    with dbi.se() as session:
+        expected = [s.id for s in dbi.qry_scripts_sub(session, script_name='test_pagination', order='asc')]
+
+    for order in ['asc', 'desc']:
+        ids = expected if order == 'asc' else expected[::-1]
+        pages, cursor = [], None
+        while True:
+            page, cursor, prev_cursor = get_page(n_max=3, cursor=cursor, order=order)
+            assert (prev_cursor is None) == (not pages)
+            pages.append(page)
+            if cursor is None:
+                break
+        assert pages == [ids[:3], ids[3:6], ids[6:]]
+
+        # back from the last page
+        page, next_cursor, prev_cursor = get_page(n_max=3, cursor=prev_cursor, order=order)
+        assert page == ids[3:6] and next_cursor
+        page, next_cursor, prev_cursor = get_page(n_max=3, cursor=prev_cursor, order=order)
+        assert page == ids[:3] and next_cursor and prev_cursor is None
+
+    # inserts before the current page do not shift the next one
+    first, cursor, _ = get_page(n_max=3, order='asc')
+    add_scripts(t0, [-5, 0, -1])
+    assert get_page(n_max=3, cursor=cursor, order='asc')[0] == expected[3:6]
+
+    try:
+        dbi.decode_cursor('not a cursor')
+        assert False, 'an invalid cursor must raise'
+    except ValueError:
+        pass
+
+
+def test_tabledata_pages(make_db):
+    make_db()
+    add_scripts(datetime.datetime(2024, 1, 1, 12), range(5))
+    kwargs = dict(t_min=None, t_max=None, skipn=0, script_name='test_pagination')
+
+    dc = dbi.qry_tabledata(n_max=-1, **kwargs) # all rows without cursors
+    assert len(dc['data']) == 5 and dc['next_cursor'] is None and dc['prev_cursor'] is None
+
+    dc = dbi.qry_tabledata(n_max=2, **kwargs)
+    assert len(dc['data']) == 2 and dc['next_cursor'] and dc['prev_cursor'] is None
+    dc = dbi.qry_tabledata(n_max=2, cursor=dc['next_cursor'], **kwargs)
+    assert len(dc['data']) == 2 and dc['prev_cursor']
@@ -0,0 +1,88 @@
+import time
+import pytest
+import requests
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core.api_interface import PatchBatcher, get_endpoint_key
+
+
+class FakeClient():
+    """records the patch_many calls and fails the next n_fail of them"""
+    def __init__(self, n_fail=0, status_code=503):
+        self.calls = []
+        self.n_fail = n_fail
+        self.status_code = status_code
+
+    def patch_many(self, changes):
+        if self.n_fail:
+            self.n_fail -= 1
+            response = requests.Response()
+            response.status_code = self.status_code
+            raise requests.HTTPError(f'{self.status_code} Error', response=response)
+        self.calls.append(changes)
+        return list(changes)
+
+
+def test_endpoint_key():
+    assert get_endpoint_key('patch', 'http://localhost:7990/script/12') == 'PATCH /script/{id}'
+    assert get_endpoint_key('GET', 'https://host:1/action/script/3/trigger_upload?is_dryrun=0') == 'GET /action/script/{id}/trigger_upload'
+    assert get_endpoint_key('GET', 'http://host/qry/script/cell_durations?script_name=a1') == 'GET /qry/script/cell_durations'
+    assert get_endpoint_key('PATCH', 'http://host/script') == 'PATCH /script'
+
+
+def test_coalescing():
+    client = FakeClient()
+    batcher = PatchBatcher(client, max_n=3, max_delay=0)
+    batcher.patch(1, progress_json={'cell': 1})
+    batcher.patch(1, progress_json={'cell': 2}, status='RUNNING')
+    batcher.patch('2', status='FAULTY')
+    assert not client.calls
+
+    assert batcher.flush() == [1, 2]
+    assert client.calls == [{1: {'progress_json': {'cell': 2}, 'status': 'RUNNING'}, 2: {'status': 'FAULTY'}}]
+    assert batcher.flush() == [] and len(client.calls) == 1 # nothing pending
+
+    # max_n pending scripts flush right away
+    for i in range(3):
+        batcher.patch(10 + i, status='FAULTY')
+    assert len(client.calls) == 2 and list(client.calls[-1]) == [10, 11, 12]
+    assert not batcher.pending
+
+
+def test_requeue_on_failure():
+    client = FakeClient(n_fail=1)
+    batcher = PatchBatcher(client, max_delay=0)
+    batcher.patch(1, progress_json={'cell': 1}, status='RUNNING')
+    with pytest.raises(requests.HTTPError):
+        batcher.flush()
+
+    # the newer change made in between wins over the one kept from the failed flush
+    batcher.patch(1, progress_json={'cell': 2})
+    batcher.flush()
+    assert client.calls == [{1: {'progress_json': {'cell': 2}, 'status': 'RUNNING'}}]
+
+    # rejected changes are dropped since they would fail forever
+    client = FakeClient(n_fail=1, status_code=404)
+    batcher = PatchBatcher(client, max_delay=0)
+    batcher.patch(1, status='FAULTY')
+    with pytest.raises(requests.HTTPError):
+        batcher.flush()
+    assert not batcher.pending
+
+
+def test_timer_rearms_on_failure():
+    client = FakeClient(n_fail=2)
+    batcher = PatchBatcher(client, max_delay=0.05)
+    batcher.patch(1, status='FAULTY')
+
+    t_end = time.monotonic() + 5
+    while not client.calls and time.monotonic() < t_end:
+        time.sleep(0.02)
+
+    assert client.calls == [{1: {'status': 'FAULTY'}}]
+    assert client.n_fail == 0 and not batcher.pending and batcher._timer is None
@@ -0,0 +1,129 @@
+import pytest
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, pipelines, schema
+from JupyRunner.core.pipelines import expand_stages
+from JupyRunner.core.helpers_papermill import get_outputs, SCRAP_MIMETYPE
+
+STATUS = schema.STATUS
+
+
+def test_expand_foreach():
+    stages = {
+        'measure': {'script_in_path': 'measure.ipynb', 'foreach': {'device_id': ['dev1', 'dev2']}},
+        'sweep': {'script_in_path': 'sweep.ipynb', 'foreach': {'freq': [1, 2]}, 'script_params_json': {'power': 0}, 'depends_on': ['measure']},
+        'analyse': {'script_in_path': 'analyse.ipynb', 'depends_on': ['measure', 'sweep']},
+    }
+    instances, deps = expand_stages(stages)
+
+    assert list(instances) == ['measure[dev1]', 'measure[dev2]', 'sweep[1]', 'sweep[2]', 'analyse']
+    assert instances['measure[dev2]'] == {'script_in_path': 'measure.ipynb', 'device_id': 'dev2'}
+    assert instances['sweep[1]']['script_params_json'] == {'power': 0, 'freq': 1}
+    assert deps['measure[dev1]'] == []
+    assert deps['sweep[2]'] == ['measure[dev1]', 'measure[dev2]']
+    assert deps['analyse'] == ['measure[dev1]', 'measure[dev2]', 'sweep[1]', 'sweep[2]']
+    assert 'foreach' in stages['measure'] # the definition is not changed
+
+
+def test_expand_invalid():
+    with pytest.raises(AssertionError, match='cycle'):
+        expand_stages({'a': {'script_in_path': 'a.ipynb', 'depends_on': ['c']},
+                       'b': {'script_in_path': 'b.ipynb', 'depends_on': ['a']},
+                       'c': {'script_in_path': 'c.ipynb', 'depends_on': ['b']},
+                       'd': {'script_in_path': 'd.ipynb'}})
+    with pytest.raises(AssertionError, match='cycle'):
+        expand_stages({'a': {'script_in_path': 'a.ipynb', 'depends_on': ['a']}})
+    with pytest.raises(AssertionError, match='unknown stage'):
+        expand_stages({'a': {'script_in_path': 'a.ipynb', 'depends_on': ['nope']}})
+    with pytest.raises(AssertionError, match='script_in_path'):
+        expand_stages({'a': {}})
+    with pytest.raises(AssertionError, match='foreach'):
+        expand_stages({'a': {'script_in_path': 'a.ipynb', 'foreach': {'x': [1], 'y': [2]}}})
+
+
+def test_get_outputs():
+    nb = {'cells': [
+        {'cell_type': 'code', 'metadata': {}, 'outputs': [{'output_type': 'display_data', 'data': {SCRAP_MIMETYPE: {'name': 'f0', 'data': 1.5, 'encoder': 'json'}}}]},
+        {'cell_type': 'code', 'metadata': {'tags': ['outputs']}, 'outputs': [{'output_type': 'display_data', 'data': {'application/json': {'n': 3}}}]},
+        {'cell_type': 'code', 'metadata': {}, 'outputs': [{'output_type': 'display_data', 'data': {'application/json': {'ignored': 1}}}]},
+        {'cell_type': 'markdown', 'metadata': {}},
+    ]}
+    assert get_outputs(nb) == {'f0': 1.5, 'n': 3}
+
+
+@pytest.fixture
+def pipeline_db(make_db, tmp_path):
+    """a temporary db with the pipelines advancing on status changes and a notebook for every stage"""
+    make_db()
+    dbi.add_status_listener(pipelines.on_status_change)
+    for name in ['prep', 'measure', 'analyse']:
+        (tmp_path / f'{name}.ipynb').write_text('{}')
+    return {
+        'prep': {'script_in_path': str(tmp_path / 'prep.ipynb')},
+        'measure': {'script_in_path': str(tmp_path / 'measure.ipynb'), 'foreach': {'device_id': ['dev1', 'dev2']}, 'depends_on': ['prep']},
+        'analyse': {'script_in_path': str(tmp_path / 'analyse.ipynb'), 'depends_on': ['measure']},
+    }
+
+
+def get_stati(pipeline_id):
+    return {k: v['status'] for k, v in pipelines.get_pipeline_info(pipeline_id)['stages'].items()}
+
+
+def test_pipeline_run(pipeline_db):
+    pipeline = pipelines.create_pipeline('test', pipeline_db, submitter='alice')
+    ids = pipeline.script_ids_json
+    assert get_stati(pipeline.id) == {'prep': STATUS.INITIALIZING, 'measure[dev1]': STATUS.HOLD, 'measure[dev2]': STATUS.HOLD, 'analyse': STATUS.HOLD}
+
+    # the outputs of a parent are passed to its children
+    dbi.set_property(schema.Script, ids['prep'], data_json={'outputs': {'f0': 1.5}}, status=STATUS.FINISHED)
+    stati = get_stati(pipeline.id)
+    assert stati['measure[dev1]'] == stati['measure[dev2]'] == STATUS.INITIALIZING and stati['analyse'] == STATUS.HOLD
+    script = dbi.get(schema.Script, ids['measure[dev2]'])
+    assert script.device_id == 'dev2' and script.submitter == 'alice'
+    parents = script.script_params_json['parents']
+    assert list(parents) == ['prep'] and parents['prep']['script_id'] == ids['prep'] and parents['prep']['outputs'] == {'f0': 1.5}
+
+    # fan in: the join waits for all foreach instances
+    dbi.set_property(schema.Script, ids['measure[dev1]'], status=STATUS.FINISHED)
+    assert get_stati(pipeline.id)['analyse'] == STATUS.HOLD
+    dbi.set_property(schema.Script, ids['measure[dev2]'], status=STATUS.FINISHED)
+    assert get_stati(pipeline.id)['analyse'] == STATUS.INITIALIZING
+    assert list(dbi.get(schema.Script, ids['analyse']).script_params_json['parents']) == ['measure[dev1]', 'measure[dev2]']
+
+    dbi.set_property(schema.Script, ids['analyse'], status=STATUS.FINISHED)
+    pipeline = dbi.get(schema.Pipeline, pipeline.id)
+    assert pipeline.status == STATUS.FINISHED and pipeline.time_finished is not None
+
+
+def test_pipeline_failure_aborts_descendants(pipeline_db):
+    pipeline = pipelines.create_pipeline('test', pipeline_db)
+    ids = pipeline.script_ids_json
+    dbi.set_property(schema.Script, ids['prep'], status=STATUS.FINISHED)
+
+    dbi.set_property(schema.Script, ids['measure[dev1]'], status=STATUS.FAILED)
+    stati = get_stati(pipeline.id)
+    assert stati['analyse'] == STATUS.ABORTED and stati['measure[dev2]'] == STATUS.INITIALIZING # siblings keep running
+    assert 'measure[dev1]' in dbi.get(schema.Script, ids['analyse']).errors
+    assert dbi.get(schema.Pipeline, pipeline.id).status == STATUS.RUNNING
+
+    dbi.set_property(schema.Script, ids['measure[dev2]'], status=STATUS.FINISHED)
+    assert dbi.get(schema.Pipeline, pipeline.id).status == STATUS.FAILED
+
+
+def test_cancel_pipeline(pipeline_db):
+    pipeline = pipelines.create_pipeline('test', pipeline_db)
+    ids = pipeline.script_ids_json
+    dbi.set_property(schema.Script, ids['prep'], status=STATUS.RUNNING)
+
+    ret = pipelines.cancel_pipeline(pipeline.id)
+    assert ret == {'prep': STATUS.CANCELLING, 'measure[dev1]': STATUS.ABORTED, 'measure[dev2]': STATUS.ABORTED, 'analyse': STATUS.ABORTED}
+    assert dbi.get(schema.Pipeline, pipeline.id).status == STATUS.CANCELLING
+
+    # the pipeline is done once its running stage was cancelled by its runner
+    dbi.set_property(schema.Script, ids['prep'], status=STATUS.CANCELLED)
+    assert dbi.get(schema.Pipeline, pipeline.id).status == STATUS.CANCELLED
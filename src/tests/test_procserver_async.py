@@ -0,0 +1,140 @@
+import asyncio
+import importlib
+import yaml
+import pytest
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import schema, launcher
+
+STATUS = schema.STATUS
+
+
+class FakeAsyncClient():
+    """the parts of api_interface.AsyncScriptClient the asyncio runner loop uses, on an in memory dict of scripts"""
+    def __init__(self, scripts):
+        self.scripts = {s.id: s for s in scripts}
+        self.lost = []
+
+    async def get(self, script_id):
+        return self.scripts.get(script_id)
+
+    async def patch(self, script_id, **kwargs):
+        return self.patch_sync(script_id, **kwargs)
+
+    def patch_sync(self, script_id, **kwargs):
+        script = self.scripts[getattr(script_id, 'id', script_id)]
+        for k, v in kwargs.items():
+            setattr(script, k, v)
+        return script
+
+    async def qry(self, stati=None, n_max=-1, skipn=0):
+        return [s.model_copy() for s in self.scripts.values() if stati is None or s.status in stati]
+
+    async def claim(self, runner_id=None, runner_ip=None, n_max=1, max_cost=None, cost_cap=None, lease_sec=120, scheduler=None):
+        claimed = [s for s in self.scripts.values() if s.status == STATUS.WAITING_TO_RUN][:n_max]
+        for s in claimed:
+            s.status = STATUS.STARTING
+        return [s.model_copy() for s in claimed]
+
+    async def renew_leases(self, script_ids, runner_id=None, runner_ip=None, lease_sec=120):
+        return {'renewed': [i for i in script_ids if not i in self.lost], 'lost': self.lost}
+
+    async def wait_for_events(self, since=None, timeout=30):
+        return {'seq': (since or 0) + 1, 'events': [], 'timed_out': False}
+
+
+class FakeJob():
+    """a job which runs until it is terminated"""
+    def __init__(self, script_id):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def terminate(self):
+        self.returncode = -15
+
+    def kill(self):
+        self.returncode = -9
+
+    def communicate(self):
+        return b'', b'terminated'
+
+
+@pytest.fixture
+def ps(tmp_path, monkeypatch):
+    """the procserver module (which reads ./config.yaml on import) with its jobs reset and no real jobs or sync HTTP calls"""
+    with open(os.path.join(parent_dir, 'config.yaml')) as fp:
+        cnfg = yaml.safe_load(fp)
+    cnfg['globals']['dbserver_uri'] = 'http://127.0.0.1:9'
+    cnfg['pathes'] = {k: str(tmp_path / k) for k in list(cnfg['pathes']) + ['default_dir_libs']}
+    cnfg['procserver'].update(launcher='subprocess', do_direct_running=0, max_slots=2, heartbeat_sec=0, max_runtime_sec=0)
+    with open(tmp_path / 'config.yaml', 'w') as fp:
+        yaml.safe_dump(cnfg, fp)
+    monkeypatch.chdir(tmp_path)
+
+    if 'procserver' in sys.modules:
+        procserver = importlib.reload(sys.modules['procserver'])
+    else:
+        procserver = importlib.import_module('procserver')
+
+    monkeypatch.setattr(launcher, 'launch', FakeJob)
+    monkeypatch.setattr(procserver, 'update_slot_info', lambda force=False: None)
+    yield procserver
+    for d in [procserver.processes, procserver.slot_costs, procserver.deadlines]:
+        d.clear()
+    procserver.lost_leases.clear()
+    procserver.abandoned.clear()
+
+
+def test_atick(ps, monkeypatch):
+    scripts = [schema.Script(id=i, script_in_path='bad' if i == 2 else 'ok', status=STATUS.AWAITING_CHECK if i <= 2 else STATUS.WAITING_TO_RUN) for i in range(1, 6)]
+    aapi = FakeAsyncClient(scripts)
+
+    def check(script):
+        if script.script_in_path == 'bad':
+            script.append_error_msg('no such notebook')
+            return script, STATUS.FAULTY
+        return script, STATUS.WAITING_TO_RUN
+    monkeypatch.setattr(ps, '_check_script', check)
+    monkeypatch.setattr(ps, 'get_script', lambda script_id: aapi.scripts[script_id].model_copy())
+    monkeypatch.setattr(ps, 'set_prop_remote', aapi.patch_sync)
+
+    async def main():
+        sem = asyncio.Semaphore(ps.async_concurrency)
+        await ps.atick(aapi, sem)
+        assert aapi.scripts[1].status in [STATUS.WAITING_TO_RUN, STATUS.STARTING] # the checks run concurrently to the claims
+        assert aapi.scripts[2].status == STATUS.FAULTY and 'no such notebook' in aapi.scripts[2].errors
+        started = sorted(ps.processes)
+        assert len(started) == 2 and not 2 in started # only max_slots jobs
+        assert all(aapi.scripts[i].status == STATUS.STARTING for i in started)
+
+        await ps.atick(aapi, sem)
+        assert sorted(ps.processes) == started # no free slots
+
+        # cancelling
+        cancelled, other = started
+        aapi.scripts[cancelled].status = STATUS.CANCELLING
+        await ps.atick_cancelling(aapi)
+        assert aapi.scripts[cancelled].status == STATUS.CANCELLED and sorted(ps.processes) == [other]
+
+        # lost leases terminate the job, which is then discarded without a status change
+        aapi.lost = [other]
+        await ps.atick_renew_leases(aapi)
+        assert ps.processes[other].returncode == -15 and other in ps.lost_leases
+        await ps.atick(aapi, sem)
+        assert sorted(ps.processes) == sorted({1, 3, 4, 5} - set(started)) and not ps.lost_leases
+        assert aapi.scripts[other].status == STATUS.STARTING
+
+        monkeypatch.setattr(ps, 'event_seq', 1)
+        assert await ps.await_wakeup(aapi, 1) # woken up by the events
+
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+import nbformat
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core.progress import get_eta, get_median_durations, ProgressReporter
+
+c = nbformat.v4.new_code_cell
+md = nbformat.v4.new_markdown_cell
+
+
+def test_eta():
+    code_indices = [0, 2, 3]
+    history = get_median_durations([[1, None, 10, 5], [3, None, 20, 7], [2, None, 30]])
+    assert history == [2, None, 20, 6]
+
+    assert get_eta(history, {}, code_indices, 0) == 28
+    assert get_eta(history, {0: 1}, code_indices, 2, elapsed_in_cell=5) == 21
+    assert get_eta(history, {0: 1}, code_indices, 2, elapsed_in_cell=50) == 6
+
+    # without a history the cells executed so far are the estimate
+    assert get_eta([], {}, code_indices, 0) is None
+    assert get_eta([], {0: 4}, code_indices, 2) == 8
+
+
+def test_reporter_rate_limit():
+    records = []
+    reporter = ProgressReporter(records.append, min_interval_sec=3600)
+    cells = [c('x = 1'), md('# title'), c('y = x', metadata={'jupyrunner': {'cached': True}})]
+    reporter.start(cells)
+    for i, cell in enumerate(cells):
+        reporter.on_cell_start(cell, i)
+        reporter.on_cell_complete(cell, i)
+    reporter.finish()
+
+    assert len(records) == 2 # the first cell and the end
+    assert records[0]['cell'] == 1 and records[0]['n_cells'] == 2 and not records[0]['done']
+    assert records[-1]['done'] and records[-1]['eta_sec'] == 0 and records[-1]['cell'] == 2
+    assert len(records[-1]['durations']) == 3 and records[-1]['durations'][0] is not None and records[-1]['durations'][1:] == [None, None]
@@ -0,0 +1,60 @@
+import nbformat
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import render_cache
+
+
+def test_render_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_cache, 'default_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(render_cache, 'n_workers', 0)
+    monkeypatch.setattr(render_cache, 'size_total', None)
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('x = 42')])
+    path = tmp_path / 'nb.ipynb'
+    nbformat.write(nb, str(path))
+
+    html_data = render_cache.render_html(str(path))
+    assert 'x = 42' in html_data or 'x</span>' in html_data
+    key = render_cache.get_key(path.read_bytes(), render_cache.get_settings())
+    assert os.path.exists(render_cache.get_path(key))
+
+    # a hit comes from the cache, a changed notebook gets a new key
+    with open(render_cache.get_path(key), 'w', encoding='utf-8') as fp:
+        fp.write('cached')
+    assert render_cache.render_html(str(path)) == 'cached'
+    nb.cells[0].source = 'x = 43'
+    nbformat.write(nb, str(path))
+    assert render_cache.render_html(str(path)) != 'cached'
+
+    # LRU eviction
+    assert len(render_cache.evict(max_bytes=0)) == 2
+    assert render_cache.size_total == 0
+
+
+def test_evict_on_size_total(tmp_path, monkeypatch):
+    monkeypatch.setattr(render_cache, 'default_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(render_cache, 'n_workers', 0)
+    monkeypatch.setattr(render_cache, 'size_total', None)
+    evicted = []
+    monkeypatch.setattr(render_cache, 'evict', lambda: evicted.append(render_cache.size_total))
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / f'nb{i}.ipynb')
+        nbformat.write(nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell(f'x = {i}')]), str(paths[-1]))
+
+    render_cache.render_html(str(paths[0]))
+    assert render_cache.size_total is None and not evicted # no walk yet (as in the jobs) -> left to the server
+
+    monkeypatch.setattr(render_cache, 'size_total', 0)
+    size = os.path.getsize(render_cache.get_path(render_cache.get_key(paths[0].read_bytes(), render_cache.get_settings())))
+    monkeypatch.setattr(render_cache, 'max_size_mb', 1.5 * size / 1024**2)
+    render_cache.render_html(str(paths[1]))
+    assert not evicted and render_cache.size_total > 0 # below max_size_mb, no walk of the cache
+    render_cache.render_html(str(paths[2]))
+    assert len(evicted) == 1
+    render_cache.render_html(str(paths[2])) # hits do not count
+    assert len(evicted) == 1
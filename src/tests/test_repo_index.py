@@ -0,0 +1,82 @@
+import nbformat
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import repo_index
+
+
+def test_repo_index(tmp_path, monkeypatch):
+    repo = tmp_path / 'repo'
+    (repo / 'sub' / '.ipynb_checkpoints').mkdir(parents=True)
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('a = 1', metadata={'tags': ['parameters']})])
+    nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'}
+    for p in ['a.ipynb', 'sub/b.ipynb', 'sub/.ipynb_checkpoints/b-checkpoint.ipynb']:
+        nbformat.write(nb, str(repo / p))
+
+    monkeypatch.setattr(repo_index, 'repo_dir', str(repo))
+    monkeypatch.setattr(repo_index, 'filepath', str(tmp_path / 'index.json'))
+    monkeypatch.setattr(repo_index, '_index', {})
+    assert repo_index.refresh() == 2
+    scripts = repo_index.get_scripts()
+    assert sorted(os.path.basename(k) for k in scripts) == ['a.ipynb', 'b.ipynb']
+    assert scripts[str(repo / 'a.ipynb')]['params']['a']['default'] == '1'
+
+    # only changed files are inspected again and deleted ones are dropped
+    assert repo_index.refresh() == 0
+    nb.cells[0].source = 'a = 22'
+    nbformat.write(nb, str(repo / 'a.ipynb'))
+    os.remove(repo / 'sub' / 'b.ipynb')
+    assert repo_index.refresh() == 2
+    assert list(repo_index.get_scripts()) == [str(repo / 'a.ipynb')]
+
+    # the index is persistent
+    monkeypatch.setattr(repo_index, '_index', {})
+    repo_index.load()
+    assert repo_index.get_info(str(repo / 'a.ipynb'))['params']['a']['default'] == '22'
+
+
+def test_repo_index_parallel(tmp_path, monkeypatch):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('a = 1', metadata={'tags': ['parameters']})])
+    nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'}
+    for i in range(4):
+        nbformat.write(nb, str(repo / f'nb_{i}.ipynb'))
+    (repo / 'broken.ipynb').write_text('not a notebook')
+
+    monkeypatch.setattr(repo_index, 'repo_dir', str(repo))
+    monkeypatch.setattr(repo_index, 'filepath', '')
+    monkeypatch.setattr(repo_index, '_index', {})
+    monkeypatch.setattr(repo_index, 'n_workers', 2)
+    monkeypatch.setattr(repo_index, 'min_parallel', 2)
+    assert repo_index.refresh() == 5
+    scripts = repo_index.get_scripts()
+    assert 'ERROR' in scripts[str(repo / 'broken.ipynb')]['params']
+    assert scripts[str(repo / 'nb_3.ipynb')]['params']['a']['default'] == '1'
+    assert repo_index.get_status()['n_done'] == 5
+
+
+def test_repo_index_miss(tmp_path, monkeypatch):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    nb = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('a = 1', metadata={'tags': ['parameters']})])
+    nb.metadata['kernelspec'] = {'name': 'python3', 'display_name': 'Python 3', 'language': 'python'}
+    nbformat.write(nb, str(repo / 'old.ipynb'))
+
+    monkeypatch.setattr(repo_index, 'repo_dir', str(repo))
+    monkeypatch.setattr(repo_index, 'filepath', '')
+    monkeypatch.setattr(repo_index, '_index', {})
+    assert repo_index.refresh() == 1
+
+    # new notebooks are found without waiting for the next rescan
+    nbformat.write(nb, str(repo / 'new_measurement.ipynb'))
+    assert repo_index.find('new_meas') == str(repo / 'new_measurement.ipynb')
+    assert repo_index.find('does_not_exist') is None
+
+    nbformat.write(nb, str(repo / 'newer.ipynb'))
+    assert repo_index.get_info(str(repo / 'newer.ipynb'))['params']['a']['default'] == '1'
+    assert str(repo / 'newer.ipynb') in repo_index.get_scripts()
@@ -0,0 +1,58 @@
+import datetime
+import pytest
+
+import os, inspect, sys
+current_dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parent_dir = os.path.dirname(current_dir)
+if __name__ == '__main__':
+    sys.path.insert(0, parent_dir)
+
+from JupyRunner.core import db_interface as dbi, schema, helpers
+
+template = {'script_in_path': 'x.ipynb'}
+
+
+def test_validate_trigger():
+    schema.Schedule(cron='*/5 * * * *', template_json=template).validate_trigger()
+    schema.Schedule(interval_sec=60, template_json=template).validate_trigger()
+
+    for kwargs in [dict(), dict(interval_sec=-1), dict(cron='*/5 * * * *', interval_sec=60)]: # exactly one trigger
+        with pytest.raises(AssertionError, match='either "cron" or "interval_sec"'):
+            schema.Schedule(template_json=template, **kwargs).validate_trigger()
+    with pytest.raises(AssertionError):
+        schema.Schedule(cron='61 * * * *', template_json=template).validate_trigger()
+    with pytest.raises(AssertionError, match='script_in_path'):
+        schema.Schedule(interval_sec=60, template_json={'script_params_json': {}}).validate_trigger()
+
+
+def test_materialize_skips_broken_schedules(make_db):
+    make_db()
+    now = helpers.get_utcnow()
+    past = now - datetime.timedelta(minutes=1)
+    good, broken = dbi.add_many([schema.Schedule(name='good', interval_sec=60, next_fire=past, template_json=template),
+                                 schema.Schedule(name='broken', cron='0 0 31 2 *', next_fire=past, template_json=template)])
+
+    assert len(dbi.materialize_schedules(now)) == 2 # the due fire of the broken one still happens
+    broken, good = dbi.get(schema.Schedule, broken.id), dbi.get(schema.Schedule, good.id)
+    assert not broken.enabled and 'never fires' in broken.comments
+    assert good.enabled and good.next_fire > now and good.n_fired == 1
+    assert dbi.materialize_schedules(now + datetime.timedelta(minutes=2)) != [] # only the good one is left
+    assert dbi.get(schema.Schedule, broken.id).n_fired == 1
+
+
+def test_missed_fires_fire_once(make_db):
+    make_db()
+    now = helpers.get_utcnow()
+    missed = now - datetime.timedelta(hours=1) # e.G. the server was down for 60 fire times
+    schedule, = dbi.add_many([schema.Schedule(name='every_minute', interval_sec=60, next_fire=missed, template_json=template)])
+
+    ids = dbi.materialize_schedules(now)
+    assert len(ids) == 1
+    script = dbi.get(schema.Script, ids[0])
+    assert script.start_condition == missed and script.data_json['schedule_id'] == schedule.id
+    assert script.submitter == 'schedule:every_minute'
+
+    schedule = dbi.get(schema.Schedule, schedule.id)
+    assert schedule.n_fired == 1 and schedule.last_script_id == ids[0] and schedule.last_fire == missed
+    assert now < schedule.next_fire <= now + datetime.timedelta(seconds=60)
+    assert dbi.materialize_schedules(now) == []